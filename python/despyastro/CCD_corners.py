@@ -144,7 +144,7 @@ def DESDM_corners(hdr, border=0):
     else:
         nx = hdr['naxis1']
         ny = hdr['naxis2']
-    wcs = wcsutil.WCS(hdr)
+    wcs = wcsutil.get_wcs(hdr)
     rac1, decc1 = wcs.image2sky(1+border, 1+border)
     rac2, decc2 = wcs.image2sky(nx-border, 1+border)
     rac3, decc3 = wcs.image2sky(nx-border, ny-border)
@@ -7,5 +7,8 @@ from . import astrometry
 from . import coords
 from . import tableio
 from . import wcsutil
+from . import focalplane
+from . import skymatch
+from . import healpix
 from . import genutil
 from .genutil import *
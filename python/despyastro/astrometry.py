@@ -182,10 +182,20 @@ def sky_area(ra, dec, units='degrees'):
     return area
 
 
-def get_pixelscale(header, units='arcsec'):
+def get_pixelscale(header, units='arcsec', x=None, y=None):
     """Returns the pixel-scale from the CDX_X matrix in an WCS-compiant header.
+
+    If x,y positions are given, returns instead the pixel-scale at each
+    position, the square root of the pixel area from the full WCS including
+    the distortion and the projection.
     """
     import math
+    if x is not None or y is not None:
+        import numpy
+        from despyastro import wcsutil
+        wcs = wcsutil.get_wcs(header)
+        return numpy.sqrt(wcs.pixel_area(x, y, units=units))
+
     if units == 'arcsec':
         scale = 3600
     elif units == 'arcmin':
@@ -213,8 +223,8 @@ def update_wcs_matrix(header, x0, y0, naxis1, naxis2):
 
     # We need to make a deep copy/otherwise if fails
     h = copy.deepcopy(header)
-    # Get the wcs object
-    wcs = wcsutil.WCS(h)
+    # Get the wcs object, shared through the process-wide cache
+    wcs = wcsutil.get_wcs(h)
     # Recompute CRVAL1/2 on the new center x0,y0
     CRVAL1, CRVAL2 = wcs.image2sky(x0, y0)
     # Asign CRPIX1/2 on the new image
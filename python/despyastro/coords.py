@@ -10,6 +10,12 @@ Felipe Menanteau, NCSA, March 2014.
         coordinate transformations.
 
     COORDINATE TRANSFORMATIONS
+        convert_frame(lon, lat, from_frame, to_frame, dtype='f8'):
+            Transform between the frames 'eq' (J2000), 'eq1950', 'gal',
+            'ec' (J2000), 'ec1950' and 'sdss', each of which is a cached
+            3x3 rotation matrix; frame_matrix(from_frame, to_frame) gives
+            the composed matrix.  All the routines below use it.
+
         euler:  
             A generic routine for transforming between Galactic, Celestial,
             and ecliptic coords.  The following wrapper routines are also
@@ -31,6 +37,7 @@ Felipe Menanteau, NCSA, March 2014.
             Convert galactic to ecliptic coordinates.
 
         # These SDSS specific functions do not use euler
+        # but convert_frame
         eq2sdss
             Convert between equatorial and corrected SDSS survey coords.
         sdss2eq
@@ -49,6 +56,10 @@ Felipe Menanteau, NCSA, March 2014.
             Calculate the arc length between two sets of points on the sphere.
             Currently only takes ra,dec.
 
+        sphneighbors(ra1, dec1, ra2, dec2, radius, filename=None):
+            All the neighbors within radius, as CSR arrays offsets,
+            indices, distances, optionally streamed to a file.
+
         shiftlon:
             shift the input longitude.  By default wrap the coordinate to
             -180,180.  If a shift is entered, return the new value
@@ -135,6 +146,219 @@ _sdsspar['doc'] = """
 """
 
 
+#   J2000 coordinate conversions are based on the following constants
+#   (see the Hipparcos explanatory supplement).
+#  eps = 23.4392911111d           Obliquity of the ecliptic
+#  alphaG = 192.85948d            Right Ascension of Galactic North Pole
+#  deltaG = 27.12825d             Declination of Galactic North Pole
+#  lomega = 32.93192d             Galactic longitude of celestial equator
+#  alphaE = 180.02322d            Ecliptic longitude of Galactic North Pole
+#  deltaE = 29.811438523d         Ecliptic latitude of Galactic North Pole
+#  Eomega  = 6.3839743d           Galactic longitude of ecliptic equator
+# Euler angles psi, sin(theta), cos(theta), phi of the RA-Dec to Galactic
+# and RA-Dec to Ecliptic rotations, by equinox
+_euler_par = {}
+_euler_par['J2000'] = {'gal': (0.57477043300, 0.88998808748,
+                               0.45598377618, 4.9368292465),
+                       'ec': (0.00000000000, 0.39777715593,
+                              0.91748206207, 0.0000000000)}
+_euler_par['B1950'] = {'gal': (0.57595865315, 0.88781538514,
+                               0.46019978478, 4.9261918136),
+                       'ec': (0.00000000000, 0.39788119938,
+                              0.91743694670, 0.0000000000)}
+
+# The frames of convert_frame, and the euler select numbers
+_frame_names = ['eq', 'eq1950', 'gal', 'ec', 'ec1950', 'sdss']
+_euler_select = {1: ('eq', 'gal'), 2: ('gal', 'eq'),
+                 3: ('eq', 'ec'), 4: ('ec', 'eq'),
+                 5: ('ec', 'gal'), 6: ('gal', 'ec')}
+_frame_1950 = {'eq': 'eq1950', 'ec': 'ec1950'}
+
+# rotation matrices of the frames from J2000 RA-Dec, and composed ones
+_frame_matrices = {}
+_frame_cache = {}
+
+# points per block in convert_frame
+_frame_chunk_size = 65536
+
+
+def _euler_matrix(psi, stheta, ctheta, phi):
+    """
+    The rotation of unit vectors done by euler(): longitude minus phi,
+    rotation by theta about the x axis, then longitude plus psi.
+    """
+    def zrot(angle):
+        c, s = math.cos(angle), math.sin(angle)
+        return numpy.array([[c, -s, 0.0], [s, c, 0.0], [0.0, 0.0, 1.0]])
+
+    xrot = numpy.array([[1.0, 0.0, 0.0],
+                        [0.0, ctheta, stheta],
+                        [0.0, -stheta, ctheta]])
+    return numpy.dot(zrot(psi), numpy.dot(xrot, zrot(-phi)))
+
+
+def _get_frame_matrix(frame):
+    """
+    The matrix taking unit vectors in J2000 RA-Dec to frame, built on
+    first use.
+    """
+    if not _frame_matrices:
+        j2000 = _euler_par['J2000']
+        b1950 = _euler_par['B1950']
+        mats = {}
+        mats['eq'] = numpy.identity(3)
+        mats['gal'] = _euler_matrix(*j2000['gal'])
+        mats['ec'] = _euler_matrix(*j2000['ec'])
+
+        # B1950 RA-Dec is tied to J2000 through the galactic frame
+        mats['eq1950'] = numpy.dot(_euler_matrix(*b1950['gal']).T,
+                                   mats['gal'])
+        mats['ec1950'] = numpy.dot(_euler_matrix(*b1950['ec']),
+                                   mats['eq1950'])
+
+        # clambda = -arcsin(x), ceta = arctan2(z, y) - etapole with x,y,z
+        # relative to the node.  The first is a reflection, which is fine
+        # as the inverse is still the transpose
+        ce = math.cos(_sdsspar['etapole'])
+        se = math.sin(_sdsspar['etapole'])
+        sdss = numpy.array([[0.0, ce, se],
+                            [0.0, -se, ce],
+                            [-1.0, 0.0, 0.0]])
+        cn = math.cos(_sdsspar['node'])
+        sn = math.sin(_sdsspar['node'])
+        node = numpy.array([[cn, sn, 0.0], [-sn, cn, 0.0], [0.0, 0.0, 1.0]])
+        mats['sdss'] = numpy.dot(sdss, node)
+
+        _frame_matrices.update(mats)
+
+    if frame not in _frame_matrices:
+        raise ValueError("frame must be one of %s" % ", ".join(_frame_names))
+    return _frame_matrices[frame]
+
+
+def frame_matrix(from_frame, to_frame):
+    """
+    NAME:
+        frame_matrix
+    PURPOSE:
+        The 3x3 matrix that rotates unit vectors from one frame to another.
+
+    CALLING SEQUENCE:
+        m = frame_matrix(from_frame, to_frame)
+
+    INPUTS:
+        from_frame, to_frame: One of 'eq' (J2000 RA-Dec), 'eq1950' (B1950
+            RA-Dec), 'gal', 'ec' (J2000 ecliptic), 'ec1950' and 'sdss'
+            (corrected SDSS survey coordinates ceta, clambda).
+
+    OUTPUTS:
+        m: The matrix, such that xyz_to = m . xyz_from.  It is composed
+            once for each pair of frames and cached; do not modify it.
+    """
+    key = (from_frame, to_frame)
+    matrix = _frame_cache.get(key)
+    if matrix is None:
+        matrix = numpy.dot(_get_frame_matrix(to_frame),
+                           _get_frame_matrix(from_frame).T)
+        matrix.flags.writeable = False
+        _frame_cache[key] = matrix
+    return matrix
+
+
+def convert_frame(lon_in, lat_in, from_frame, to_frame, dtype='f8',
+                  chunk_size=None):
+    """
+    NAME:
+        convert_frame
+    PURPOSE:
+        Transform longitude and latitude between coordinate frames.
+
+    CALLING SEQUENCE:
+        lon, lat = convert_frame(lon_in, lat_in, from_frame, to_frame,
+                                 dtype='f8')
+
+    INPUTS:
+        lon_in, lat_in: Longitude and latitude in degrees, scalars or
+            arrays of the same shape.
+        from_frame, to_frame: The frames, see frame_matrix.
+
+    OPTIONAL INPUTS:
+        dtype: The data type of the outputs.  Default is 'f8'; the
+            calculation is always in double precision.
+        chunk_size: The points are converted in blocks of this many,
+            reusing the same buffers.  Default 65536.
+
+    OUTPUTS:
+        lon, lat: Longitude and latitude in degrees, always arrays with
+            at least one dimension.  The longitude is in [0,360), or in
+            [-180,180) for 'sdss' as for eq2sdss.
+
+    NOTES:
+        The points go to unit vectors, are rotated with the cached
+        composed matrix of the two frames in one matrix product per
+        block, and back to angles with arctan2, so chaining conversions
+        costs no more than a single one.
+    """
+    lon_in = numpy.asarray(lon_in, dtype='f8')
+    lat_in = numpy.asarray(lat_in, dtype='f8')
+    if lon_in.shape != lat_in.shape:
+        raise ValueError("longitude and latitude must be the same shape")
+    if chunk_size is None:
+        chunk_size = _frame_chunk_size
+
+    matrix = frame_matrix(from_frame, to_frame)
+    wrap = 180.0 if to_frame == 'sdss' else 0.0
+
+    shape = lon_in.shape if lon_in.ndim > 0 else (1,)
+    lon_out = numpy.empty(shape, dtype=dtype)
+    lat_out = numpy.empty(shape, dtype=dtype)
+    lonflat, latflat = lon_in.reshape(-1), lat_in.reshape(-1)
+    lon_outflat, lat_outflat = lon_out.reshape(-1), lat_out.reshape(-1)
+
+    # buffers: unit vectors as rows x, y, z, so that the matrix product
+    # and the trig work on contiguous memory
+    n = 0
+    for i0 in range(0, lonflat.size, chunk_size):
+        i1 = min(i0+chunk_size, lonflat.size)
+        if i1-i0 != n:
+            n = i1-i0
+            xyz = numpy.empty((3, n))
+            rot = numpy.empty((3, n))
+            a = numpy.empty(n)
+            b = numpy.empty(n)
+            cb = numpy.empty(n)
+
+        numpy.multiply(lonflat[i0:i1], D2R, out=a)
+        numpy.multiply(latflat[i0:i1], D2R, out=b)
+        numpy.cos(b, out=cb)
+        numpy.sin(b, out=xyz[2])
+        numpy.cos(a, out=xyz[0])
+        xyz[0] *= cb
+        numpy.sin(a, out=xyz[1])
+        xyz[1] *= cb
+
+        numpy.dot(matrix, xyz, out=rot)
+
+        numpy.arctan2(rot[1], rot[0], out=a)
+        # cos(latitude), then the latitude, accurate also near the poles
+        numpy.multiply(rot[0], rot[0], out=cb)
+        numpy.multiply(rot[1], rot[1], out=b)
+        cb += b
+        numpy.sqrt(cb, out=cb)
+        numpy.arctan2(rot[2], cb, out=b)
+
+        # longitude into [0,360) or [-180,180)
+        a *= R2D
+        a += wrap
+        numpy.add(a, 360.0, out=a, where=a < 0.0)
+        numpy.subtract(a, 360.0, out=a, where=a >= 360.0)
+        a -= wrap
+        lon_outflat[i0:i1] = a
+        numpy.multiply(b, R2D, out=lat_outflat[i0:i1])
+
+    return lon_out, lat_out
+
+
 def euler(ai_in, bi_in, select, b1950=False, dtype='f8'):
     """
     NAME:
@@ -167,6 +391,10 @@ def euler(ai_in, bi_in, select, b1950=False, dtype='f8'):
        b1950 - If this keyword is true then input and output 
              celestial and ecliptic coordinates should be given in equinox 
              B1950.
+    NOTES:
+       The transformation is done by convert_frame, as a rotation of unit
+       vectors.
+
     REVISION HISTORY:
        Written W. Landsman,  February 1987
        Adapted from Fortran by Daryl Yentis NRL
@@ -178,75 +406,14 @@ def euler(ai_in, bi_in, select, b1950=False, dtype='f8'):
 
     """
 
-    # Make a copy as an array. ndmin=1 to avoid messed up scalar arrays
-    ai = numpy.array(ai_in, ndmin=1, copy=True, dtype=dtype)
-    bi = numpy.array(bi_in, ndmin=1, copy=True, dtype=dtype)
-
-    twopi = 2.0*PI
-    fourpi = 4.0*PI
-
-    #   J2000 coordinate conversions are based on the following constants
-    #   (see the Hipparcos explanatory supplement).
-    #  eps = 23.4392911111d           Obliquity of the ecliptic
-    #  alphaG = 192.85948d            Right Ascension of Galactic North Pole
-    #  deltaG = 27.12825d             Declination of Galactic North Pole
-    #  lomega = 32.93192d             Galactic longitude of celestial equator
-    #  alphaE = 180.02322d            Ecliptic longitude of Galactic North Pole
-    #  deltaE = 29.811438523d         Ecliptic latitude of Galactic North Pole
-    #  Eomega  = 6.3839743d           Galactic longitude of ecliptic equator
-    # Parameters for all the different conversions
+    if select not in _euler_select:
+        raise ValueError("select must be an integer 1-6")
+    from_frame, to_frame = _euler_select[select]
     if b1950:
+        from_frame = _frame_1950.get(from_frame, from_frame)
+        to_frame = _frame_1950.get(to_frame, to_frame)
 
-        equinox = '(B1950)'
-        psi = numpy.array([0.57595865315, 4.9261918136,
-                           0.00000000000, 0.0000000000,
-                           0.11129056012, 4.7005372834], dtype=dtype)
-        stheta = numpy.array([0.88781538514, -0.88781538514,
-                              0.39788119938, -0.39788119938,
-                              0.86766174755, -0.86766174755], dtype=dtype)
-        ctheta = numpy.array([0.46019978478, 0.46019978478,
-                              0.91743694670, 0.91743694670,
-                              0.49715499774, 0.49715499774], dtype=dtype)
-        phi = numpy.array([4.9261918136, 0.57595865315,
-                           0.0000000000, 0.00000000000,
-                           4.7005372834, 0.11129056012], dtype=dtype)
-
-    else:
-
-        equinox = '(J2000)'
-
-        psi = numpy.array([0.57477043300, 4.9368292465,
-                           0.00000000000, 0.0000000000,
-                           0.11142137093, 4.71279419371], dtype=dtype)
-        stheta = numpy.array([0.88998808748, -0.88998808748,
-                              0.39777715593, -0.39777715593,
-                              0.86766622025, -0.86766622025], dtype=dtype)
-        ctheta = numpy.array([0.45598377618, 0.45598377618,
-                              0.91748206207, 0.91748206207,
-                              0.49714719172, 0.49714719172], dtype=dtype)
-        phi = numpy.array([4.9368292465, 0.57477043300,
-                           0.0000000000, 0.00000000000,
-                           4.71279419371, 0.11142137093], dtype=dtype)
-
-    # zero offset
-    i = select - 1
-    a = ai*D2R - phi[i]
-
-    b = bi*D2R
-    sb = sin(b)
-    cb = cos(b)
-    cbsa = cb * sin(a)
-    b = -stheta[i] * cbsa + ctheta[i] * sb
-    w, = numpy.where(b > 1.0)
-    if w.size > 0:
-        b[w] = 1.0
-    bo = arcsin(b)*R2D
-
-    a = arctan2(ctheta[i] * cbsa + stheta[i] * sb, cb * cos(a))
-
-    ao = ((a+psi[i]+fourpi) % twopi) * R2D
-
-    return ao, bo
+    return convert_frame(ai_in, bi_in, from_frame, to_frame, dtype=dtype)
 
 
 #
@@ -517,6 +684,42 @@ def sphdist(ra1, dec1, ra2, dec2, units=['deg', 'deg']):
     return theta
 
 
+def sphneighbors(ra1, dec1, ra2, dec2, radius, filename=None, **keys):
+    """
+    Find all the points of a second set within radius of each point of
+    the first, as compact CSR arrays rather than lists of arrays.
+
+    parameters
+    ----------
+    ra1,dec1: scalar or array
+        The points to query, in degrees.
+    ra2,dec2: array
+        The points searched, in degrees.  They are indexed with a
+        skymatch.SkyIndex; to run several queries on the same set, build
+        one and call its neighbors() method.
+    radius: scalar or array
+        Radius in degrees, for all the points or for each of ra1,dec1.
+    filename: string, optional
+        Write the arrays to this file chunk by chunk instead of returning
+        them; read it with skymatch.iter_neighbors or read_neighbors.
+    keys:
+        chunksize, max_pairs, nproc, dtype and cellsize as for
+        skymatch.SkyIndex.neighbors.
+
+    returns
+    -------
+    offsets,indices,distances:
+        The neighbors of point i of the first set are
+        indices[offsets[i]:offsets[i+1]] in the second, at distances in
+        degrees distances[offsets[i]:offsets[i+1]], closest first.  With
+        filename, the number of pairs written.
+    """
+    from despyastro import skymatch
+
+    index = skymatch.SkyIndex(ra2, dec2, cellsize=keys.pop('cellsize', None))
+    return index.neighbors(ra1, dec1, radius, filename=filename, **keys)
+
+
 def gcirc(ra1deg, dec1deg, ra2deg, dec2deg, getangle=False):
     """
     This is currently very inflexible: degrees in, radians out
@@ -622,9 +825,9 @@ def eq2sdss(ra_in, dec_in, dtype='f8'):
       Written: 11-March-2006  Converted from IDL program.
     """
 
-    # Make a copy as an array. ndmin=1 to avoid messed up scalar arrays
-    ra = numpy.array(ra_in, ndmin=1, copy=True, dtype=dtype)
-    dec = numpy.array(dec_in, ndmin=1, copy=True, dtype=dtype)
+    # No copy, convert_frame does not modify its inputs
+    ra = numpy.asarray(ra_in, dtype='f8')
+    dec = numpy.asarray(dec_in, dtype='f8')
 
     if (ra.size != dec.size):
         raise ValueError("RA, DEC must be same size")
@@ -635,39 +838,7 @@ def eq2sdss(ra_in, dec_in, dtype='f8'):
     if (dec.min() < -90.0) | (dec.max() > 90.0):
         raise ValueError('DEC must we within [-90,90]')
 
-    ra *= D2R
-    dec *= D2R
-    ra -= _sdsspar['node']
-
-    # generate x,y,z on unit sphere, clearing memory as we go
-    cdec = cos(dec)
-
-    x = cos(ra)*cdec
-    y = sin(ra)*cdec
-
-    ra = 0
-    cdec = 0 # mem
-
-    z = numpy.sin(dec)
-
-    dec = 0 # mem
-
-    # generate clambda, ceta
-    # do things in place to save memory
-
-    # clambda = -arcsin( x ) (not a copy clambda=x)
-    arcsin(x, x)
-    clambda = x
-    clambda *= -1
-
-    arctan2(z, y, z)
-    ceta = z
-    ceta -= _sdsspar['etapole']
-
-    clambda *= R2D
-    ceta *= R2D
-
-    atbound(ceta, -180.0, 180.0)
+    ceta, clambda = convert_frame(ra, dec, 'eq', 'sdss', dtype=dtype)
 
     return (clambda, ceta)
 
@@ -699,9 +870,9 @@ def sdss2eq(clambda_in, ceta_in, dtype='f8'):
       Written: 11-March-2006  Converted from IDL program.
     """
 
-    # Make a copy as an array. ndmin=1 to avoid messed up scalar arrays
-    clambda = numpy.array(clambda_in, ndmin=1, copy=True, dtype=dtype)
-    ceta = numpy.array(ceta_in, ndmin=1, copy=True, dtype=dtype)
+    # No copy, convert_frame does not modify its inputs
+    clambda = numpy.asarray(clambda_in, dtype='f8')
+    ceta = numpy.asarray(ceta_in, dtype='f8')
 
     # range checking
     if (clambda.min() < -90.0) | (clambda.max() > 90.0):
@@ -709,19 +880,7 @@ def sdss2eq(clambda_in, ceta_in, dtype='f8'):
     if (ceta.min() < -180.0) | (ceta.max() > 180.0):
         raise ValueError('CETA must we within [-180,180]')
 
-    clambda *= D2R
-    ceta *= D2R
-
-    x = -sin(clambda)
-    y = cos(ceta + _sdsspar['etapole'])*cos(clambda)
-    z = sin(ceta + _sdsspar['etapole'])*cos(clambda)
-
-    ra = arctan2(y, x) + _sdsspar['node']
-    dec = arcsin(z)
-
-    ra *= R2D
-    dec *= R2D
-    atbound2(dec, ra)
+    ra, dec = convert_frame(ceta, clambda, 'sdss', 'eq', dtype=dtype)
 
     return (ra, dec)
 
@@ -0,0 +1,595 @@
+"""WCS transformations for all the CCDs of a focal plane at once.
+
+A DECam exposure has ~62 CCD headers, each with its own WCS.  Rather than
+looping over wcsutil.WCS objects, FocalPlaneWCS packs CRPIX, the CD matrices,
+the rotation matrices and the distortion coefficients of all the CCDs into
+stacked arrays, and transforms points given as (ccdnum, x, y) or
+(ccdnum, lon, lat) in a single vectorized pass.
+
+MosaicLookup answers the reverse question: which CCD of an exposure, or of
+a whole night, and which pixel does each sky position land on.
+
+Examples:
+    from despyastro import focalplane
+    fp = focalplane.FocalPlaneWCS(headers)
+    ra, dec = fp.image2sky(ccdnum, x, y)
+    x, y = fp.sky2image(ccdnum, ra, dec)
+
+    mosaic = focalplane.MosaicLookup(headers)
+    ccd_index, x, y = mosaic.lookup(ra, dec)
+"""
+
+import math
+
+import numpy
+
+from despyastro import wcsutil
+from despyastro import CCD_corners
+
+r2d = 180.0/math.pi
+d2r = math.pi/180.0
+
+
+class FocalPlaneWCS(object):
+    """A stack of CCD WCS solutions sharing one projection.
+
+    Usage:
+        fp = FocalPlaneWCS(headers, ccdnums=None)
+
+    headers is a sequence of headers (anything wcsutil.WCS accepts) or of
+    wcsutil.WCS objects, or a table with one header per row (see
+    wcsutil.is_header_table).  ccdnums are the numbers used to address the
+    CCDs; by default the CCDNUM keyword of each header, or 0..N-1 if it is
+    not present in all of them.
+
+    All the CCDs must have the same projection and distortion model.  The
+    distortion matrices are zero padded to the largest order present.  The
+    inverse matrices are only stacked when sky2image first needs them, so
+    the CCDs whose headers have no inverse coefficients are not fit (see
+    wcsutil.DistortionModel) when only image2sky is used.
+    """
+
+    def __init__(self, headers, ccdnums=None):
+        # The CCDNUM of each header, None where it has none.  They come
+        # from the headers as the cached WCS objects only hold the WCS
+        # keywords
+        if wcsutil.is_header_table(headers):
+            self.wcslist = wcsutil.build_wcs_list(headers)
+            hdrnums = wcsutil.header_columns(headers, keys=['ccdnum'])
+            hdrnums = hdrnums.get('ccdnum', [None]*len(self.wcslist))
+        else:
+            self.wcslist = []
+            hdrnums = []
+            for hdr in headers:
+                if isinstance(hdr, wcsutil.WCS):
+                    self.wcslist.append(hdr)
+                    hdrnums.append(hdr.wcs.get('ccdnum'))
+                else:
+                    self.wcslist.append(wcsutil.get_wcs(hdr))
+                    hdrnums.append(wcsutil.header_value(hdr, 'ccdnum'))
+
+        nccd = len(self.wcslist)
+        if nccd == 0:
+            raise ValueError('Need at least one CCD')
+
+        if ccdnums is None:
+            if all(num is not None for num in hdrnums):
+                ccdnums = hdrnums
+            else:
+                ccdnums = range(nccd)
+        self.ccdnums = numpy.array(ccdnums, dtype='i8')
+        if self.ccdnums.size != nccd:
+            raise ValueError('Need one ccdnum per header')
+        if numpy.unique(self.ccdnums).size != nccd:
+            raise ValueError('ccdnums must be unique')
+        if self.ccdnums.min() < 0:
+            raise ValueError('ccdnums must be >= 0')
+
+        # Dense lookup table from ccdnum to position in the stack
+        self._lookup = numpy.zeros(self.ccdnums.max()+1, dtype='i8') - 1
+        self._lookup[self.ccdnums] = numpy.arange(nccd)
+
+        self.projection = self.wcslist[0].projection.upper()
+        self.distort_name = self.wcslist[0].distort['name']
+        for w in self.wcslist:
+            if w.projection.upper() != self.projection:
+                raise ValueError('All CCDs must have the same projection')
+            if w.distort['name'] != self.distort_name:
+                raise ValueError('All CCDs must have the same distortion')
+
+        self.crpix = numpy.array([w.crpix for w in self.wcslist], dtype='f8')
+        self.crval = numpy.array([w.crval for w in self.wcslist], dtype='f8')
+        self.cd = numpy.array([w.cd for w in self.wcslist], dtype='f8')
+        self.cdinv = numpy.array([w.cdinv for w in self.wcslist], dtype='f8')
+        self.rotation = numpy.array([w.rotation_matrix
+                                     for w in self.wcslist], dtype='f8')
+
+        # Stacked distortion matrices and their derivatives; the inverse
+        # 'ap', 'bp' are added by _inverse_stacks
+        self.distort = {}
+        if self.distort_name != 'none':
+            for name in ['a', 'b']:
+                stack = _pad_stack([w.distort[name] for w in self.wcslist])
+                self.distort[name] = stack
+                derivs = [wcsutil.Differentiate2DPolynomial(m)
+                          for m in self.distort[name]]
+                self.distort[name+'_x'] = numpy.array([d[0] for d in derivs])
+                self.distort[name+'_y'] = numpy.array([d[1] for d in derivs])
+
+    def __len__(self):
+        return len(self.wcslist)
+
+    def __getitem__(self, ccdnum):
+        """The wcsutil.WCS of one CCD.
+        """
+        return self.wcslist[self.index(ccdnum)[0]]
+
+    def index(self, ccdnum):
+        """Positions in the stack of the input ccdnums.
+        """
+        ccdnum = numpy.atleast_1d(numpy.asarray(ccdnum, dtype='i8'))
+        bad = (ccdnum < 0) | (ccdnum >= self._lookup.size)
+        idx = self._lookup[numpy.where(bad, 0, ccdnum)]
+        idx[bad] = -1
+        if (idx < 0).any():
+            w, = numpy.where(idx.ravel() < 0)
+            raise ValueError('Unknown ccdnum %s' % ccdnum.ravel()[w[0]])
+        return idx
+
+    def image2sky(self, ccdnum, x, y, distort=True):
+        """Convert image x,y on CCD ccdnum to sky coordinates lon,lat.
+
+        ccdnum can be a scalar or an array of the same length as x, y.
+        Returns arrays, or scalars if x, y are scalars.
+        """
+        arescalar = numpy.isscalar(x)
+        x, y, idx = self._prepare(ccdnum, x, y)
+
+        u, v = self._tangent(idx, x - self.crpix[idx, 0],
+                             y - self.crpix[idx, 1], distort=distort)
+        lon, lat = _native2sky(self.rotation, idx, u, v)
+
+        if arescalar:
+            return lon[0], lat[0]
+        return lon, lat
+
+    def sky2image(self, ccdnum, lon, lat, distort=True, find=True,
+                  tol=1.0e-8, maxiter=20):
+        """Convert sky coordinates lon,lat to image x,y on CCD ccdnum.
+
+        Same conventions as wcsutil.WCS.sky2image.  With find=True the
+        forward transform is inverted with a vectorized Newton iteration
+        started from the polynomial inverse; points that do not converge to
+        tol pixels in maxiter iterations are solved by their CCD's WCS.
+        """
+        arescalar = numpy.isscalar(lon)
+        lon, lat, idx = self._prepare(ccdnum, lon, lat)
+
+        u0, v0 = _sky2native(self.rotation, idx, lon, lat)
+        xdiff, ydiff = self._inverse_tangent(idx, u0, v0, distort=distort)
+
+        if find and distort and self.distort_name != 'none':
+            active = numpy.arange(lon.size)
+            for i in range(maxiter):
+                ia = idx[active]
+                u, v, dudx, dudy, dvdx, dvdy = \
+                    self._tangent_jacobian(ia, xdiff[active], ydiff[active])
+                du = u0[active] - u
+                dv = v0[active] - v
+
+                det = dudx*dvdy - dudy*dvdx
+                dx = (dvdy*du - dudy*dv)/det
+                dy = (dudx*dv - dvdx*du)/det
+                xdiff[active] += dx
+                ydiff[active] += dy
+
+                converged = (numpy.abs(dx) < tol) & (numpy.abs(dy) < tol)
+                active = active[~converged]
+                if active.size == 0:
+                    break
+
+            for i in active:
+                w = self.wcslist[idx[i]]
+                xf, yf = w._findxy_fsolve(lon[i:i+1], lat[i:i+1])
+                xdiff[i] = xf[0] - self.crpix[idx[i], 0]
+                ydiff[i] = yf[0] - self.crpix[idx[i], 1]
+
+        x = xdiff + self.crpix[idx, 0]
+        y = ydiff + self.crpix[idx, 1]
+
+        if arescalar:
+            return x[0], y[0]
+        return x, y
+
+    def _prepare(self, ccdnum, x, y):
+        x = numpy.atleast_1d(numpy.asarray(x, dtype='f8'))
+        y = numpy.atleast_1d(numpy.asarray(y, dtype='f8'))
+        if x.size != y.size:
+            raise ValueError('coordinates must be the same size')
+        idx = self.index(ccdnum)
+        if idx.size == 1:
+            idx = numpy.zeros(x.size, dtype='i8') + idx[0]
+        elif idx.size != x.size:
+            raise ValueError('ccdnum must be a scalar or the same size '
+                             'as the coordinates')
+        return x, y, idx
+
+    def _apply_cd(self, cd, idx, x, y):
+        xp = cd[idx, 0, 0]*x + cd[idx, 0, 1]*y
+        yp = cd[idx, 1, 0]*x + cd[idx, 1, 1]*y
+        return xp, yp
+
+    def _tangent(self, idx, xdiff, ydiff, distort=True):
+        # pixel offsets from crpix to distorted tangent plane coordinates
+        dodistort = distort and self.distort_name != 'none'
+        if self.projection in ['-TAN', '-TPV']:
+            u, v = self._apply_cd(self.cd, idx, xdiff, ydiff)
+            if dodistort:
+                u, v = (_stacked_poly(self.distort['a'], idx, u, v),
+                        _stacked_poly(self.distort['b'], idx, u, v))
+        else:
+            if dodistort:
+                xdiff, ydiff = \
+                    (xdiff + _stacked_poly(self.distort['a'], idx,
+                                           xdiff, ydiff),
+                     ydiff + _stacked_poly(self.distort['b'], idx,
+                                           xdiff, ydiff))
+            u, v = self._apply_cd(self.cd, idx, xdiff, ydiff)
+        return u, v
+
+    def _inverse_stacks(self):
+        # The stacked inverse matrices ap, bp, built the first time they
+        # are needed, which fits the inverse of the CCDs that lack one.
+        # Two threads may both build them, with the same result.
+        if 'ap' not in self.distort:
+            ap = _pad_stack([w.distort['ap'] for w in self.wcslist])
+            bp = _pad_stack([w.distort['bp'] for w in self.wcslist])
+            self.distort['bp'] = bp
+            self.distort['ap'] = ap
+        return self.distort['ap'], self.distort['bp']
+
+    def _inverse_tangent(self, idx, u, v, distort=True):
+        # tangent plane coordinates to pixel offsets using the polynomial
+        # inverse of the distortion
+        dodistort = distort and self.distort_name != 'none'
+        if dodistort:
+            ap, bp = self._inverse_stacks()
+        if self.projection in ['-TAN', '-TPV']:
+            if dodistort:
+                u, v = (_stacked_poly(ap, idx, u, v),
+                        _stacked_poly(bp, idx, u, v))
+            xdiff, ydiff = self._apply_cd(self.cdinv, idx, u, v)
+        else:
+            xdiff, ydiff = self._apply_cd(self.cdinv, idx, u, v)
+            if dodistort:
+                xdiff, ydiff = \
+                    (xdiff + _stacked_poly(ap, idx, xdiff, ydiff),
+                     ydiff + _stacked_poly(bp, idx, xdiff, ydiff))
+        return xdiff, ydiff
+
+    def _tangent_jacobian(self, idx, xdiff, ydiff):
+        # Same as wcsutil.WCS._tangent_jacobian with per point coefficients
+        cd = self.cd
+        d = self.distort
+        if self.projection in ['-TAN', '-TPV']:
+            u, v = self._apply_cd(cd, idx, xdiff, ydiff)
+            a_u = _stacked_poly(d['a_x'], idx, u, v)
+            a_v = _stacked_poly(d['a_y'], idx, u, v)
+            b_u = _stacked_poly(d['b_x'], idx, u, v)
+            b_v = _stacked_poly(d['b_y'], idx, u, v)
+
+            dudx = a_u*cd[idx, 0, 0] + a_v*cd[idx, 1, 0]
+            dudy = a_u*cd[idx, 0, 1] + a_v*cd[idx, 1, 1]
+            dvdx = b_u*cd[idx, 0, 0] + b_v*cd[idx, 1, 0]
+            dvdy = b_u*cd[idx, 0, 1] + b_v*cd[idx, 1, 1]
+
+            u, v = (_stacked_poly(d['a'], idx, u, v),
+                    _stacked_poly(d['b'], idx, u, v))
+        else:
+            xp = xdiff + _stacked_poly(d['a'], idx, xdiff, ydiff)
+            yp = ydiff + _stacked_poly(d['b'], idx, xdiff, ydiff)
+            dxpdx = 1.0 + _stacked_poly(d['a_x'], idx, xdiff, ydiff)
+            dxpdy = _stacked_poly(d['a_y'], idx, xdiff, ydiff)
+            dypdx = _stacked_poly(d['b_x'], idx, xdiff, ydiff)
+            dypdy = 1.0 + _stacked_poly(d['b_y'], idx, xdiff, ydiff)
+
+            u, v = self._apply_cd(cd, idx, xp, yp)
+            dudx = cd[idx, 0, 0]*dxpdx + cd[idx, 0, 1]*dypdx
+            dudy = cd[idx, 0, 0]*dxpdy + cd[idx, 0, 1]*dypdy
+            dvdx = cd[idx, 1, 0]*dxpdx + cd[idx, 1, 1]*dypdx
+            dvdy = cd[idx, 1, 0]*dxpdy + cd[idx, 1, 1]*dypdy
+
+        return u, v, dudx, dudy, dvdx, dvdy
+
+
+class MosaicLookup(object):
+    """Find the CCD and pixel that each sky position lands on.
+
+    Usage:
+        mosaic = MosaicLookup(headers, border=0, cellsize=None, pad=0.001)
+        ccd_index, x, y = mosaic.lookup(ra, dec)
+
+    headers is a sequence of CCD headers or wcsutil.WCS objects, or a table
+    of headers, for one exposure or many.  ccd_index refers to the position
+    in that sequence.
+
+    The footprint of each CCD, from CCD_corners.DESDM_corners, is bounded
+    by a disc around its center, enlarged by pad degrees.  The discs are
+    registered in a grid of cells of about cellsize degrees (by default
+    the diameter of the largest CCD), equal width in declination and split
+    in RA so cells stay roughly square.  A point is only tested against the
+    CCDs registered in its cell and whose disc contains it; those
+    candidates are inverted in one batch through a FocalPlaneWCS and kept
+    when they fall inside the CCD, excluding border pixels.
+    """
+
+    def __init__(self, headers, border=0, cellsize=None, pad=0.001):
+        if wcsutil.is_header_table(headers):
+            wcslist = wcsutil.build_wcs_list(headers)
+        else:
+            wcslist = [h if isinstance(h, wcsutil.WCS) else wcsutil.get_wcs(h)
+                       for h in headers]
+        nccd = len(wcslist)
+        self.fp = FocalPlaneWCS(wcslist, ccdnums=numpy.arange(nccd))
+        self.border = border
+
+        self.nx = numpy.zeros(nccd, dtype='f8')
+        self.ny = numpy.zeros(nccd, dtype='f8')
+        self.center = numpy.zeros((nccd, 2), dtype='f8')
+        self.radius = numpy.zeros(nccd, dtype='f8')
+        for i, w in enumerate(wcslist):
+            hdr = w.wcs
+            if hdr.get('znaxis1') and hdr.get('znaxis2'):
+                self.nx[i], self.ny[i] = hdr['znaxis1'], hdr['znaxis2']
+            else:
+                self.nx[i], self.ny[i] = hdr['naxis1'], hdr['naxis2']
+
+            corners = CCD_corners.DESDM_corners(hdr)
+            self.center[i] = corners[0:2]
+            dist = _angdist(corners[0], corners[1],
+                            numpy.array(corners[2::2]),
+                            numpy.array(corners[3::2]))
+            self.radius[i] = dist.max() + pad
+
+        # unit vectors of the centers, to prune candidates
+        self._cxyz = _radec2xyz(self.center[:, 0], self.center[:, 1])
+        self._cosrad = numpy.cos(self.radius*d2r)
+
+        if cellsize is None:
+            cellsize = 2.0*self.radius.max()
+        self._build_cells(cellsize)
+
+    def __len__(self):
+        return len(self.fp)
+
+    def _build_cells(self, cellsize):
+        # Bands of declination, each split in nra cells of RA
+        self.nband = max(1, int(math.ceil(180.0/cellsize)))
+        self.bandsize = 180.0/self.nband
+        edges = numpy.arange(self.nband+1)*self.bandsize - 90.0
+        cosmin = numpy.minimum(numpy.cos(edges[:-1]*d2r),
+                               numpy.cos(edges[1:]*d2r))
+        self.nra = numpy.maximum(1, (360.0*cosmin/cellsize).astype('i8'))
+        self.band_offset = numpy.zeros(self.nband+1, dtype='i8')
+        self.band_offset[1:] = numpy.cumsum(self.nra)
+
+        cells = []
+        ccds = []
+        for i in range(len(self.fp)):
+            ra0, dec0 = self.center[i]
+            rad = self.radius[i]
+            jmin = self._band(dec0-rad)
+            jmax = self._band(dec0+rad)
+            if abs(dec0)+rad >= 90.0:
+                dra = 180.0
+            else:
+                dra = math.asin(min(1.0, math.sin(rad*d2r) /
+                                    math.cos(dec0*d2r)))*r2d
+            for j in range(jmin, jmax+1):
+                nra = self.nra[j]
+                if dra >= 180.0:
+                    kk = numpy.arange(nra)
+                else:
+                    kmin = int(math.floor((ra0-dra)/360.0*nra))
+                    kmax = int(math.floor((ra0+dra)/360.0*nra))
+                    kk = numpy.unique(numpy.arange(kmin, kmax+1) % nra)
+                cells.append(self.band_offset[j] + kk)
+                ccds.append(numpy.zeros(kk.size, dtype='i8') + i)
+
+        cells = numpy.concatenate(cells)
+        ccds = numpy.concatenate(ccds)
+        s = numpy.argsort(cells, kind='mergesort')
+
+        # CSR lists of the CCDs in each cell
+        ncell = self.band_offset[-1]
+        self.cell_ccds = ccds[s]
+        self.cell_offsets = numpy.zeros(ncell+1, dtype='i8')
+        self.cell_offsets[1:] = numpy.cumsum(numpy.bincount(cells,
+                                                            minlength=ncell))
+
+    def _band(self, dec):
+        j = numpy.floor((numpy.asarray(dec) + 90.0)/self.bandsize)
+        return numpy.clip(j, 0, self.nband-1).astype('i8')
+
+    def cell(self, ra, dec):
+        """Cell number of each ra,dec.
+        """
+        j = self._band(dec)
+        nra = self.nra[j]
+        k = numpy.floor((numpy.asarray(ra) % 360.0)/360.0*nra).astype('i8')
+        k = numpy.clip(k, 0, nra-1)
+        return self.band_offset[j] + k
+
+    def lookup_all(self, ra, dec, find=True, chunksize=1000000):
+        """All the (point, CCD) pairs where a point lands on a CCD.
+
+        Returns index, ccd_index, x, y arrays with one entry per pair,
+        index being the position of the point in ra,dec.  A point can land
+        on several CCDs when the headers span several exposures.
+        """
+        ra = numpy.atleast_1d(numpy.asarray(ra, dtype='f8'))
+        dec = numpy.atleast_1d(numpy.asarray(dec, dtype='f8'))
+        if ra.size != dec.size:
+            raise ValueError('ra and dec must be the same size')
+
+        results = []
+        for i0 in range(0, ra.size, chunksize):
+            i1 = min(i0+chunksize, ra.size)
+            index, ccd, x, y = self._lookup_chunk(ra[i0:i1], dec[i0:i1],
+                                                  find=find)
+            results.append((index+i0, ccd, x, y))
+
+        if len(results) == 0:
+            return (numpy.zeros(0, dtype='i8'), numpy.zeros(0, dtype='i8'),
+                    numpy.zeros(0, dtype='f8'), numpy.zeros(0, dtype='f8'))
+        return tuple(numpy.concatenate(r) for r in zip(*results))
+
+    def lookup(self, ra, dec, find=True, chunksize=1000000):
+        """CCD index and pixel x,y of each ra,dec.
+
+        Points off the detector get ccd_index -1 and x,y NaN.  If a point
+        lands on more than one CCD the one listed first is returned.
+        """
+        arescalar = numpy.isscalar(ra)
+        ra = numpy.atleast_1d(numpy.asarray(ra, dtype='f8'))
+        dec = numpy.atleast_1d(numpy.asarray(dec, dtype='f8'))
+        index, ccd, x, y = self.lookup_all(ra, dec, find=find,
+                                           chunksize=chunksize)
+
+        ccd_index = numpy.zeros(ra.size, dtype='i8') - 1
+        xout = numpy.zeros(ra.size, dtype='f8') + numpy.nan
+        yout = numpy.zeros(ra.size, dtype='f8') + numpy.nan
+
+        # pairs are sorted by point then CCD, keep the first of each point
+        first = numpy.ones(index.size, dtype=bool)
+        first[1:] = index[1:] != index[:-1]
+        ccd_index[index[first]] = ccd[first]
+        xout[index[first]] = x[first]
+        yout[index[first]] = y[first]
+
+        if arescalar:
+            return ccd_index[0], xout[0], yout[0]
+        return ccd_index, xout, yout
+
+    def _lookup_chunk(self, ra, dec, find=True):
+        # candidate (point, ccd) pairs from the cells
+        cell = self.cell(ra, dec)
+        start = self.cell_offsets[cell]
+        counts = self.cell_offsets[cell+1] - start
+        index = numpy.repeat(numpy.arange(ra.size), counts)
+        first = numpy.repeat(numpy.cumsum(counts)-counts, counts)
+        ccd = self.cell_ccds[numpy.repeat(start, counts) +
+                             numpy.arange(index.size) - first]
+
+        # keep the pairs inside the bounding disc of the CCD
+        px, py, pz = _radec2xyz(ra[index], dec[index])
+        c = self._cxyz
+        cosdist = px*c[0][ccd] + py*c[1][ccd] + pz*c[2][ccd]
+        w, = numpy.where(cosdist >= self._cosrad[ccd])
+        index, ccd = index[w], ccd[w]
+
+        x, y = self.fp.sky2image(ccd, ra[index], dec[index], find=find)
+
+        b = self.border
+        inside = ((x >= 0.5+b) & (x < self.nx[ccd]+0.5-b) &
+                  (y >= 0.5+b) & (y < self.ny[ccd]+0.5-b))
+        w, = numpy.where(inside)
+        return index[w], ccd[w], x[w], y[w]
+
+
+def _radec2xyz(ra, dec):
+    ra = numpy.asarray(ra)*d2r
+    dec = numpy.asarray(dec)*d2r
+    cdec = numpy.cos(dec)
+    return cdec*numpy.cos(ra), cdec*numpy.sin(ra), numpy.sin(dec)
+
+
+def _angdist(ra1, dec1, ra2, dec2):
+    # angular distance in degrees
+    x1, y1, z1 = _radec2xyz(ra1, dec1)
+    x2, y2, z2 = _radec2xyz(ra2, dec2)
+    cosd = numpy.clip(x1*x2 + y1*y2 + z1*z2, -1.0, 1.0)
+    return numpy.arccos(cosd)*r2d
+
+
+def _pad_stack(matrices):
+    # Stack square matrices zero padding them to the largest shape
+    size = max(max(m.shape) for m in matrices)
+    stack = numpy.zeros((len(matrices), size, size), dtype='f8')
+    for i, m in enumerate(matrices):
+        stack[i, 0:m.shape[0], 0:m.shape[1]] = m
+    return stack
+
+
+def _stacked_poly(coeffs, idx, x, y):
+    """Evaluate sum c[idx,ix,iy] x**ix y**iy with per point coefficients.
+
+    Nested Horner scheme as in wcsutil.Polynomial2D, skipping the terms that
+    are zero for every matrix of the stack.
+    """
+    nonzero = (coeffs != 0.0).any(axis=0)
+    result = numpy.zeros_like(x)
+    row = numpy.empty_like(x)
+    for ix in range(coeffs.shape[1]-1, -1, -1):
+        result *= x
+        w, = numpy.where(nonzero[ix])
+        if w.size == 0:
+            continue
+        row[:] = coeffs[idx, ix, w[-1]]
+        for iy in range(w[-1]-1, -1, -1):
+            row *= y
+            if nonzero[ix, iy]:
+                row += coeffs[idx, ix, iy]
+        result += row
+    return result
+
+
+def _native2sky(rotation, idx, u, v):
+    """Tangent plane u,v in degrees to sky lon,lat with per point rotation.
+
+    Works on unit vectors: the native direction of u,v is
+    (-v, u, r2d)/norm, rotated to the sky by the transposed rotation matrix.
+    """
+    l = -v*d2r
+    m = u*d2r
+    norm = numpy.sqrt(l*l + m*m + 1.0)
+    l /= norm
+    m /= norm
+    n = 1.0/norm
+
+    r = rotation[idx]
+    b0 = r[:, 0, 0]*l + r[:, 0, 1]*m + r[:, 0, 2]*n
+    b1 = r[:, 1, 0]*l + r[:, 1, 1]*m + r[:, 1, 2]*n
+    b2 = r[:, 2, 0]*l + r[:, 2, 1]*m + r[:, 2, 2]*n
+
+    lon = numpy.arctan2(b1, b0)*r2d
+    lat = numpy.arctan2(b2, numpy.sqrt(b0*b0 + b1*b1))*r2d
+    lon %= 360.0
+    return lon, lat
+
+
+def _sky2native(rotation, idx, lon, lat):
+    """Sky lon,lat to tangent plane u,v in degrees with per point rotation.
+
+    Points more than 90 degrees from the tangent point go to 0,0 like
+    wcsutil.WCS.sph2image.
+    """
+    lonr = lon*d2r
+    latr = lat*d2r
+    clat = numpy.cos(latr)
+    l = clat*numpy.cos(lonr)
+    m = clat*numpy.sin(lonr)
+    n = numpy.sin(latr)
+
+    r = rotation[idx]
+    b0 = r[:, 0, 0]*l + r[:, 1, 0]*m + r[:, 2, 0]*n
+    b1 = r[:, 0, 1]*l + r[:, 1, 1]*m + r[:, 2, 1]*n
+    b2 = r[:, 0, 2]*l + r[:, 1, 2]*m + r[:, 2, 2]*n
+
+    u = numpy.zeros_like(b0)
+    v = numpy.zeros_like(b0)
+    w, = numpy.where(b2 > 0.0)
+    if w.size > 0:
+        u[w] = r2d*b1[w]/b2[w]
+        v[w] = -r2d*b0[w]/b2[w]
+    return u, v
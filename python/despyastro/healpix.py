@@ -0,0 +1,494 @@
+"""Equal area hierarchical pixelization of the sphere.
+
+The HEALPix scheme (Gorski et al. 2005, ApJ 622, 759) in its nested
+ordering, in plain numpy.  The sphere is split in 12 base pixels, each
+divided in nside x nside pixels of equal area, nside a power of two.  In
+the nested ordering the 4 pixels of nside 2*nside inside pixel p are
+4p..4p+3, so the pixels inside any coarser pixel form one range of
+numbers, which is what makes range sets a compact description of a
+region.  Pixel numbers are those of the standard scheme on ra,dec, and
+unit vectors are those of coords.eq2xyz.
+
+Range sets are (n, 2) int64 arrays of sorted, disjoint [start, stop)
+ranges of pixel numbers.
+
+Examples:
+    from despyastro import healpix
+    pix = healpix.ang2pix(1024, ra, dec)
+    ra, dec = healpix.pix2ang(1024, pix)
+    nbrs = healpix.neighbors(1024, pix)
+
+    # pixels touching a disc or a CCD, as ranges
+    ranges = healpix.query_disc(1024, ra0, dec0, 0.5)
+    ranges = healpix.query_polygon(1024, ccd_ra, ccd_dec)
+    inside = healpix.ranges_contains(ranges, pix)
+"""
+
+import math
+
+import numpy
+
+from despyastro import coords
+
+r2d = 180.0/math.pi
+d2r = math.pi/180.0
+
+# highest order supported, nside = 2**29, with pixel numbers in int64
+_max_order = 29
+
+# ring and longitude offsets of the base pixels, for pix2ang
+_jrll = numpy.array([2, 2, 2, 2, 3, 3, 3, 3, 4, 4, 4, 4], dtype='i8')
+_jpll = numpy.array([1, 3, 5, 7, 0, 2, 4, 6, 1, 3, 5, 7], dtype='i8')
+
+# Neighbors, in the order SW, W, NW, N, NE, E, SE, S: the offsets in the
+# face coordinates x,y, and, when they leave the face, the base pixel
+# next to each one (-1 when there is none) and the bits of the flips of x,
+# y and their swap, for the direction (x-1, y-1) ... (x+1, y+1) numbered
+# 0..8 as 3*dy + dx + 4
+_xoffset = numpy.array([-1, -1, 0, 1, 1, 1, 0, -1], dtype='i8')
+_yoffset = numpy.array([0, 1, 1, 1, 0, -1, -1, -1], dtype='i8')
+_facearray = numpy.array([[8, 9, 10, 11, -1, -1, -1, -1, 10, 11, 8, 9],
+                          [5, 6, 7, 4, 8, 9, 10, 11, 9, 10, 11, 8],
+                          [-1, -1, -1, -1, 5, 6, 7, 4, -1, -1, -1, -1],
+                          [4, 5, 6, 7, 11, 8, 9, 10, 11, 8, 9, 10],
+                          [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11],
+                          [1, 2, 3, 0, 0, 1, 2, 3, 5, 6, 7, 4],
+                          [-1, -1, -1, -1, 7, 4, 5, 6, -1, -1, -1, -1],
+                          [3, 0, 1, 2, 3, 0, 1, 2, 4, 5, 6, 7],
+                          [2, 3, 0, 1, -1, -1, -1, -1, 0, 1, 2, 3]],
+                         dtype='i8')
+_swaparray = numpy.array([[0, 0, 3],
+                          [0, 0, 6],
+                          [0, 0, 0],
+                          [0, 0, 5],
+                          [0, 0, 0],
+                          [5, 0, 0],
+                          [0, 0, 0],
+                          [6, 0, 0],
+                          [3, 0, 0]], dtype='i8')
+
+
+def nside2order(nside):
+    """The order of nside, log2(nside), checking it is a power of two.
+    """
+    order = int(nside).bit_length() - 1
+    if nside < 1 or (1 << order) != nside or order > _max_order:
+        raise ValueError('nside must be a power of 2 up to 2**%d' %
+                         _max_order)
+    return order
+
+
+def nside2npix(nside):
+    """Number of pixels, 12*nside**2.
+    """
+    nside2order(nside)
+    return 12*nside*nside
+
+
+def nside2area(nside):
+    """Area of the pixels in square degrees.
+    """
+    return 4.0*math.pi*r2d*r2d/nside2npix(nside)
+
+
+def max_pixrad(nside):
+    """Largest distance in degrees from a pixel center to its corners.
+    """
+    nside2order(nside)
+    # between a corner at the pole of the polar cap, and the center of the
+    # pixel next to it, and the equatorial pixel that is most elongated
+    va = _zphi2vec(2.0/3.0, math.pi/(4*nside))
+    t1 = (1.0 - 1.0/nside)**2
+    vb = _zphi2vec(1.0 - t1/3.0, 0.0)
+    return _vec_angle(va, vb)*r2d
+
+
+def ang2pix(nside, ra, dec):
+    """Nested pixel number of each ra,dec in degrees.
+    """
+    nside2order(nside)
+    ra = numpy.asarray(ra, dtype='f8')
+    dec = numpy.asarray(dec, dtype='f8')
+    z = numpy.sin(dec*d2r)
+    cosdec = numpy.cos(dec*d2r)
+    za = numpy.abs(z)
+
+    # longitude in units of 90 degrees, in [0,4)
+    tt = (ra % 360.0)/90.0
+    tt = numpy.where(tt >= 4.0, tt-4.0, tt)
+
+    face = numpy.empty(z.shape, dtype='i8')
+    ix = numpy.empty(z.shape, dtype='i8')
+    iy = numpy.empty(z.shape, dtype='i8')
+
+    # equatorial region
+    eq = za <= 2.0/3.0
+    if eq.any():
+        temp1 = nside*(0.5 + tt[eq])
+        temp2 = nside*z[eq]*0.75
+        jp = (temp1 - temp2).astype('i8')
+        jm = (temp1 + temp2).astype('i8')
+        ifp = jp//nside
+        ifm = jm//nside
+        face[eq] = numpy.where(ifp == ifm, ifp | 4,
+                               numpy.where(ifp < ifm, ifp, ifm+8))
+        ix[eq] = jm & (nside-1)
+        iy[eq] = nside - (jp & (nside-1)) - 1
+
+    # polar caps
+    pol = ~eq
+    if pol.any():
+        ttp = tt[pol]
+        ntt = numpy.minimum(ttp.astype('i8'), 3)
+        tp = ttp - ntt
+        # nside*sqrt(3*(1-|z|)), accurate near the poles
+        tmp = nside*cosdec[pol]*numpy.sqrt(3.0/(1.0 + za[pol]))
+        jp = numpy.minimum((tp*tmp).astype('i8'), nside-1)
+        jm = numpy.minimum(((1.0 - tp)*tmp).astype('i8'), nside-1)
+        north = z[pol] >= 0
+        face[pol] = numpy.where(north, ntt, ntt+8)
+        ix[pol] = numpy.where(north, nside-jm-1, jp)
+        iy[pol] = numpy.where(north, nside-jp-1, jm)
+
+    return _xyf2pix(nside, ix, iy, face)
+
+
+def pix2ang(nside, pix):
+    """ra,dec in degrees of the centers of nested pixels.
+    """
+    ix, iy, face = _pix2xyf(nside, pix)
+    return _xyf2ang(nside, ix, iy, face)
+
+
+def vec2pix(nside, x, y, z):
+    """Nested pixel number of unit vectors, as from coords.eq2xyz.
+    """
+    ra, dec = coords.xyz2eq(x, y, z)
+    return ang2pix(nside, ra, dec)
+
+
+def pix2vec(nside, pix):
+    """Unit vectors, as coords.eq2xyz gives them, of the pixel centers.
+    """
+    ra, dec = pix2ang(nside, pix)
+    return coords.eq2xyz(ra, dec)
+
+
+def neighbors(nside, pix):
+    """The 8 neighbors of each pixel.
+
+    Returns an array of shape (8,) + shape of pix with the neighbors in
+    the order SW, W, NW, N, NE, E, SE, S; -1 where there is none, which
+    happens for one of the directions of the pixels at the corners of the
+    base pixels where only 3 of them meet.
+    """
+    ix, iy, face = _pix2xyf(nside, pix)
+    result = numpy.empty((8,) + ix.shape, dtype='i8')
+    for i in range(8):
+        x = ix + _xoffset[i]
+        y = iy + _yoffset[i]
+
+        # which of the neighboring base pixels it falls in
+        nbnum = numpy.zeros(x.shape, dtype='i8') + 4
+        nbnum[x < 0] -= 1
+        nbnum[x >= nside] += 1
+        nbnum[y < 0] -= 3
+        nbnum[y >= nside] += 3
+        x = x % nside
+        y = y % nside
+
+        f = _facearray[nbnum, face]
+        bits = _swaparray[nbnum, face >> 2]
+        x = numpy.where(bits & 1, nside-x-1, x)
+        y = numpy.where(bits & 2, nside-y-1, y)
+        swap = (bits & 4) != 0
+        x, y = numpy.where(swap, y, x), numpy.where(swap, x, y)
+
+        result[i] = numpy.where(f >= 0,
+                                _xyf2pix(nside, x, y, numpy.maximum(f, 0)),
+                                -1)
+    return result
+
+
+def query_disc(nside, ra, dec, radius, inclusive=True):
+    """The pixels of a disc, as a range set.
+
+    Parameters
+    ----------
+    nside : int
+    ra, dec : scalars
+        Center of the disc in degrees.
+    radius : scalar
+        Radius in degrees.
+    inclusive : bool, optional
+        If True, the default, return all the pixels that overlap the disc,
+        and possibly a few more next to its edge; else only the pixels
+        whose center is in the disc.
+
+    Returns
+    -------
+    ranges : (n, 2) array
+        [start, stop) ranges of nested pixel numbers.
+
+    Notes
+    -----
+    The base pixels are refined down to nside, keeping whole the pixels
+    whose bounding circle is inside the disc, which become single ranges,
+    and dropping those whose bounding circle is outside.  Only the pixels
+    along the edge are refined, so the work grows as the perimeter.
+    """
+    center = numpy.array(coords.eq2xyz(ra, dec)).reshape(3)
+    radius = min(float(radius), 180.0)
+
+    def classify(vec, pixrad):
+        # angle from the center; in (1), out (-1) or on the edge (0)
+        dist = _chord_angle(vec, center[:, numpy.newaxis])*r2d
+        state = numpy.zeros(dist.size, dtype='i8')
+        state[dist + pixrad <= radius] = 1
+        state[dist - pixrad > radius] = -1
+        return state, dist <= radius
+
+    return _query(nside, classify, inclusive)
+
+
+def query_polygon(nside, ra, dec, inclusive=True):
+    """The pixels of a convex polygon, as a range set.
+
+    Parameters
+    ----------
+    nside : int
+    ra, dec : sequences
+        The vertices in degrees, in either direction; the edges are great
+        circles.  For a CCD, the corners from CCD_corners.DESDM_corners.
+    inclusive : bool, optional
+        As for query_disc.
+
+    Returns
+    -------
+    ranges : (n, 2) array
+        [start, stop) ranges of nested pixel numbers.
+    """
+    verts = numpy.array(coords.eq2xyz(ra, dec))
+    nvert = verts.shape[1]
+    if nvert < 3:
+        raise ValueError('a polygon needs at least 3 vertices')
+
+    # inward normals of the edges
+    normals = numpy.cross(verts.T, numpy.roll(verts, -1, axis=1).T)
+    normals /= numpy.sqrt((normals**2).sum(axis=1))[:, numpy.newaxis]
+    side = numpy.dot(normals, verts)
+    tol = 1.0e-10
+    if (side <= tol).all():
+        normals = -normals
+        side = -side
+    if (side < -tol).any():
+        raise ValueError('the polygon must be convex')
+
+    def classify(vec, pixrad):
+        # angular distance of each point inside each edge
+        cosd = numpy.dot(normals, vec)
+        dist = numpy.arcsin(numpy.clip(cosd, -1.0, 1.0))*r2d
+        state = numpy.zeros(vec.shape[1], dtype='i8')
+        state[(dist >= pixrad).all(axis=0)] = 1
+        state[(dist < -pixrad).any(axis=0)] = -1
+        return state, (dist >= 0).all(axis=0)
+
+    return _query(nside, classify, inclusive)
+
+
+def pixels_to_ranges(pix):
+    """The range set of a collection of pixel numbers.
+    """
+    pix = numpy.unique(numpy.asarray(pix, dtype='i8'))
+    if pix.size == 0:
+        return numpy.zeros((0, 2), dtype='i8')
+    breaks, = numpy.where(numpy.diff(pix) != 1)
+    start = numpy.append(pix[0], pix[breaks+1])
+    stop = numpy.append(pix[breaks]+1, pix[-1]+1)
+    return numpy.array([start, stop]).T.copy()
+
+
+def ranges_to_pixels(ranges):
+    """All the pixel numbers of a range set.
+    """
+    ranges = numpy.asarray(ranges, dtype='i8').reshape(-1, 2)
+    counts = ranges[:, 1] - ranges[:, 0]
+    first = numpy.cumsum(counts) - counts
+    group = numpy.repeat(numpy.arange(counts.size), counts)
+    return ranges[group, 0] + numpy.arange(group.size) - first[group]
+
+
+def ranges_union(*range_sets):
+    """The union of range sets, or the normal form of any list of ranges,
+    sorted and with the overlapping or touching ranges merged.
+    """
+    ranges = numpy.concatenate([numpy.asarray(r, dtype='i8').reshape(-1, 2)
+                                for r in range_sets] +
+                               [numpy.zeros((0, 2), dtype='i8')])
+    ranges = ranges[ranges[:, 1] > ranges[:, 0]]
+    if ranges.shape[0] == 0:
+        return ranges
+    ranges = ranges[numpy.argsort(ranges[:, 0], kind='mergesort')]
+
+    # a range starts a new group when it begins after all before it end
+    end = numpy.maximum.accumulate(ranges[:, 1])
+    new = numpy.ones(ranges.shape[0], dtype=bool)
+    new[1:] = ranges[1:, 0] > end[:-1]
+    first, = numpy.where(new)
+    last = numpy.append(first[1:], ranges.shape[0]) - 1
+    return numpy.array([ranges[first, 0], end[last]]).T.copy()
+
+
+def ranges_intersection(a, b):
+    """The intersection of two range sets.
+    """
+    a = ranges_union(a)
+    b = ranges_union(b)
+    if a.shape[0] == 0 or b.shape[0] == 0:
+        return numpy.zeros((0, 2), dtype='i8')
+
+    # the ranges of b overlapping each range of a
+    first = numpy.searchsorted(b[:, 1], a[:, 0], side='right')
+    last = numpy.searchsorted(b[:, 0], a[:, 1], side='left')
+    counts = numpy.maximum(last - first, 0)
+    ia = numpy.repeat(numpy.arange(a.shape[0]), counts)
+    ib = numpy.repeat(first, counts) + (numpy.arange(ia.size) -
+                                        numpy.repeat(numpy.cumsum(counts) -
+                                                     counts, counts))
+    start = numpy.maximum(a[ia, 0], b[ib, 0])
+    stop = numpy.minimum(a[ia, 1], b[ib, 1])
+    keep = stop > start
+    return numpy.array([start[keep], stop[keep]]).T.copy()
+
+
+def ranges_contains(ranges, pix):
+    """True for each pixel that is in the range set.
+    """
+    ranges = ranges_union(ranges)
+    pix = numpy.asarray(pix, dtype='i8')
+    i = numpy.searchsorted(ranges[:, 0], pix, side='right') - 1
+    inside = i >= 0
+    i = numpy.maximum(i, 0)
+    if ranges.shape[0] == 0:
+        return numpy.zeros(pix.shape, dtype=bool)
+    return inside & (pix < ranges[i, 1])
+
+
+def ranges_degrade(ranges, nside_in, nside_out):
+    """The range set at a coarser nside of the pixels touched by ranges.
+    """
+    shift = 2*(nside2order(nside_in) - nside2order(nside_out))
+    if shift < 0:
+        raise ValueError('nside_out must not be above nside_in')
+    ranges = ranges_union(ranges)
+    start = ranges[:, 0] >> shift
+    stop = ((ranges[:, 1] - 1) >> shift) + 1
+    return ranges_union(numpy.array([start, stop]).T)
+
+
+def _query(nside, classify, inclusive):
+    # Refine the base pixels down to nside, classifying each with
+    # classify(vectors, pixrad) as inside, outside or on the edge
+    order = nside2order(nside)
+    ranges = []
+    pix = numpy.arange(12, dtype='i8')
+    for level in range(order+1):
+        lnside = 1 << level
+        # a little margin for the rounding in the distances
+        pixrad = max_pixrad(lnside)*(1.0 + 1.0e-9) + 1.0e-9
+        vec = numpy.array(pix2vec(lnside, pix))
+        state, center_in = classify(vec, pixrad)
+
+        shift = 2*(order - level)
+        full = pix[state == 1]
+        ranges.append(numpy.array([full << shift, (full+1) << shift]).T)
+
+        edge = pix[state == 0]
+        if level == order:
+            if not inclusive:
+                edge = pix[(state == 0) & center_in]
+            ranges.append(numpy.array([edge, edge+1]).T)
+        else:
+            pix = (4*edge[:, numpy.newaxis] +
+                   numpy.arange(4, dtype='i8')).ravel()
+
+    return ranges_union(*ranges)
+
+
+def _pix2xyf(nside, pix):
+    order = nside2order(nside)
+    pix = numpy.asarray(pix, dtype='i8')
+    npface = nside*nside
+    if pix.size > 0 and (pix.min() < 0 or pix.max() >= 12*npface):
+        raise ValueError('pixel numbers must be in [0, 12*nside**2)')
+    face = pix >> (2*order)
+    ipf = pix & (npface-1)
+    return _compact_bits(ipf), _compact_bits(ipf >> 1), face
+
+
+def _xyf2pix(nside, ix, iy, face):
+    return (numpy.asarray(face, dtype='i8')*(nside*nside) +
+            _spread_bits(ix) + (_spread_bits(iy) << 1))
+
+
+def _xyf2ang(nside, ix, iy, face):
+    # ra,dec of the centers of the pixels ix,iy of base pixels face
+    jr = _jrll[face]*nside - ix - iy - 1
+    nl4 = 4*nside
+    fact = 1.0/(3.0*nside*nside)
+
+    north = jr < nside
+    south = jr > 3*nside
+    nr = numpy.where(north, jr, numpy.where(south, nl4-jr, nside))
+    kshift = numpy.where(north | south, 0, (jr - nside) & 1)
+
+    # z and 1-|z|, the latter exact in the caps
+    z = numpy.where(north, 1.0 - nr*nr*fact,
+                    numpy.where(south, nr*nr*fact - 1.0,
+                                (2*nside - jr)*(2.0/(3*nside))))
+    one_minus = numpy.where(north | south, nr*nr*fact, 1.0 - numpy.abs(z))
+    cosdec = numpy.sqrt(one_minus*(2.0 - one_minus))
+    dec = numpy.arctan2(z, cosdec)*r2d
+
+    jp = (_jpll[face]*nr + ix - iy + 1 + kshift)//2
+    jp = numpy.where(jp > nl4, jp-nl4, jp)
+    jp = numpy.where(jp < 1, jp+nl4, jp)
+    ra = (jp - (kshift+1)*0.5)*(90.0/nr)
+    return ra, dec
+
+
+def _spread_bits(v):
+    # put the bits of v at the even positions
+    v = numpy.asarray(v, dtype='i8') & 0xFFFFFFFF
+    v = (v | (v << 16)) & 0x0000FFFF0000FFFF
+    v = (v | (v << 8)) & 0x00FF00FF00FF00FF
+    v = (v | (v << 4)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v << 2)) & 0x3333333333333333
+    v = (v | (v << 1)) & 0x5555555555555555
+    return v
+
+
+def _compact_bits(v):
+    # the bits of v at the even positions, the inverse of _spread_bits
+    v = numpy.asarray(v, dtype='i8') & 0x5555555555555555
+    v = (v | (v >> 1)) & 0x3333333333333333
+    v = (v | (v >> 2)) & 0x0F0F0F0F0F0F0F0F
+    v = (v | (v >> 4)) & 0x00FF00FF00FF00FF
+    v = (v | (v >> 8)) & 0x0000FFFF0000FFFF
+    v = (v | (v >> 16)) & 0x00000000FFFFFFFF
+    return v
+
+
+def _zphi2vec(z, phi):
+    s = math.sqrt((1.0-z)*(1.0+z))
+    return numpy.array([s*math.cos(phi), s*math.sin(phi), z])
+
+
+def _vec_angle(a, b):
+    return math.atan2(numpy.linalg.norm(numpy.cross(a, b)), numpy.dot(a, b))
+
+
+def _chord_angle(a, b):
+    # angle in radians between unit vectors from their chord
+    chord = numpy.sqrt(((a - b)**2).sum(axis=0))
+    return 2.0*numpy.arcsin(numpy.minimum(0.5*chord, 1.0))
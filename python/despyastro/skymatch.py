@@ -0,0 +1,633 @@
+"""Spherical cross-matching of catalogs.
+
+SkyIndex sorts a catalog into a grid of cells on the sky, as MosaicLookup
+does for CCDs: bands of equal width in declination, split in RA so cells
+stay roughly square.  Only the occupied cells are stored, as a sorted list
+of cell numbers with CSR offsets into the catalog sorted by cell, along
+with the unit vectors of coords.eq2xyz.  A query visits the cells that
+overlap the disc around each point and measures the chord distance to the
+objects in them, so the work and memory depend on the number of
+candidates, not on the size of the catalogs.
+
+Queries are done in chunks of points, and each chunk split further so that
+it never holds more than max_pairs candidate pairs, which bounds the
+memory of matching catalogs of any size.  With nproc > 1 the chunks are
+spread over a process pool; the index and the points are put in shared
+memory once rather than pickled to every worker, and the results are
+gathered in chunk order, so they are identical to those of a single
+process.
+
+Examples:
+    from despyastro import skymatch
+    i1, i2, d12 = skymatch.match(ra1, dec1, ra2, dec2, 1.0/3600)
+
+    # reuse the index of the reference catalog
+    index = skymatch.SkyIndex(ra2, dec2)
+    i1, i2, d12 = index.match(ra1, dec1, 1.0/3600, maxmatch=0)
+
+    # on 16 processes
+    i1, i2, d12 = skymatch.match(ra1, dec1, ra2, dec2, 1.0/3600, nproc=16)
+
+    # all neighbors as CSR arrays, or streamed to a file chunk by chunk
+    offsets, indices, distances = index.neighbors(ra1, dec1, 0.1)
+    index.neighbors(ra1, dec1, 0.1, filename='pairs.npy')
+    for i0, offsets, indices, distances in skymatch.iter_neighbors(
+            'pairs.npy'):
+        ...
+"""
+
+import math
+import sys
+
+import numpy
+
+from despyastro import coords
+
+r2d = 180.0/math.pi
+d2r = math.pi/180.0
+
+# points per query chunk, and most candidate pairs held at once
+_default_chunksize = 1000000
+_default_max_pairs = 20000000
+
+# the arrays that make up a SkyIndex
+_index_arrays = ['index', 'cells', 'cell_offsets', 'xyz']
+
+# shared memory blocks attached in this process, by name
+_attached = {}
+
+
+class SkyIndex(object):
+    """An index of a catalog of ra,dec positions for spatial queries.
+
+    Usage:
+        index = SkyIndex(ra, dec, cellsize=None)
+        i1, i2, d12 = index.match(ra1, dec1, radius, maxmatch=1)
+
+    ra, dec are in degrees.  cellsize is the approximate size of the cells
+    in degrees; by default it is chosen so the occupied cells hold about
+    four objects each, between 1 arcsec and 1 degree.  Queries with a
+    radius much larger than the cells visit many cells, which is fine, but
+    cells much larger than the radius mean many candidates per point.
+    """
+
+    def __init__(self, ra, dec, cellsize=None):
+        ra = numpy.atleast_1d(numpy.asarray(ra, dtype='f8'))
+        dec = numpy.atleast_1d(numpy.asarray(dec, dtype='f8'))
+        if ra.shape != dec.shape or ra.ndim != 1:
+            raise ValueError('ra and dec must be 1-d arrays of the same size')
+
+        if cellsize is None:
+            cellsize = _default_cellsize(ra, dec)
+        self.cellsize = float(cellsize)
+        self._build_grid(self.cellsize)
+
+        cell = self.cell(ra, dec)
+        s = numpy.argsort(cell, kind='mergesort')
+        cell = cell[s]
+
+        # the position in the input of each entry sorted by cell
+        self.index = s
+
+        # occupied cells and CSR offsets of their objects
+        if cell.size > 0:
+            first = numpy.ones(cell.size, dtype=bool)
+            first[1:] = cell[1:] != cell[:-1]
+            start, = numpy.where(first)
+        else:
+            start = numpy.zeros(0, dtype='i8')
+        self.cells = cell[start]
+        self.cell_offsets = numpy.append(start, cell.size).astype('i8')
+
+        x, y, z = coords.eq2xyz(ra[s], dec[s])
+        self.xyz = numpy.array([x, y, z])
+
+    def __repr__(self):
+        return 'SkyIndex(%d objects in %d cells of %.3g deg)' % (
+            len(self), self.cells.size, self.cellsize)
+
+    def __len__(self):
+        return self.index.size
+
+    def _build_grid(self, cellsize):
+        # Bands of declination, each split in nra cells of RA
+        self.nband = max(1, int(math.ceil(180.0/cellsize)))
+        self.bandsize = 180.0/self.nband
+        edges = numpy.arange(self.nband+1)*self.bandsize - 90.0
+        cosmin = numpy.minimum(numpy.cos(edges[:-1]*d2r),
+                               numpy.cos(edges[1:]*d2r))
+        self.nra = numpy.maximum(1, (360.0*cosmin/cellsize).astype('i8'))
+        self.band_offset = numpy.zeros(self.nband+1, dtype='i8')
+        self.band_offset[1:] = numpy.cumsum(self.nra)
+
+    def _band(self, dec):
+        j = numpy.floor((numpy.asarray(dec) + 90.0)/self.bandsize)
+        return numpy.clip(j, 0, self.nband-1).astype('i8')
+
+    def cell(self, ra, dec):
+        """Cell number of each ra,dec.
+        """
+        j = self._band(dec)
+        nra = self.nra[j]
+        k = numpy.floor((numpy.asarray(ra) % 360.0)/360.0*nra).astype('i8')
+        k = numpy.clip(k, 0, nra-1)
+        return self.band_offset[j] + k
+
+    @classmethod
+    def _from_arrays(cls, arrays, cellsize):
+        # A SkyIndex on existing arrays, e.g. in shared memory
+        self = cls.__new__(cls)
+        self.cellsize = cellsize
+        self._build_grid(cellsize)
+        for name in _index_arrays:
+            setattr(self, name, arrays[name])
+        return self
+
+    def match(self, ra, dec, radius, maxmatch=1, chunksize=None,
+              max_pairs=None, nproc=None):
+        """Match points to the indexed catalog.
+
+        Parameters
+        ----------
+        ra, dec : scalars or arrays
+            The points, in degrees.
+        radius : scalar or array
+            Match radius in degrees, for all points or for each.
+        maxmatch : int, optional
+            Keep at most this many matches per point, the closest.  0 keeps
+            them all.  Default 1.
+        chunksize : int, optional
+            Points per query chunk.  Default 1000000.
+        max_pairs : int, optional
+            Most candidate pairs held at once; chunks are split to stay
+            below it.  Default 20000000, about 1 GB of scratch space (per
+            process).
+        nproc : int, optional
+            Number of processes.  When above 1 the chunks, by default
+            about four per process and at most chunksize points, are run
+            on a multiprocessing pool.
+
+        Returns
+        -------
+        i1, i2, d12 : arrays
+            For each match the index of the point, the index in the
+            catalog and their separation in degrees.  Sorted by i1, then
+            separation, then i2, so the output does not depend on the
+            chunking.
+        """
+        results = [r[2:] for r in self._iter_matches(ra, dec, radius, maxmatch,
+                                                     chunksize, max_pairs,
+                                                     nproc)]
+        results = [r for r in results if r[0].size > 0]
+        if len(results) == 0:
+            return (numpy.zeros(0, dtype='i8'), numpy.zeros(0, dtype='i8'),
+                    numpy.zeros(0, dtype='f8'))
+        return tuple(numpy.concatenate(r) for r in zip(*results))
+
+    def neighbors(self, ra, dec, radius, chunksize=None, max_pairs=None,
+                  nproc=None, dtype='f8', filename=None):
+        """All the neighbors within radius of each point, as CSR arrays.
+
+        Parameters are as for match, with all matches kept, and
+
+        dtype : optional
+            Data type of the distances.  Default 'f8'.
+        filename : str, optional
+            Rather than returning the arrays, write them to this file one
+            chunk of points at a time, so the whole result never has to
+            fit in memory.  Read it back with iter_neighbors or
+            read_neighbors.
+
+        Returns
+        -------
+        offsets, indices, distances : arrays
+            The neighbors of point i are indices[offsets[i]:offsets[i+1]],
+            at distances[offsets[i]:offsets[i+1]] degrees, closest first.
+            offsets has one more entry than there are points.  The indices
+            are int32 when the catalog is small enough.  With filename,
+            the number of pairs written is returned instead.
+        """
+        itype = 'i4' if len(self) < 2**31 else 'i8'
+        if filename is not None:
+            fobj = open(filename, 'wb')
+        else:
+            chunks = []
+
+        npairs = 0
+        try:
+            for i0, i1, m1, m2, d12 in self._iter_matches(ra, dec, radius, 0,
+                                                          chunksize, max_pairs,
+                                                          nproc):
+                offsets = numpy.zeros(i1-i0+1, dtype='i8')
+                numpy.cumsum(numpy.bincount(m1-i0, minlength=i1-i0),
+                             out=offsets[1:])
+                indices = m2.astype(itype)
+                distances = d12.astype(dtype)
+                if filename is not None:
+                    _write_neighbors(fobj, i0, i1, offsets, indices, distances)
+                else:
+                    chunks.append((offsets, indices, distances))
+                npairs += m1.size
+        finally:
+            if filename is not None:
+                fobj.close()
+
+        if filename is not None:
+            return npairs
+        return _join_csr(chunks, itype, dtype)
+
+    def _iter_matches(self, ra, dec, radius, maxmatch, chunksize, max_pairs,
+                      nproc):
+        # Yield i0, i1 and the matches m1, m2, d12 of each chunk of points
+        # i0:i1, in order
+        if chunksize is None:
+            chunksize = _default_chunksize
+        ra = numpy.atleast_1d(numpy.asarray(ra, dtype='f8'))
+        dec = numpy.atleast_1d(numpy.asarray(dec, dtype='f8'))
+        if ra.shape != dec.shape or ra.ndim != 1:
+            raise ValueError('ra and dec must be 1-d arrays of the same size')
+        radius = numpy.asarray(radius, dtype='f8')
+        if radius.ndim > 0 and radius.shape != ra.shape:
+            raise ValueError('radius must be a scalar or of the size of ra')
+
+        if nproc is not None and nproc > 1:
+            for result in self._iter_parallel(ra, dec, radius, maxmatch,
+                                              chunksize, max_pairs, nproc):
+                yield result
+            return
+
+        for i0 in range(0, ra.size, chunksize):
+            i1 = min(i0+chunksize, ra.size)
+            rad = radius if radius.ndim == 0 else radius[i0:i1]
+            results = list(self._match_chunk(ra[i0:i1], dec[i0:i1], rad,
+                                             maxmatch, max_pairs))
+            m1, m2, d12 = _join_matches(results)
+            yield i0, i1, m1+i0, m2, d12
+
+    def _iter_parallel(self, ra, dec, radius, maxmatch, chunksize, max_pairs,
+                       nproc):
+        import multiprocessing
+
+        nchunk = max(4*nproc, (ra.size+chunksize-1)//chunksize)
+        size = max(1, (ra.size+nchunk-1)//nchunk)
+        bounds = list(range(0, ra.size, size)) + [ra.size]
+
+        points = {'ra': ra, 'dec': dec}
+        if radius.ndim > 0:
+            points['radius'] = radius
+        shared_index = _SharedArrays(dict((name, getattr(self, name))
+                                          for name in _index_arrays))
+        try:
+            shared_points = _SharedArrays(points)
+            try:
+                tasks = [(shared_index, self.cellsize, shared_points,
+                          float(radius) if radius.ndim == 0 else None,
+                          i0, i1, maxmatch, max_pairs)
+                         for i0, i1 in zip(bounds[:-1], bounds[1:])]
+                pool = multiprocessing.Pool(nproc)
+                try:
+                    # imap keeps the order of the chunks
+                    for task, result in zip(tasks,
+                                            pool.imap(_match_task, tasks)):
+                        yield (task[4], task[5]) + result
+                finally:
+                    pool.terminate()
+                    pool.join()
+            finally:
+                shared_points.unlink()
+        finally:
+            shared_index.unlink()
+
+    def _match_chunk(self, ra, dec, radius, maxmatch, max_pairs):
+        # Yield the matches of the points in blocks of at most max_pairs
+        # candidates, in order of point
+        if max_pairs is None:
+            max_pairs = _default_max_pairs
+        radius = numpy.zeros(ra.size, dtype='f8') + radius
+
+        pt, start, count = self._cell_ranges(ra, dec, radius)
+        ncand = numpy.bincount(pt, weights=count, minlength=ra.size)
+        bounds = _split_points(ncand, max_pairs)
+
+        # the cell ranges are sorted by point
+        cstart = numpy.searchsorted(pt, bounds)
+        for b in range(len(bounds)-1):
+            p0, p1 = bounds[b], bounds[b+1]
+            c0, c1 = cstart[b], cstart[b+1]
+            m1, m2, d12 = self._candidates(ra[p0:p1], dec[p0:p1],
+                                           radius[p0:p1], pt[c0:c1]-p0,
+                                           start[c0:c1], count[c0:c1])
+            m1, m2, d12 = _sort_matches(m1, m2, d12, maxmatch)
+            yield m1+p0, m2, d12
+
+    def _cell_ranges(self, ra, dec, radius):
+        """The occupied cells overlapping the disc of each point.
+
+        Returns pt, start, count: for each (point, cell) pair the point
+        and the range of sorted catalog entries of the cell, ordered by
+        point.
+        """
+        # bands touched by the disc
+        jmin = self._band(dec-radius)
+        jmax = self._band(dec+radius)
+        pt, jofs = _ragged(jmax-jmin+1)
+        j = jmin[pt] + jofs
+
+        # half width in RA of the disc, all of the band near the poles
+        decp = dec[pt]
+        radp = radius[pt]
+        polar = numpy.abs(decp) + radp >= 90.0
+        sinr = numpy.sin(numpy.minimum(radp, 90.0)*d2r)
+        cosd = numpy.cos(numpy.where(polar, 0.0, decp)*d2r)
+        dra = numpy.arcsin(numpy.clip(sinr/cosd, 0.0, 1.0))*r2d
+        dra[polar] = 180.0
+
+        nra = self.nra[j]
+        rap = ra[pt] % 360.0
+        kmin = numpy.floor((rap-dra)/360.0*nra).astype('i8')
+        kmax = numpy.floor((rap+dra)/360.0*nra).astype('i8')
+        nk = numpy.minimum(kmax-kmin+1, nra)
+
+        band_pair, kofs = _ragged(nk)
+        pt = pt[band_pair]
+        j = j[band_pair]
+        k = (kmin[band_pair] + kofs) % nra[band_pair]
+        cell = self.band_offset[j] + k
+
+        # keep the occupied ones
+        pos = numpy.searchsorted(self.cells, cell)
+        pos = numpy.minimum(pos, self.cells.size-1)
+        if self.cells.size > 0:
+            w, = numpy.where(self.cells[pos] == cell)
+        else:
+            w = numpy.zeros(0, dtype='i8')
+        pt = pt[w]
+        pos = pos[w]
+        start = self.cell_offsets[pos]
+        count = self.cell_offsets[pos+1] - start
+        return pt, start, count
+
+    def _candidates(self, ra, dec, radius, pt, start, count):
+        # Test the candidates of the cell ranges and return the matches
+        cell_pair, ofs = _ragged(count)
+        pt = pt[cell_pair]
+        entry = start[cell_pair] + ofs
+
+        x, y, z = coords.eq2xyz(ra, dec)
+        dx = self.xyz[0, entry] - x[pt]
+        dy = self.xyz[1, entry] - y[pt]
+        dz = self.xyz[2, entry] - z[pt]
+        chord2 = dx*dx + dy*dy + dz*dz
+
+        # chord length of the radius
+        maxchord = 2.0*numpy.sin(0.5*numpy.minimum(radius, 180.0)*d2r)
+        w, = numpy.where(chord2 <= (maxchord*maxchord)[pt])
+
+        d12 = 2.0*numpy.arcsin(numpy.minimum(0.5*numpy.sqrt(chord2[w]), 1.0))
+        d12 *= r2d
+        return pt[w], self.index[entry[w]], d12
+
+
+def match(ra1, dec1, ra2, dec2, radius, maxmatch=1, cellsize=None,
+          chunksize=None, max_pairs=None, nproc=None):
+    """Match two catalogs on the sky.
+
+    Indexes ra2, dec2 with a SkyIndex and queries it with ra1, dec1 in
+    chunks, see SkyIndex.match.  Index the larger catalog when they differ
+    much in size only if it is reused, as the queries are the part that is
+    chunked.
+
+    Returns
+    -------
+    i1, i2, d12 : arrays
+        Indices into catalogs 1 and 2 of each pair closer than radius
+        degrees, and their separation in degrees; at most maxmatch pairs,
+        the closest, for each entry of catalog 1, or all with maxmatch=0.
+    """
+    index = SkyIndex(ra2, dec2, cellsize=cellsize)
+    return index.match(ra1, dec1, radius, maxmatch=maxmatch,
+                       chunksize=chunksize, max_pairs=max_pairs, nproc=nproc)
+
+
+def _match_task(args):
+    # Match one chunk of points in a pool worker
+    (shared_index, cellsize, shared_points, radius, i0, i1, maxmatch,
+     max_pairs) = args
+    index = SkyIndex._from_arrays(shared_index.arrays, cellsize)
+    points = shared_points.arrays
+    if radius is None:
+        radius = points['radius'][i0:i1]
+    results = list(index._match_chunk(points['ra'][i0:i1],
+                                      points['dec'][i0:i1],
+                                      radius, maxmatch, max_pairs))
+    m1, m2, d12 = _join_matches(results)
+    return m1+i0, m2, d12
+
+
+def _join_matches(results):
+    # Concatenate the (i1, i2, d12) of blocks of matches
+    if len(results) == 0:
+        return (numpy.zeros(0, dtype='i8'), numpy.zeros(0, dtype='i8'),
+                numpy.zeros(0, dtype='f8'))
+    return tuple(numpy.concatenate(r) for r in zip(*results))
+
+
+def _join_csr(chunks, itype='i8', dtype='f8'):
+    # Concatenate the (offsets, indices, distances) of consecutive chunks
+    # of points
+    offsets = [numpy.zeros(1, dtype='i8')]
+    last = 0
+    for o, i, d in chunks:
+        offsets.append(o[1:] + last)
+        last += o[-1]
+    return (numpy.concatenate(offsets),
+            numpy.concatenate([numpy.zeros(0, dtype=itype)] +
+                              [c[1] for c in chunks]),
+            numpy.concatenate([numpy.zeros(0, dtype=dtype)] +
+                              [c[2] for c in chunks]))
+
+
+def _write_neighbors(fobj, i0, i1, offsets, indices, distances):
+    # One chunk of a neighbors file: the range of points, then the CSR
+    # arrays of the chunk, each in .npy format
+    numpy.save(fobj, numpy.array([i0, i1], dtype='i8'))
+    numpy.save(fobj, offsets)
+    numpy.save(fobj, indices)
+    numpy.save(fobj, distances)
+
+
+def iter_neighbors(filename):
+    """Iterate over the chunks of a file written by SkyIndex.neighbors.
+
+    Yields i0, offsets, indices, distances for each chunk, which covers
+    the points i0 to i0+len(offsets)-1 with offsets relative to the chunk.
+    Only one chunk is in memory at a time.
+    """
+    with open(filename, 'rb') as fobj:
+        while True:
+            try:
+                irange = numpy.load(fobj)
+            except EOFError:
+                return
+            offsets = numpy.load(fobj)
+            indices = numpy.load(fobj)
+            distances = numpy.load(fobj)
+            yield int(irange[0]), offsets, indices, distances
+
+
+def read_neighbors(filename):
+    """Read a file written by SkyIndex.neighbors into offsets, indices,
+    distances arrays, as SkyIndex.neighbors returns them.
+    """
+    chunks = [c[1:] for c in iter_neighbors(filename)]
+    itype = chunks[0][1].dtype if chunks else 'i8'
+    dtype = chunks[0][2].dtype if chunks else 'f8'
+    return _join_csr(chunks, itype, dtype)
+
+
+class _SharedArrays(object):
+    # Named numpy arrays in one block of shared memory.  Pickles as the
+    # name of the block and the layout; unpickling attaches to it, once
+    # per process
+
+    def __init__(self, arrays=None, _attach=None):
+        from multiprocessing import shared_memory
+
+        if _attach is not None:
+            name, self.layout = _attach
+            self.shm = _attach_shared_memory(name)
+        else:
+            self.layout = []
+            offset = 0
+            for key, arr in arrays.items():
+                arr = numpy.ascontiguousarray(arr)
+                self.layout.append((key, arr.dtype.str, arr.shape, offset))
+                # keep 8 byte alignment
+                offset += (arr.nbytes + 7)//8*8
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=max(offset, 8))
+
+        self.arrays = {}
+        for key, dtype, shape, offset in self.layout:
+            self.arrays[key] = numpy.ndarray(shape, dtype=dtype,
+                                             buffer=self.shm.buf,
+                                             offset=offset)
+        if _attach is None:
+            for key, arr in arrays.items():
+                self.arrays[key][...] = arr
+
+    def __reduce__(self):
+        return (_attach_arrays, (self.shm.name, self.layout))
+
+    def unlink(self):
+        self.arrays = None
+        self.shm.close()
+        self.shm.unlink()
+
+
+def _attach_arrays(name, layout):
+    if name not in _attached:
+        _attached[name] = _SharedArrays(_attach=(name, layout))
+    return _attached[name]
+
+
+def _attach_shared_memory(name):
+    # Attach without registering with the resource tracker, see
+    # wcsutil.SharedWCSList
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+def _default_cellsize(ra, dec, nper=4.0):
+    # Cell size giving about nper objects per cell over the area actually
+    # covered, measured in one degree cells
+    if ra.size == 0:
+        return 1.0
+    grid = SkyIndex.__new__(SkyIndex)
+    grid._build_grid(1.0)
+    ncell = numpy.unique(grid.cell(ra, dec)).size
+    density = ra.size/float(ncell)
+    return min(1.0, max(1.0/3600, math.sqrt(nper/density)))
+
+
+def _ragged(counts):
+    # For groups of the given sizes, the group and position within the
+    # group of each element of the concatenation
+    counts = numpy.asarray(counts, dtype='i8')
+    group = numpy.repeat(numpy.arange(counts.size), counts)
+    first = numpy.cumsum(counts) - counts
+    return group, numpy.arange(group.size) - first[group]
+
+
+def _split_points(ncand, max_pairs):
+    # Boundaries of runs of points with at most max_pairs candidates in
+    # total, each run holding at least one point
+    bounds = [0]
+    total = numpy.cumsum(ncand)
+    while bounds[-1] < ncand.size:
+        p0 = bounds[-1]
+        base = total[p0-1] if p0 > 0 else 0.0
+        p1 = int(numpy.searchsorted(total, base + max_pairs, side='right'))
+        bounds.append(max(p1, p0+1))
+    return numpy.array(bounds, dtype='i8')
+
+
+def _sort_matches(m1, m2, d12, maxmatch):
+    # Order the matches by point, separation and catalog index, and keep
+    # the first maxmatch of each point
+    s = numpy.lexsort((m2, d12, m1))
+    m1, m2, d12 = m1[s], m2[s], d12[s]
+    if maxmatch is not None and maxmatch > 0 and m1.size > 0:
+        first = numpy.ones(m1.size, dtype=bool)
+        first[1:] = m1[1:] != m1[:-1]
+        start = numpy.maximum.accumulate(numpy.where(first,
+                                                     numpy.arange(m1.size), 0))
+        w, = numpy.where(numpy.arange(m1.size) - start < maxmatch)
+        m1, m2, d12 = m1[w], m2[w], d12[w]
+    return m1, m2, d12
+
+
+def bench_match(n1=2000000, n2=1000000, radius=1.0/3600, area=100.0,
+                seed=None, nproc=None):
+    """Time matching random catalogs in a patch of about area sq. degrees.
+
+    Catalog 2 is catalog 1 jittered by about radius/3 for its first n2
+    objects, so most of those should match.  With nproc, also times the
+    match on 2, 4, ... up to nproc processes.
+    """
+    import time
+
+    rng = numpy.random.RandomState(seed)
+    side = math.sqrt(area)
+    ra1 = rng.uniform(0.0, side, n1)
+    dec1 = rng.uniform(-side/2, side/2, n1)
+    n = min(n1, n2)
+    ra2 = numpy.concatenate([ra1[:n], rng.uniform(0.0, side, n2-n)])
+    dec2 = numpy.concatenate([dec1[:n], rng.uniform(-side/2, side/2, n2-n)])
+    ra2 += rng.normal(scale=radius/3, size=n2)
+    dec2 += rng.normal(scale=radius/3, size=n2)
+
+    t0 = time.time()
+    index = SkyIndex(ra2, dec2)
+    tindex = time.time()-t0
+    t0 = time.time()
+    i1, i2, d12 = index.match(ra1, dec1, radius)
+    tmatch = time.time()-t0
+
+    sys.stdout.write('%s\n' % index)
+    sys.stdout.write('index: %.2f s  match %d x %d: %.2f s, %d matches\n' %
+                     (tindex, n1, n2, tmatch, i1.size))
+
+    times = [tmatch]
+    np = 2
+    while nproc is not None and np <= nproc:
+        t0 = time.time()
+        index.match(ra1, dec1, radius, nproc=np)
+        times.append(time.time()-t0)
+        sys.stdout.write('%2d processes: %.2f s, speedup %.2f\n' %
+                         (np, times[-1], tmatch/times[-1]))
+        np *= 2
+    return tindex, times
@@ -65,9 +65,14 @@ try:
 except:
     have_numpy = False
 
+import collections
+import hashlib
+import itertools
 import math
 import os
+import re
 import sys
+import threading
 
 r2d = 180.0/math.pi
 d2r = math.pi/180.0
@@ -131,6 +136,15 @@ for key in smkeys:
     newkey = key.replace('pv', 'pvi')
     _scamp_map[newkey] = _scamp_map[key]
 
+# The header keywords that define a WCS.  Everything else in a header is
+# ignored when caching WCS objects.
+_wcs_keys = ['ctype1', 'ctype2', 'cunit1', 'cunit2',
+             'crpix1', 'crpix2', 'crval1', 'crval2',
+             'cd1_1', 'cd1_2', 'cd2_1', 'cd2_2',
+             'naxis1', 'naxis2', 'znaxis1', 'znaxis2',
+             'longpole', 'latpole', 'theta0']
+_distort_key_re = re.compile(r'^(pvi?[12]_\d+|(a|b|ap|bp)_(order|\d+_\d+))$')
+
 
 class WCS(object):
     """A class to do WCS transformations.
@@ -165,6 +179,15 @@ class WCS(object):
 
     The solve is done using scipy.optimize.fsolve
 
+    Send minimal=True to only read the WCS keywords from the header, which
+    is much faster for full headers; self.wcs then only holds those.  To
+    build many WCS objects at once see build_wcs_list.
+
+    Send inverse_tol (pixels) to fit the missing inverse polynomial to that
+    accuracy with FitInverse, instead of with a fixed grid and order; and
+    use find='auto' in sky2image() to only solve where the polynomial is
+    not accurate enough.
+
     Examples:
         # Use a fits header as initialization to a WCS class and convert
         # image (x,y) to equatorial longitude,latitude (ra,dec)
@@ -185,11 +208,13 @@ class WCS(object):
         x,y = wcs.sky2image(ra,dec)
     """
 
-    def __init__(self, wcs, longpole=180.0, latpole=90.0, theta0=90.0):
+    def __init__(self, wcs, longpole=180.0, latpole=90.0, theta0=90.0,
+                 inverse_tol=None, minimal=False):
 
         # Convert to internal dictionary and set some attributes of this
         # instance
-        self.wcs = self.ConvertWCS(wcs)
+        self.wcs = self.ConvertWCS(wcs, minimal=minimal)
+        self.inverse_tol = inverse_tol
 
         # Set these as attributes, either from above keywords or from the
         # wcs header
@@ -212,7 +237,13 @@ class WCS(object):
     def keys(self):
         return list(self.wcs.keys())
 
-    def image2sky(self, x, y, distort=True):
+    def compact(self):
+        """Return the CompactWCS of this WCS, e.g. to send to other processes.
+        """
+        return CompactWCS(_pack_wcs(self))
+
+    def image2sky(self, x, y, distort=True, dtype='f8', out=None,
+                  chunk_size=None, nthreads=None, backend=None):
         """Convert between image x,y and sky coordinates lon,lat e.g. ra,dec.
 
         Parameters
@@ -221,12 +252,46 @@ class WCS(object):
             x and y coords in the image.
         distort :  bool, optional
             Use the distortion model if present.  Default is True.
+        dtype : optional
+            'f8' or 'f4', the precision of the tangent plane stage (CRPIX
+            offsets, CD matrix and distortion).  The spherical stage is
+            always done in double precision.  Default is 'f8'.
+        out : tuple of arrays, optional
+            (longitude, latitude) arrays of the shape of x, y to fill.
+        chunk_size : int, optional
+            Process the input in blocks of this many points, reusing the
+            same scratch buffers, so that the memory used on top of the
+            outputs does not depend on the input size.
+        nthreads : int, optional
+            Number of threads.  When above 1 the blocks (of chunk_size, or
+            a cache sized default) are run on a thread pool, each thread
+            with its own scratch buffers, writing straight into the
+            outputs.  numpy releases the GIL in the arithmetic, so this
+            scales with the number of cores on large inputs.
+        backend : str, optional
+            Name of the transform backend, see get_backend.  Default None,
+            the current default backend.  Fused backends such as 'numba'
+            always work in double precision and ignore dtype.
 
         Returns
         -------
         longitude, latitude : tupple of arrays
             Probably ra, dec.  Will have the same shape as x, y.
 
+        Notes
+        -----
+        The whole chain works in place in a fixed set of buffers: five of
+        the tangent plane dtype plus the outputs, and for dtype='f4' four
+        double precision buffers for the spherical stage.
+
+        Precision budget for dtype='f4': single precision has a relative
+        error of 6e-8, so the offsets from CRPIX carry an error of about
+        6e-8*|x-crpix| pixels, and the CD matrix and distortion add a
+        similar relative error on the tangent plane coordinates.  In total
+        expect ~2e-7*|x-crpix| pixels, 1e-3 to 2e-3 pixels for the DECam
+        CCDs far from the optical axis (|x-crpix| ~ 1e4).  Use 'f8' when
+        this is not acceptable.
+
         Examples
         --------
         >>> import wcsutil
@@ -236,36 +301,397 @@ class WCS(object):
         >>> ra, dec = wcs.image2sky(x,y)
         """
         arescalar = isscalar(x)
-        x = numpy.array(x, dtype='f8', copy=False)
-        y = numpy.array(y, dtype='f8', copy=False)
+        x = numpy.atleast_1d(numpy.asarray(x, dtype='f8'))
+        y = numpy.atleast_1d(numpy.asarray(y, dtype='f8'))
+        dtype = numpy.dtype(dtype)
+        if dtype not in [numpy.float32, numpy.float64]:
+            raise ValueError("dtype must be 'f4' or 'f8'")
+        if x.shape != y.shape:
+            raise ValueError('x and y must be the same shape')
+
+        backend = get_backend(backend)
+
+        if nthreads is not None and nthreads > 1 and chunk_size is None:
+            chunk_size = _default_chunk_size
+
+        if backend.fused and (chunk_size is None or x.size <= chunk_size):
+            longitude, latitude = backend.image2sky(self, x, y,
+                                                    distort=distort, out=out)
+        elif chunk_size is None or x.size <= chunk_size:
+            longitude, latitude = self._image2sky_block(x, y, distort, dtype,
+                                                        out=out)
+        else:
+            if out is None:
+                out = (numpy.empty(x.shape, dtype='f8'),
+                       numpy.empty(x.shape, dtype='f8'))
+            longitude, latitude = out
+            if not (longitude.flags['C_CONTIGUOUS'] and
+                    latitude.flags['C_CONTIGUOUS']):
+                raise ValueError('out arrays must be contiguous')
+            xflat, yflat = x.reshape(-1), y.reshape(-1)
+            lonflat, latflat = longitude.reshape(-1), latitude.reshape(-1)
+
+            # one set of buffers per thread
+            local = threading.local()
+
+            def run_block(i0):
+                i1 = min(i0+chunk_size, xflat.size)
+                if backend.fused:
+                    backend.image2sky(self, xflat[i0:i1], yflat[i0:i1],
+                                      distort=distort,
+                                      out=(lonflat[i0:i1], latflat[i0:i1]))
+                    return
+                buffers = getattr(local, 'buffers', None)
+                if buffers is None:
+                    buffers = _image2sky_buffers(chunk_size, dtype)
+                    local.buffers = buffers
+                self._image2sky_block(xflat[i0:i1], yflat[i0:i1],
+                                      distort, dtype,
+                                      out=(lonflat[i0:i1], latflat[i0:i1]),
+                                      buffers=[b[0:i1-i0] for b in buffers])
+
+            _run_blocks(run_block, range(0, xflat.size, chunk_size),
+                        nthreads)
 
-        xdiff = x - self.crpix[0]
-        ydiff = y - self.crpix[1]
+        if arescalar:
+            longitude, latitude = longitude[0], latitude[0]
+        return longitude, latitude
+
+    def image2sky_chunks(self, x_iter, y_iter, chunk=1000000, distort=True,
+                         dtype='f8'):
+        """Generator of image2sky over an input of any length.
 
+        x_iter, y_iter are arrays (which can be memory maps) or iterables
+        yielding arrays of matching lengths, e.g. columns read piece by
+        piece from a catalog.  The pieces are re-blocked, split or merged,
+        into blocks of chunk points, the last one possibly shorter, which
+        are processed with one set of scratch buffers, and a (lon, lat)
+        tuple of arrays is yielded for each block, in order.  Memory use is
+        therefore bounded by the chunk size whatever the input length.
+
+        Usage:
+            for ra, dec in wcs.image2sky_chunks(x, y, chunk=1000000):
+                ...
+        """
+        dtype = numpy.dtype(dtype)
+        buffers = _image2sky_buffers(chunk, dtype)
+        for x, y in _iter_blocks(x_iter, y_iter, chunk):
+            n = x.size
+            yield self._image2sky_block(x, y, distort, dtype,
+                                        buffers=[b[0:n] for b in buffers])
+
+    def _image2sky_block(self, x, y, distort, dtype, out=None, buffers=None):
+        # The image2sky chain on arrays x, y.  buffers is an optional list
+        # from _image2sky_buffers of the right size.
+        if buffers is None:
+            buffers = _image2sky_buffers(x.shape, dtype)
+        else:
+            buffers = [b.reshape(x.shape) for b in buffers]
+
+        # Two pairs of buffers the stages write back and forth between,
+        # plus one for polynomial rows and products
+        pair1 = (numpy.subtract(x, self.crpix[0], out=buffers[0]),
+                 numpy.subtract(y, self.crpix[1], out=buffers[1]))
+        pair2 = (buffers[2], buffers[3])
+        work = buffers[4]
+
+        dodistort = distort and self.distort['name'] != 'none'
         p = self.projection.upper()
         if p in ['-TAN', '-TPV']:
-            u, v = self.ApplyCDMatrix(xdiff, ydiff)
-            if distort and self.distort['name'] != 'none':
+            self.ApplyCDMatrix(pair1[0], pair1[1], out=pair2, work=work)
+            if dodistort:
                 # Assuming PV distortions
-                u, v = self.Distort(u, v)
+                self.Distort(pair2[0], pair2[1], out=pair1, work=work)
+                pair1, pair2 = pair2, pair1
 
         elif p == '-TAN-SIP':
-            if distort and self.distort['name'] != 'none':
-                u, v = self.Distort(xdiff, ydiff)
-            u, v = self.ApplyCDMatrix(u, v)
+            if dodistort:
+                self.Distort(pair1[0], pair1[1], out=pair2, work=work)
+                pair1, pair2 = pair2, pair1
+            self.ApplyCDMatrix(pair1[0], pair1[1], out=pair2, work=work)
         else:
             raise ValueError("projection '%s' not supported" % p)
+        u, v = pair2
 
-        longitude, latitude = self.image2sph(u, v)
+        if dtype == numpy.float64:
+            sphwork = [pair1[0], pair1[1], work]
+        else:
+            sphwork = buffers[5:]
+        return self.image2sph(u, v, out=out, work=sphwork)
 
-        if arescalar:
-            longitude, latitude = longitude[0], latitude[0]
+    def image2sky_grid(self, shape=None, step=64, tol=1.0e-3, out=None,
+                       distort=True, get_err=False):
+        """Sky coordinates of every pixel of an image.
+
+        The exact transform is only evaluated on a grid of nodes every
+        ~step pixels, and the rest is filled with a bicubic spline.  The
+        spline is checked against the exact transform at the cell centers,
+        where its error is largest; if the error is above tol pixels the
+        step is halved and the spline rebuilt.
+
+        Parameters
+        ----------
+        shape : tuple, optional
+            (ny, nx) of the image.  Default (naxis2, naxis1).
+        step : int, optional
+            Initial spacing of the nodes in pixels.  Default 64.
+        tol : float, optional
+            Maximum allowed interpolation error in pixels.  Default 1.0e-3
+        out : tuple of arrays, optional
+            (lon, lat) arrays of the given shape to fill.
+        distort : bool, optional
+            Use the distortion model if present.  Default is True.
+        get_err : bool, optional
+            Also return the maximum error found in the check, in pixels.
+
+        Returns
+        -------
+        longitude, latitude : arrays of shape (ny, nx)
+            The value at [j, i] is that of pixel x=i+1, y=j+1.
+        """
+        from scipy.interpolate import RectBivariateSpline
+
+        if shape is None:
+            shape = (self.wcs['naxis2'], self.wcs['naxis1'])
+        ny, nx = shape
+        if out is None:
+            longitude = numpy.empty(shape, dtype='f8')
+            latitude = numpy.empty(shape, dtype='f8')
+        else:
+            longitude, latitude = out
+            if longitude.shape != tuple(shape) or \
+               latitude.shape != tuple(shape):
+                raise ValueError('out arrays must have shape %s' % (shape,))
+
+        # rows per block when filling, ~1M pixels at a time
+        nrows = max(1, 2**20//max(nx, 1))
+        xpix = numpy.arange(1, nx+1, dtype='f8')
+
+        # degrees per pixel, to express errors in pixels
+        pixscale = math.sqrt(abs(self.cd[0, 0]*self.cd[1, 1] -
+                                 self.cd[0, 1]*self.cd[1, 0]))
+        lon0 = self.crval[0]
+
+        maxerr = 0.0
+        while True:
+            xn = _grid_nodes(nx, step)
+            yn = _grid_nodes(ny, step)
+            if step < 4 or xn.size >= nx or yn.size >= ny:
+                # Not worth interpolating, do it exactly
+                for j0 in range(0, ny, nrows):
+                    j1 = min(j0+nrows, ny)
+                    ypix = numpy.arange(j0+1, j1+1, dtype='f8')
+                    longitude[j0:j1], latitude[j0:j1] = \
+                        self._image2sky_mesh(xpix, ypix, distort=distort)
+                maxerr = 0.0
+                break
+
+            # longitudes relative to crval so the spline does not see the
+            # jump at 0/360
+            lonn, latn = self._image2sky_mesh(xn, yn, distort=distort)
+            lonn = (lonn - lon0 + 180.0) % 360.0 - 180.0
+            lonspline = RectBivariateSpline(yn, xn, lonn)
+            latspline = RectBivariateSpline(yn, xn, latn)
+
+            # check at the cell centers
+            xc = 0.5*(xn[1:] + xn[:-1])
+            yc = 0.5*(yn[1:] + yn[:-1])
+            lonc, latc = self._image2sky_mesh(xc, yc, distort=distort)
+            lonc = (lonc - lon0 + 180.0) % 360.0 - 180.0
+            dlon = (lonspline(yc, xc) - lonc)*numpy.cos(latc*d2r)
+            dlat = latspline(yc, xc) - latc
+            maxerr = numpy.sqrt(dlon**2 + dlat**2).max()/pixscale
+
+            if maxerr <= tol:
+                # On a grid the spline is By C Bx^T, with By, Bx the
+                # B-spline basis matrices of the rows and columns, so the
+                # fill is one matrix product per block of rows.
+                tylon, txlon, clon = lonspline.tck
+                tylat, txlat, clat = latspline.tck
+                mlon = numpy.dot(clon.reshape(len(tylon)-4, len(txlon)-4),
+                                 _spline_basis(txlon, xpix).T)
+                mlat = numpy.dot(clat.reshape(len(tylat)-4, len(txlat)-4),
+                                 _spline_basis(txlat, xpix).T)
+                for j0 in range(0, ny, nrows):
+                    j1 = min(j0+nrows, ny)
+                    ypix = numpy.arange(j0+1, j1+1, dtype='f8')
+                    lonblock = longitude[j0:j1]
+                    _dot_into(_spline_basis(tylon, ypix), mlon, lonblock)
+                    lonblock += lon0
+                    numpy.mod(lonblock, 360.0, out=lonblock)
+                    _dot_into(_spline_basis(tylat, ypix), mlat,
+                              latitude[j0:j1])
+                break
+
+            step = step//2
+
+        if get_err:
+            return longitude, latitude, maxerr
         return longitude, latitude
 
-    def sky2image(self, lon, lat, distort=True, find=True):
+    def jacobian(self, x, y, distort=True):
+        """Partial derivatives of lon,lat with respect to the image x,y.
+
+        Computed analytically through the CD matrix, the distortion
+        polynomials and the tangent projection, in one vectorized pass.
+
+        Parameters
+        ----------
+        x, y : scalars or arrays
+            x and y coords in the image.
+        distort : bool, optional
+            Use the distortion model if present.  Default is True.
+
+        Returns
+        -------
+        dlon_dx, dlon_dy, dlat_dx, dlat_dy : tuple of arrays
+            In degrees per pixel, same shape as x, y.  These are the
+            derivatives of the coordinates: multiply the dlon terms by
+            cos(lat) for angles on the sky.  dlon is undefined at the poles.
+        """
+        arescalar = isscalar(x)
+        x = numpy.atleast_1d(numpy.asarray(x, dtype='f8'))
+        y = numpy.atleast_1d(numpy.asarray(y, dtype='f8'))
+        if x.shape != y.shape:
+            raise ValueError('x and y must be the same shape')
+
+        u, v, dudx, dudy, dvdx, dvdy = \
+            self._tangent_jacobian(x-self.crpix[0], y-self.crpix[1],
+                                   distort=distort)
+
+        # image2sph puts the tangent point u,v (radians) at the native
+        # direction p = (-v, u, 1), and the sky direction is q = R p for the
+        # rotation matrix R, so dq/du = R[:, 1] and dq/dv = -R[:, 0].
+        # lon = atan2(q1, q0), lat = atan2(q2, hypot(q0, q1)).  The
+        # derivatives do not depend on the normalization of q, and have the
+        # same value in degrees as in radians.
+        r = self.rotation_matrix
+        u = u*d2r
+        v = v*d2r
+        q0 = r[0, 2] - r[0, 0]*v + r[0, 1]*u
+        q1 = r[1, 2] - r[1, 0]*v + r[1, 1]*u
+        q2 = r[2, 2] - r[2, 0]*v + r[2, 1]*u
+        rho2 = q0**2 + q1**2
+        qq = rho2 + q2**2
+        rho = numpy.sqrt(rho2)
+
+        dlon_du = (q0*r[1, 1] - q1*r[0, 1])/rho2
+        dlon_dv = (q1*r[0, 0] - q0*r[1, 0])/rho2
+        dlat_du = (r[2, 1]*qq - q2*(q0*r[0, 1] + q1*r[1, 1] +
+                                    q2*r[2, 1]))/(qq*rho)
+        dlat_dv = (q2*(q0*r[0, 0] + q1*r[1, 0] + q2*r[2, 0]) -
+                   r[2, 0]*qq)/(qq*rho)
+
+        dlon_dx = dlon_du*dudx + dlon_dv*dvdx
+        dlon_dy = dlon_du*dudy + dlon_dv*dvdy
+        dlat_dx = dlat_du*dudx + dlat_dv*dvdx
+        dlat_dy = dlat_du*dudy + dlat_dv*dvdy
+
+        if arescalar:
+            return dlon_dx[0], dlon_dy[0], dlat_dx[0], dlat_dy[0]
+        return dlon_dx, dlon_dy, dlat_dx, dlat_dy
+
+    def pixel_area(self, x, y, distort=True, units='arcsec'):
+        """Solid angle of the pixels at x,y.
+
+        The determinant of the analytic jacobian of the tangent plane
+        coordinates, times the area factor of the gnomonic projection,
+        (1 + r^2)^-3/2 for the distance r (radians) from the tangent point.
+
+        Parameters
+        ----------
+        x, y : scalars or arrays
+            x and y coords in the image.
+        distort : bool, optional
+            Use the distortion model if present.  Default is True.
+        units : str, optional
+            'arcsec', 'arcmin' or 'degree'; the area is in units squared.
+            Default 'arcsec'.
+        """
+        scale = _angle_units(units)
+        arescalar = isscalar(x)
+        x = numpy.atleast_1d(numpy.asarray(x, dtype='f8'))
+        y = numpy.atleast_1d(numpy.asarray(y, dtype='f8'))
+        if x.shape != y.shape:
+            raise ValueError('x and y must be the same shape')
+
+        u, v, dudx, dudy, dvdx, dvdy = \
+            self._tangent_jacobian(x-self.crpix[0], y-self.crpix[1],
+                                   distort=distort)
+        area = numpy.abs(dudx*dvdy - dudy*dvdx)
+        r2 = (u*u + v*v)*(d2r*d2r)
+        area *= (scale*scale)*(1.0 + r2)**-1.5
+
+        if arescalar:
+            return area[0]
+        return area
+
+    def pixel_area_map(self, shape=None, distort=True, units='arcsec',
+                       out=None):
+        """Solid angle of every pixel of an image, see pixel_area.
+
+        Parameters
+        ----------
+        shape : tuple, optional
+            (ny, nx) of the image.  Default (naxis2, naxis1).
+        distort : bool, optional
+            Use the distortion model if present.  Default is True.
+        units : str, optional
+            'arcsec', 'arcmin' or 'degree'; the area is in units squared.
+            Default 'arcsec'.
+        out : array, optional
+            Array of the given shape to fill.
+
+        Returns
+        -------
+        area : array of shape (ny, nx)
+            The value at [j, i] is that of pixel x=i+1, y=j+1.
+        """
+        if shape is None:
+            shape = (self.wcs['naxis2'], self.wcs['naxis1'])
+        ny, nx = shape
+        if out is None:
+            out = numpy.empty(shape, dtype='f8')
+        elif out.shape != tuple(shape):
+            raise ValueError('out array must have shape %s' % (shape,))
+
+        # ~1M pixels at a time
+        nrows = max(1, 2**20//max(nx, 1))
+        xpix = numpy.arange(1, nx+1, dtype='f8')
+        for j0 in range(0, ny, nrows):
+            j1 = min(j0+nrows, ny)
+            y = numpy.repeat(numpy.arange(j0+1, j1+1, dtype='f8'), nx)
+            x = numpy.tile(xpix, j1-j0)
+            out[j0:j1] = self.pixel_area(x, y, distort=distort,
+                                         units=units).reshape(j1-j0, nx)
+        return out
+
+    def sky2image_chunks(self, lon_iter, lat_iter, chunk=1000000,
+                         distort=True, find=True, tol=1.0e-8):
+        """Generator of sky2image over an input of any length.
+
+        Same as image2sky_chunks for the inverse transform; yields an
+        (x, y) tuple of arrays per block of at most chunk points.
+        """
+        for lon, lat in _iter_blocks(lon_iter, lat_iter, chunk):
+            yield self.sky2image(lon, lat, distort=distort, find=find,
+                                 tol=tol)
+
+    def _image2sky_mesh(self, x1d, y1d, distort=True):
+        # image2sky on the mesh of x1d, y1d, returns arrays of shape
+        # (y1d.size, x1d.size)
+        x, y = numpy.meshgrid(x1d, y1d)
+        lon, lat = self.image2sky(x.ravel(), y.ravel(), distort=distort)
+        return lon.reshape(x.shape), lat.reshape(x.shape)
+
+    def sky2image(self, lon, lat, distort=True, find=True, tol=1.0e-8,
+                  chunk_size=None, nthreads=None, backend=None,
+                  auto_tol=1.0e-3, table=None):
         """
         Usage:
-            x,y=sky2image(longitude, latitude, distort=True, find=True)
+            x,y=sky2image(longitude, latitude, distort=True, find=True,
+                          tol=1.0e-8, chunk_size=None, nthreads=None,
+                          backend=None, auto_tol=1.0e-3, table=None)
 
         Purpose:
             Convert between sky (lon,lat) and image coordinates (x,y)
@@ -277,6 +703,24 @@ class WCS(object):
             find: When the distortion model is present, simply find the 
                 roots of the polynomial rather than using an inverse 
                 polynomial.  This is more accurate but slower. Default True.
+                Send 'auto' to use the inverse polynomial where its error is
+                below auto_tol and find the roots only elsewhere, or
+                'table' to use the table argument and a single Newton
+                step.  With a table, find=True and 'auto' also start the
+                root finding from it.
+            tol: Convergence tolerance in pixels of the root finding used
+                when find=True.  Default 1.0e-8
+            chunk_size: Process the input in blocks of this many points to
+                bound the memory used.  Default None, all at once.
+            nthreads: Run the blocks on a pool of this many threads.
+                Default None, no threads.
+            backend: Name of the backend used for the sky to tangent
+                plane stage, see get_backend.  Default None, the current
+                default backend.
+            auto_tol: Accuracy in pixels required from the inverse
+                polynomial with find='auto'.  Default 1.0e-3
+            table: An inverse table of this WCS from build_inverse_table.
+                Default None.
         Outputs:
             x,y: x and y coords in the image.  Will have the same shape as
                 lon,lat
@@ -292,12 +736,48 @@ class WCS(object):
         longitude = numpy.array(lon, ndmin=1, dtype='f8', copy=False)
         latitude = numpy.array(lat, ndmin=1, dtype='f8', copy=False)
 
+        if nthreads is not None and nthreads > 1 and chunk_size is None:
+            chunk_size = _default_chunk_size
+
+        if chunk_size is not None and longitude.size > chunk_size:
+            x = numpy.empty(longitude.size, dtype='f8')
+            y = numpy.empty(longitude.size, dtype='f8')
+            lonflat = longitude.reshape(-1)
+            latflat = latitude.reshape(-1)
+
+            def run_block(i0):
+                i1 = min(i0+chunk_size, lonflat.size)
+                x[i0:i1], y[i0:i1] = \
+                    self.sky2image(lonflat[i0:i1], latflat[i0:i1],
+                                   distort=distort, find=find, tol=tol,
+                                   backend=backend, auto_tol=auto_tol,
+                                   table=table)
+
+            _run_blocks(run_block, range(0, lonflat.size, chunk_size),
+                        nthreads)
+            return x.reshape(longitude.shape), y.reshape(longitude.shape)
+
         # Only do this if there is distortion
-        if find and self.distort['name'] != 'none':
-            x, y = self._findxy(longitude, latitude)
+        if find == 'table' and distort and self.distort['name'] != 'none':
+            x, y = self._findxy_table(longitude.reshape(-1),
+                                      latitude.reshape(-1), table, tol=tol)
+            x = x.reshape(longitude.shape)
+            y = y.reshape(longitude.shape)
+        elif find == 'auto' and distort and self.distort['name'] != 'none':
+            x, y = self._findxy_auto(longitude.reshape(-1),
+                                     latitude.reshape(-1), tol=tol,
+                                     auto_tol=auto_tol, backend=backend,
+                                     table=table)
+            x = x.reshape(longitude.shape)
+            y = y.reshape(longitude.shape)
+        elif find and distort and self.distort['name'] != 'none':
+            x, y = self._findxy(longitude.reshape(-1), latitude.reshape(-1),
+                                tol=tol, table=table)
+            x = x.reshape(longitude.shape)
+            y = y.reshape(longitude.shape)
         else:
 
-            u, v = self.sph2image(longitude, latitude)
+            u, v = get_backend(backend).sph2image(self, longitude, latitude)
 
             p = self.projection.upper()
             if p in ['-TAN', '-TPV']:
@@ -332,58 +812,85 @@ class WCS(object):
 
         return projection
 
-    def ApplyCDMatrix(self, x, y, inverse=False):
+    def ApplyCDMatrix(self, x, y, inverse=False, out=None, work=None):
+        """Apply the CD matrix, or its inverse, to x,y.
+
+        out can be a tuple of two arrays to write the result into, which
+        must not be x or y; work is an optional scratch array.
+        """
         if not inverse:
             cd = self.cd
-            xp = cd[0, 0]*x + cd[0, 1]*y
-            yp = cd[1, 0]*x + cd[1, 1]*y
         else:
-            cdinv = self.cdinv
-            xp = cdinv[0, 0]*x + cdinv[0, 1]*y
-            yp = cdinv[1, 0]*x + cdinv[1, 1]*y
+            cd = self.cdinv
 
+        if out is None:
+            xp = cd[0, 0]*x + cd[0, 1]*y
+            yp = cd[1, 0]*x + cd[1, 1]*y
+            return xp, yp
+
+        xp, yp = out
+        if work is None:
+            work = numpy.empty_like(xp)
+        numpy.multiply(x, cd[0, 0], out=xp)
+        numpy.multiply(y, cd[0, 1], out=work)
+        xp += work
+        numpy.multiply(x, cd[1, 0], out=yp)
+        numpy.multiply(y, cd[1, 1], out=work)
+        yp += work
         return xp, yp
 
-    def image2sph(self, xin, yin):
+    def image2sph(self, xin, yin, out=None, work=None):
         """Convert x,y projected coordinates to spherical coordinates.
 
         Currently only supports tangent plane projections. The conventions
         assumed are that of the WCS Works in the native system currently.
+
+        out can be a tuple of (longitude, latitude) arrays to fill, and work
+        a list of up to four double precision scratch arrays of the same
+        shape, which are overwritten.
         """
         # Make sure ndmin=1 to avoid messed up scalar arrays
-        x = numpy.array(xin, ndmin=1, dtype='f8')
-        y = numpy.array(yin, ndmin=1, dtype='f8')
+        x = numpy.atleast_1d(numpy.asarray(xin))
+        y = numpy.atleast_1d(numpy.asarray(yin))
 
         if x.size != y.size:
             raise ValueError('x and y must be the same size')
 
-        latitude = numpy.zeros_like(x)
-        longitude = numpy.zeros_like(x)
-
-        latitude[:] = math.pi/2
-
-        # radius in radians
-        r = numpy.sqrt(x*x + y*y)*math.pi/180.0
-
-        w, = numpy.where(r > 0)
-        if w.size > 0:
-            latitude[w] = numpy.arctan(1.0/r[w])
+        work = _scratch(work, 4, x.shape)
+        if out is None:
+            longitude = numpy.empty(x.shape, dtype='f8')
+            latitude = numpy.empty(x.shape, dtype='f8')
+        else:
+            longitude, latitude = out
+        # Work in double precision even if the outputs are not
+        if longitude.dtype != numpy.float64:
+            lonbuff = numpy.empty(x.shape, dtype='f8')
+        else:
+            lonbuff = longitude
+        if latitude.dtype != numpy.float64:
+            latbuff = numpy.empty(x.shape, dtype='f8')
+        else:
+            latbuff = latitude
 
-        longitude = numpy.arctan2(x, -y)
+        # radius in radians, the latitude is arctan(1/r), pi/2 at r=0
+        numpy.hypot(x, y, out=latbuff)
+        latbuff *= math.pi/180.0
+        numpy.arctan2(1.0, latbuff, out=latbuff)
 
-        longitude *= r2d
-        latitude *= r2d
+        numpy.negative(y, out=work[0])
+        numpy.arctan2(x, work[0], out=lonbuff)
 
-        longitude, latitude = self.Rotate(longitude, latitude, reverse=True)
+        r = self.rotation_matrix.transpose()
+        self._rotate(lonbuff, latbuff, r, out=(lonbuff, latbuff), work=work)
 
         # Make sure the result runs from 0 to 360
-        w, = numpy.where(longitude < 0.0)
-        if w.size > 0:
-            longitude[w] += 360.0
-        w, = numpy.where(longitude >= 360.0)
-        if w.size > 0:
-            longitude[w] -= 360.0
+        numpy.add(lonbuff, 360.0, out=lonbuff, where=lonbuff < 0.0)
+        numpy.subtract(lonbuff, 360.0, out=lonbuff, where=lonbuff >= 360.0)
 
+        if lonbuff is not longitude:
+            longitude[...] = lonbuff
+        if latbuff is not latitude:
+            latitude[...] = latbuff
         return longitude, latitude
 
     def sph2image(self, longitude_in, latitude_in):
@@ -391,25 +898,32 @@ class WCS(object):
 
         Must be a tangent plane projection.
         """
-        longitude = numpy.array(longitude_in, ndmin=1, dtype='f8')
-        latitude = numpy.array(latitude_in, ndmin=1, dtype='f8')
-
-        longitude, latitude = \
-            self.Rotate(longitude, latitude)
-        longitude *= d2r
-        latitude *= d2r
+        longitude = numpy.array(longitude_in, ndmin=1, dtype='f8')*d2r
+        latitude = numpy.array(latitude_in, ndmin=1, dtype='f8')*d2r
 
         if longitude.size != latitude.size:
             raise ValueError('long,lat must be the same size')
 
+        # Rotate to the native direction l,m,n.  The projection is
+        # r2d*(m, -l)/n: going through the native latitude, arcsin(n), loses
+        # precision close to the tangent point where n is close to 1.
+        r = self.rotation_matrix
+        clat = numpy.cos(latitude)
+        l = numpy.cos(longitude)*clat
+        m = numpy.sin(longitude)*clat
+        n = numpy.sin(latitude)
+        b0 = r[0, 0]*l + r[1, 0]*m + r[2, 0]*n
+        b1 = r[0, 1]*l + r[1, 1]*m + r[2, 1]*n
+        b2 = r[0, 2]*l + r[1, 2]*m + r[2, 2]*n
+
         x = numpy.zeros_like(longitude)
         y = numpy.zeros_like(longitude)
 
-        w, = numpy.where(latitude > 0.0)
-        if w.size > 0:
-            rdiv = r2d/numpy.tan(latitude[w])
-            x[w] = rdiv*numpy.sin(longitude[w])
-            y[w] = -rdiv*numpy.cos(longitude[w])
+        w = b2 > 0.0
+        if w.any():
+            rdiv = r2d/b2[w]
+            x[w] = rdiv*b1[w]
+            y[w] = -rdiv*b0[w]
 
         return x, y
 
@@ -451,49 +965,334 @@ class WCS(object):
 
         return r
 
-    def _rotate(self, longitude, latitude, r):
+    def _rotate(self, longitude, latitude, r, out=None, work=None):
         """Apply a rotation matrix to the input longitude and latitude.
 
-        Inputs must be numpy arrays.
+        Inputs must be numpy arrays, in radians; the outputs are in
+        degrees.  out can be a tuple of (longitude, latitude) double
+        precision arrays to write into, which may be the inputs, and work a
+        list of up to four scratch arrays.
         """
-        l = numpy.cos(latitude)*numpy.cos(longitude)
-        m = numpy.cos(latitude)*numpy.sin(longitude)
-        n = numpy.sin(latitude)
+        work = _scratch(work, 4, longitude.shape)
+        if out is None:
+            out = (numpy.empty(longitude.shape, dtype='f8'),
+                   numpy.empty(longitude.shape, dtype='f8'))
+        lon_new, lat_new = out
+
+        # l,m,n in work[2], work[0], work[1]
+        numpy.cos(latitude, out=work[0])
+        numpy.sin(latitude, out=work[1])
+        numpy.cos(longitude, out=work[2])
+        work[2] *= work[0]
+        numpy.sin(longitude, out=work[3])
+        work[0] *= work[3]
+        l, m, n = work[2], work[0], work[1]
 
         # find solution to the system of equations and put it in b
         # Can't use matrix notation in case l,m,n are rrays
-
-        b0 = r[0, 0]*l + r[1, 0]*m + r[2, 0]*n
-        b1 = r[0, 1]*l + r[1, 1]*m + r[2, 1]*n
-        b2 = r[0, 2]*l + r[1, 2]*m + r[2, 2]*n
+        # The inputs are no longer needed, so the outputs can be used as
+        # scratch from here on.
+
+        # b0 = r[0, 0]*l + r[1, 0]*m + r[2, 0]*n
+        b0 = work[3]
+        numpy.multiply(l, r[0, 0], out=b0)
+        numpy.multiply(m, r[1, 0], out=lon_new)
+        b0 += lon_new
+        numpy.multiply(n, r[2, 0], out=lon_new)
+        b0 += lon_new
+
+        # b2 = r[0, 2]*l + r[1, 2]*m + r[2, 2]*n
+        b2 = lat_new
+        numpy.multiply(l, r[0, 2], out=b2)
+        numpy.multiply(m, r[1, 2], out=lon_new)
+        b2 += lon_new
+        numpy.multiply(n, r[2, 2], out=lon_new)
+        b2 += lon_new
+
+        # b1 = r[0, 1]*l + r[1, 1]*m + r[2, 1]*n, l is free after this
+        b1 = lon_new
+        numpy.multiply(l, r[0, 1], out=b1)
+        numpy.multiply(m, r[1, 1], out=l)
+        b1 += l
+        numpy.multiply(n, r[2, 1], out=l)
+        b1 += l
 
         # Account for possible roundoff
-        w, = numpy.where(b2 > 1.0)
-        if w.size > 0:
-            b2[w] = 1.0
-        w, = numpy.where(b2 < -1.0)
-        if w.size > 0:
-            b2[w] = -1.0
+        numpy.clip(b2, -1.0, 1.0, out=b2)
 
-        lat_new = numpy.arcsin(b2)*r2d
-        lon_new = numpy.arctan2(b1, b0)*r2d
+        numpy.arcsin(b2, out=lat_new)
+        lat_new *= r2d
+        numpy.arctan2(b1, b0, out=lon_new)
+        lon_new *= r2d
 
         return lon_new, lat_new
 
-    def _lonlatdiff(self, xy):
+    def _lonlatdiff(self, xy, lonlat_answer=None):
+        # The answer is passed as an argument so that several threads can
+        # solve at the same time; self.lonlat_answer is the old interface
+        if lonlat_answer is None:
+            lonlat_answer = self.lonlat_answer
         x = numpy.array(xy[0])
         y = numpy.array(xy[1])
         lon, lat = self.image2sky(x, y)
         lonlat = numpy.array([lon[0], lat[0]], dtype='f8')
-        diff = lonlat-self.lonlat_answer
+        diff = lonlat-lonlat_answer
         return diff
 
-    def _findxy(self, lon, lat):
+    def _findxy(self, lon, lat, tol=1.0e-8, maxiter=20, table=None):
         """
 
         This is the simplest way to do the inverse of the (x,y)->(lon,lat)
-        transformation when there are distortions.  Simply find the x,y 
-        that give the input lon,lat from the actual distortion function.  
+        transformation when there are distortions.  Simply find the x,y
+        that give the input lon,lat from the actual distortion function.
+
+        All points are solved at once with a vectorized Newton iteration in
+        the tangent plane, using the analytic jacobian of the CD matrix and
+        the distortion polynomials.  The inverse table, when given, or the
+        polynomial inverse (find=False) is used as the starting guess and
+        each point stops iterating once its step is smaller than tol
+        pixels.  Points that have not converged
+        after maxiter iterations are handed to _findxy_fsolve.
+        """
+        if lon.size != lat.size:
+            raise ValueError('lon and lat must be same size')
+
+        # The target positions in the tangent plane
+        u0, v0 = self.sph2image(lon, lat)
+
+        # Use the inverse table, or the polynomial inverse, as our guess
+        xdiff = ydiff = None
+        if table is not None:
+            xdiff, ydiff, off = self._table_lookup(table, u0, v0)
+            if off.size > 0:
+                xoff, yoff = self.sky2image(lon[off], lat[off], find=False)
+                xdiff[off] = xoff - self.crpix[0]
+                ydiff[off] = yoff - self.crpix[1]
+        else:
+            x, y = self.sky2image(lon, lat, find=False)
+            xdiff = x - self.crpix[0]
+            ydiff = y - self.crpix[1]
+
+        active = self._newton_tangent(u0, v0, xdiff, ydiff, tol=tol,
+                                      maxiter=maxiter)
+
+        x = xdiff + self.crpix[0]
+        y = ydiff + self.crpix[1]
+
+        if active.size > 0:
+            x[active], y[active] = self._findxy_fsolve(lon[active],
+                                                       lat[active])
+        return x, y
+
+    def _newton_tangent(self, u0, v0, xdiff, ydiff, tol=1.0e-8, maxiter=20,
+                        active=None):
+        """
+
+        Newton iterations in place on the pixel offsets xdiff, ydiff so
+        that the forward transform gives the tangent plane u0, v0.  Each
+        point stops once its step is smaller than tol pixels.  Returns the
+        indices of the points that did not converge in maxiter iterations.
+        """
+        # indices of the points still iterating
+        if active is None:
+            active = numpy.arange(u0.size)
+        for i in range(maxiter):
+            # no copies while all the points are iterating
+            if active.size == u0.size:
+                sub = slice(None)
+            else:
+                sub = active
+            u, v, dudx, dudy, dvdx, dvdy = \
+                self._tangent_jacobian(xdiff[sub], ydiff[sub])
+            du = u0[sub] - u
+            dv = v0[sub] - v
+
+            det = dudx*dvdy - dudy*dvdx
+            dx = (dvdy*du - dudy*dv)/det
+            dy = (dudx*dv - dvdx*du)/det
+            xdiff[sub] += dx
+            ydiff[sub] += dy
+
+            converged = (numpy.abs(dx) < tol) & (numpy.abs(dy) < tol)
+            active = active[~converged]
+            if active.size == 0:
+                break
+        return active
+
+    def build_inverse_table(self, resolution=16.0, margin=64.0, tol=1.0e-10):
+        """Precompute a tangent plane to pixel table for sky2image.
+
+        The table covers the image, plus margin pixels, with nodes every
+        resolution pixels, and holds the exact inverse (root found to tol
+        pixels) at each node.  With it sky2image(find='table', table=table)
+        answers with a bilinear lookup in the table and one Newton step,
+        which is at the level of the root finding for the default
+        resolution at close to the cost of the forward transform, and
+        sky2image(find=True, table=table) starts its iterations from the
+        table.  Points off the table are root found as usual.
+
+        The table is returned rather than kept in the WCS, which is left
+        unchanged, so WCS objects shared through get_wcs or a WCSCache can
+        be used with tables of their own by each caller.  It is a
+        dictionary, whose 'maxerr' is the maximum error in pixels of the
+        bilinear lookup alone, measured at the cell centers.  None when
+        there is no distortion.
+        """
+        if self.distort['name'] == 'none':
+            return None
+
+        nx, ny = self.wcs['naxis1'], self.wcs['naxis2']
+
+        # tangent plane bounding box of the image and margin, from its edges
+        edge = numpy.linspace(0.0, 1.0, 65)
+        xe = numpy.concatenate([edge*(nx-1.0), edge*0.0+(nx-1.0),
+                                edge*(nx-1.0), edge*0.0]) + 1.0
+        ye = numpy.concatenate([edge*0.0, edge*(ny-1.0),
+                                edge*0.0+(ny-1.0), edge*(ny-1.0)]) + 1.0
+        xe = numpy.where(xe > nx/2.0, xe+margin, xe-margin)
+        ye = numpy.where(ye > ny/2.0, ye+margin, ye-margin)
+        u, v = self._tangent_jacobian(xe-self.crpix[0], ye-self.crpix[1])[0:2]
+
+        pixscale = math.sqrt(abs(self.cd[0, 0]*self.cd[1, 1] -
+                                 self.cd[0, 1]*self.cd[1, 0]))
+        step = resolution*pixscale
+        nu = int(math.ceil((u.max()-u.min())/step))+1
+        nv = int(math.ceil((v.max()-v.min())/step))+1
+        unodes = u.min() + step*numpy.arange(nu)
+        vnodes = v.min() + step*numpy.arange(nv)
+
+        # xdiff, ydiff pairs of the nodes, flattened so a lookup is one
+        # gather per corner
+        xdiff, ydiff = self._tangent_inverse_mesh(unodes, vnodes, tol)
+        table = {'umin': unodes[0], 'vmin': vnodes[0], 'step': step,
+                 'nu': nu, 'nv': nv,
+                 'nodes': numpy.column_stack((xdiff.ravel(), ydiff.ravel()))}
+
+        # error of the lookup at the cell centers
+        uc = 0.5*(unodes[1:] + unodes[:-1])
+        vc = 0.5*(vnodes[1:] + vnodes[:-1])
+        xc, yc = self._tangent_inverse_mesh(uc, vc, tol)
+        ucm, vcm = numpy.meshgrid(uc, vc)
+        xl, yl, off = self._table_lookup(table, ucm.ravel(), vcm.ravel())
+        table['maxerr'] = numpy.hypot(xl-xc.ravel(), yl-yc.ravel()).max()
+        return table
+
+    def _tangent_inverse_mesh(self, u1d, v1d, tol):
+        # Pixel offsets of the tangent plane mesh of u1d, v1d, shape
+        # (v1d.size, u1d.size)
+        u0, v0 = numpy.meshgrid(u1d, v1d)
+        u0 = u0.ravel()
+        v0 = v0.ravel()
+
+        # guess from the inverse CD matrix and the inverse polynomial
+        p = self.projection.upper()
+        if p in ['-TAN', '-TPV']:
+            up, vp = self.Distort(u0, v0, inverse=True)
+            xdiff, ydiff = self.ApplyCDMatrix(up, vp, inverse=True)
+        else:
+            xp, yp = self.ApplyCDMatrix(u0, v0, inverse=True)
+            xdiff, ydiff = self.Distort(xp, yp, inverse=True)
+        xdiff = numpy.array(xdiff, dtype='f8')
+        ydiff = numpy.array(ydiff, dtype='f8')
+
+        self._newton_tangent(u0, v0, xdiff, ydiff, tol=tol)
+        return (xdiff.reshape(v1d.size, u1d.size),
+                ydiff.reshape(v1d.size, u1d.size))
+
+    def _table_lookup(self, table, u0, v0):
+        # Bilinear lookup of the pixel offsets of tangent plane u0, v0 in
+        # the inverse table.  Returns xdiff, ydiff and the indices of the
+        # points off the table, for which they are not set.
+        fu = (u0 - table['umin'])/table['step']
+        fv = (v0 - table['vmin'])/table['step']
+        off, = numpy.where(~((fu >= 0.0) & (fu <= table['nu']-1) &
+                             (fv >= 0.0) & (fv <= table['nv']-1)))
+        iu = numpy.clip(numpy.floor(fu), 0, table['nu']-2).astype('i8')
+        iv = numpy.clip(numpy.floor(fv), 0, table['nv']-2).astype('i8')
+        fu -= iu
+        fv -= iv
+        fu = fu[:, numpy.newaxis]
+        fv = fv[:, numpy.newaxis]
+
+        nodes = table['nodes']
+        k = iv*table['nu'] + iu
+        t = nodes[k]*(1.0-fu)
+        t += nodes[k+1]*fu
+        t *= 1.0-fv
+        k += table['nu']
+        t1 = nodes[k]*(1.0-fu)
+        t1 += nodes[k+1]*fu
+        t1 *= fv
+        t += t1
+        return t[:, 0].copy(), t[:, 1].copy(), off
+
+    def _findxy_table(self, lon, lat, table, tol=1.0e-8):
+        """
+
+        Inverse from the table of build_inverse_table and one Newton
+        step.  Points off the table are solved with _findxy.
+        """
+        if table is None:
+            raise ValueError("find='table' needs the table of "
+                             "build_inverse_table")
+        u0, v0 = self.sph2image(lon, lat)
+        xdiff, ydiff, off = self._table_lookup(table, u0, v0)
+
+        on = numpy.ones(lon.size, dtype=bool)
+        on[off] = False
+        on, = numpy.where(on)
+        self._newton_tangent(u0, v0, xdiff, ydiff, maxiter=1, active=on)
+
+        x = xdiff + self.crpix[0]
+        y = ydiff + self.crpix[1]
+        if off.size > 0:
+            x[off], y[off] = self._findxy(lon[off], lat[off], tol=tol,
+                                          table=table)
+        return x, y
+
+    def _findxy_auto(self, lon, lat, tol=1.0e-8, auto_tol=1.0e-3,
+                     backend=None, table=None):
+        """
+
+        The inverse polynomial where it is accurate to auto_tol pixels,
+        root finding with _findxy elsewhere.
+
+        When the error of the polynomial measured over the image (see
+        InverseError) is below auto_tol it is used as is for the points
+        on the image.  Otherwise, and for points off the image, the error
+        of each point is estimated with one Newton step in the tangent
+        plane, and the points where it is too large are solved.
+        """
+        x, y = self.sky2image(lon, lat, find=False, backend=backend)
+
+        maxerr = self.InverseError()[0]
+        if maxerr <= auto_tol:
+            check, = numpy.where((x < 0.5) | (x > self.wcs['naxis1']+0.5) |
+                                 (y < 0.5) | (y > self.wcs['naxis2']+0.5))
+        else:
+            check = numpy.arange(lon.size)
+        if check.size == 0:
+            return x, y
+
+        u0, v0 = self.sph2image(lon[check], lat[check])
+        u, v, dudx, dudy, dvdx, dvdy = \
+            self._tangent_jacobian(x[check]-self.crpix[0],
+                                   y[check]-self.crpix[1])
+        du = u0 - u
+        dv = v0 - v
+        det = dudx*dvdy - dudy*dvdx
+        err = numpy.hypot((dvdy*du - dudy*dv)/det, (dudx*dv - dvdx*du)/det)
+
+        bad = check[~(err <= auto_tol)]
+        if bad.size > 0:
+            x[bad], y[bad] = self._findxy(lon[bad], lat[bad], tol=tol,
+                                          table=table)
+        return x, y
+
+    def _findxy_fsolve(self, lon, lat):
+        """
+
+        Invert the (x,y)->(lon,lat) transformation one point at a time.
 
         Uses scipy.optimize.fsolve to find the roots of the transformation
         """
@@ -506,21 +1305,129 @@ class WCS(object):
         x = numpy.zeros_like(lon)
         y = numpy.zeros_like(lon)
         xyguess = numpy.zeros(2, dtype='f8')
-        self.lonlat_answer = numpy.zeros(2, dtype='f8')
+        lonlat_answer = numpy.zeros(2, dtype='f8')
         for i in range(lon.size):
-            self.lonlat_answer[0], self.lonlat_answer[1] = lon[i], lat[i]
+            lonlat_answer[0], lonlat_answer[1] = lon[i], lat[i]
 
             # Use inversion without distortion as our guess
             xyguess[0], xyguess[1] = \
                 self.sky2image(lon[i], lat[i], find=False, distort=False)
-            xy = scipy.optimize.fsolve(self._lonlatdiff, xyguess)
+            xy = scipy.optimize.fsolve(self._lonlatdiff, xyguess,
+                                       args=(lonlat_answer,))
             x[i], y[i] = xy[0], xy[1]
             #loncheck,latcheck = self.image2sky(x[i],y[i])
             #lonerr, laterr = loncheck-lon[i], latcheck-lat[i]
 
         return x, y
 
-    def Distort(self, xin, yin, inverse=False):
+    def _fused_params(self, distort=True):
+        """Parameters of the transform for the fused kernels.
+
+        Returns (crpix, cd, mode, a, b, rotation_matrix) where mode is 0
+        for no distortion, 1 for PV distortions applied after the CD
+        matrix and 2 for SIP distortions applied before it.
+        """
+        p = self.projection.upper()
+        if p not in ['-TAN', '-TPV', '-TAN-SIP']:
+            raise ValueError("projection '%s' not supported" % p)
+
+        mode = 0
+        # placeholder matrices for the kernels when there is no distortion
+        a = b = numpy.zeros((1, 1), dtype='f8')
+        if distort and self.distort['name'] != 'none':
+            if self.distort['name'] == 'scamp':
+                mode = 1
+            elif self.distort['name'] == 'sip':
+                mode = 2
+            else:
+                raise ValueError("Unsupported distortion model '%s'" %
+                                 self.distort['name'])
+            a = numpy.ascontiguousarray(self.distort['a'], dtype='f8')
+            b = numpy.ascontiguousarray(self.distort['b'], dtype='f8')
+
+        return (numpy.asarray(self.crpix, dtype='f8'),
+                numpy.ascontiguousarray(self.cd, dtype='f8'),
+                mode, a, b,
+                numpy.ascontiguousarray(self.rotation_matrix, dtype='f8'))
+
+    def DistortPoly(self, name, deriv=None):
+        """Polynomial2D evaluator for one of the distortion matrices.
+
+        name is one of 'a', 'b', 'ap', 'bp'.  Send deriv='x' or 'y' for
+        the evaluator of the corresponding partial derivative.  Evaluators
+        are cached and rebuilt only if the matrix in self.distort changes.
+        """
+        a = self.distort[name]
+        key = (name, deriv)
+        cached = self._distort_polys.get(key)
+        if cached is None or cached[0] is not a:
+            if deriv is None:
+                poly = Polynomial2D(a)
+            elif deriv in ['x', 'y']:
+                dadx, dady = Differentiate2DPolynomial(a)
+                poly = Polynomial2D(dadx if deriv == 'x' else dady)
+            else:
+                raise ValueError("deriv must be None, 'x' or 'y'")
+            cached = (a, poly)
+            self._distort_polys[key] = cached
+        return cached[1]
+
+    def _tangent_jacobian(self, xdiff, ydiff, distort=True):
+        """Forward transform to the tangent plane and its jacobian.
+
+        Takes pixel offsets from crpix and returns the distorted tangent
+        plane coordinates u,v (degrees) and the partial derivatives
+        du/dx, du/dy, dv/dx, dv/dy.
+        """
+        cd = self.cd
+        nodistort = not distort or self.distort['name'] == 'none'
+        p = self.projection.upper()
+        if p in ['-TAN', '-TPV']:
+            u, v = self.ApplyCDMatrix(xdiff, ydiff)
+            if nodistort:
+                ones = numpy.ones_like(u)
+                return (u, v, cd[0, 0]*ones, cd[0, 1]*ones,
+                        cd[1, 0]*ones, cd[1, 1]*ones)
+
+            a_u = self.DistortPoly('a', deriv='x')(u, v)
+            a_v = self.DistortPoly('a', deriv='y')(u, v)
+            b_u = self.DistortPoly('b', deriv='x')(u, v)
+            b_v = self.DistortPoly('b', deriv='y')(u, v)
+
+            # chain rule through the CD matrix
+            dudx = a_u*cd[0, 0] + a_v*cd[1, 0]
+            dudy = a_u*cd[0, 1] + a_v*cd[1, 1]
+            dvdx = b_u*cd[0, 0] + b_v*cd[1, 0]
+            dvdy = b_u*cd[0, 1] + b_v*cd[1, 1]
+
+            u, v = self.DistortPoly('a')(u, v), self.DistortPoly('b')(u, v)
+
+        elif p == '-TAN-SIP':
+            ones = numpy.ones_like(xdiff)
+            if nodistort:
+                xp, yp = xdiff, ydiff
+                zeros = numpy.zeros_like(xdiff)
+                dxpdx, dxpdy = ones, zeros
+                dypdx, dypdy = zeros, ones
+            else:
+                xp = xdiff + self.DistortPoly('a')(xdiff, ydiff)
+                yp = ydiff + self.DistortPoly('b')(xdiff, ydiff)
+                dxpdx = ones + self.DistortPoly('a', deriv='x')(xdiff, ydiff)
+                dxpdy = self.DistortPoly('a', deriv='y')(xdiff, ydiff)
+                dypdx = self.DistortPoly('b', deriv='x')(xdiff, ydiff)
+                dypdy = ones + self.DistortPoly('b', deriv='y')(xdiff, ydiff)
+
+            u, v = self.ApplyCDMatrix(xp, yp)
+            dudx = cd[0, 0]*dxpdx + cd[0, 1]*dypdx
+            dudy = cd[0, 0]*dxpdy + cd[0, 1]*dypdy
+            dvdx = cd[1, 0]*dxpdx + cd[1, 1]*dypdx
+            dvdy = cd[1, 0]*dxpdy + cd[1, 1]*dypdy
+        else:
+            raise ValueError("projection '%s' not supported" % p)
+
+        return u, v, dudx, dudy, dvdx, dvdy
+
+    def Distort(self, xin, yin, inverse=False, out=None, work=None):
         """Apply a distortion map to the data.
 
         This follows the SIP convention, but if the scamp PV coefficients
@@ -528,38 +1435,51 @@ class WCS(object):
         convention.  The only difference is the order of operations:  for
         image to sky PV distortions come after the application of the CD
         matrix as opposed to SIP.
+
+        out can be a tuple of two arrays to write the result into, which
+        must not be the inputs; work is an optional scratch array.
         """
-        x = numpy.array(xin, ndmin=1, dtype='f8')
-        y = numpy.array(yin, ndmin=1, dtype='f8')
+        if out is None:
+            x = numpy.array(xin, ndmin=1, dtype='f8')
+            y = numpy.array(yin, ndmin=1, dtype='f8')
+        else:
+            x = numpy.asarray(xin)
+            y = numpy.asarray(yin)
         # Sometimes there is no distortion model present
         if self.distort is None or self.distort['name'] == 'none':
+            if out is not None:
+                out[0][...] = x
+                out[1][...] = y
+                return out
             return x, y
 
         if x.size != y.size:
             raise ValueError('x must be same size as y')
 
         if inverse:
-            a = self.distort['ap']
-            b = self.distort['bp']
+            apoly = self.DistortPoly('ap')
+            bpoly = self.DistortPoly('bp')
         else:
-            a = self.distort['a']
-            b = self.distort['b']
+            apoly = self.DistortPoly('a')
+            bpoly = self.DistortPoly('b')
 
-        sx, sy = a.shape
+        if out is None:
+            out = (None, None)
+        if work is None:
+            work = numpy.empty_like(x)
 
         if self.distort['name'] == 'scamp':
-            xp = numpy.zeros_like(x)
-            yp = numpy.zeros_like(x)
+            xp = apoly(x, y, out=out[0], work=work)
+            yp = bpoly(x, y, out=out[1], work=work)
         elif self.distort['name'] == 'sip':
-            xp = x.copy()
-            yp = y.copy()
+            xp = apoly(x, y, out=out[0], work=work)
+            xp += x
+            yp = bpoly(x, y, out=out[1], work=work)
+            yp += y
         else:
             raise ValueError("Unsupported distortion model '%s'" %
                              self.distort['name'])
 
-        xp += Apply2DPolynomial(a, x, y)
-        yp += Apply2DPolynomial(b, x, y)
-
         return xp, yp
 
     def _compare_inversion(self, x, y, xback, yback,
@@ -584,6 +1504,8 @@ class WCS(object):
 
     def InvertDistortion(self, fac=5, order_increase=1,
                          verbose=False, doplot=False):
+        # the measured error is for the old coefficients
+        self.distort.pop('inverse_maxerr', None)
         if self.distort['name'] == 'scamp':
             return self.InvertPVDistortion(fac=fac,
                                            order_increase=order_increase,
@@ -595,6 +1517,85 @@ class WCS(object):
         else:
             raise ValueError('Can only invert scamp and sip distortions')
 
+    def FitInverse(self, tol=1.0e-2, fac=5, max_order_increase=4,
+                   max_fac=20, verbose=False):
+        """Fit the inverse distortion to a target accuracy.
+
+        Starting from the order of the forward distortion plus one and the
+        grid density fac of InvertDistortion, the order of the inverse is
+        raised, and the grid density doubled when the fit is undersampled
+        (the error between the grid points is well above that on them),
+        until the maximum error of sky2image(find=False) over the image is
+        below tol pixels.  If it is never reached, the most accurate fit
+        found is kept.
+
+        The achieved errors in pixels are set in distort['inverse_maxerr']
+        and distort['inverse_rms'], and the order increase and grid density
+        used in distort['inverse_order_increase'] and
+        distort['inverse_fac'].  Returns the max and rms errors.
+        """
+        best = None
+        for order_increase in range(1, max_order_increase+1):
+            ifac = fac
+            while True:
+                fitrms = self.InvertDistortion(fac=ifac,
+                                               order_increase=order_increase)
+                maxerr, rms = self.InverseError(force=True)
+                if verbose:
+                    sys.stdout.write('order increase %d fac %d: max %.3g '
+                                     'rms %.3g pixels\n' %
+                                     (order_increase, ifac, maxerr, rms))
+                if best is None or maxerr < best[0]:
+                    best = (maxerr, rms, order_increase, ifac,
+                            self.distort['ap'], self.distort['bp'])
+                if maxerr <= tol or rms <= 2.0*fitrms or 2*ifac > max_fac:
+                    break
+                ifac *= 2
+            if maxerr <= tol:
+                break
+
+        maxerr, rms, order_increase, ifac, ap, bp = best
+        self.distort['ap'] = ap
+        self.distort['bp'] = bp
+        self.distort['ap_order'] = ap.shape[0]-1
+        self.distort['bp_order'] = bp.shape[0]-1
+        self.distort['inverse_maxerr'] = maxerr
+        self.distort['inverse_rms'] = rms
+        self.distort['inverse_order_increase'] = order_increase
+        self.distort['inverse_fac'] = ifac
+        return maxerr, rms
+
+    def InverseError(self, n=64, force=False):
+        """Max and rms error in pixels of the inverse polynomial.
+
+        Measured by sending the centers of an nxn grid of cells over the
+        image through image2sky and back with sky2image(find=False), so
+        away from the points the inverse was fit on.  The result is kept
+        in distort['inverse_maxerr'] and distort['inverse_rms'] and only
+        measured again with force=True.
+        """
+        if self.distort['name'] == 'none':
+            return 0.0, 0.0
+        if not force and 'inverse_maxerr' in self.distort:
+            return (self.distort['inverse_maxerr'],
+                    self.distort['inverse_rms'])
+
+        nx, ny = self.wcs['naxis1'], self.wcs['naxis2']
+        x1d = 1.0 + (numpy.arange(n) + 0.5)*(nx-1.0)/n
+        y1d = 1.0 + (numpy.arange(n) + 0.5)*(ny-1.0)/n
+        x, y = numpy.meshgrid(x1d, y1d)
+        x = x.ravel()
+        y = y.ravel()
+        lon, lat = self.image2sky(x, y)
+        xback, yback = self.sky2image(lon, lat, find=False)
+        err = numpy.hypot(xback-x, yback-y)
+
+        maxerr = float(err.max())
+        rms = float(numpy.sqrt((err**2).mean()))
+        self.distort['inverse_maxerr'] = maxerr
+        self.distort['inverse_rms'] = rms
+        return maxerr, rms
+
     def InvertPVDistortion(self, fac=5, order_increase=1,
                            verbose=False, doplot=False):
         """Invert the distortion model.
@@ -665,6 +1666,7 @@ class WCS(object):
 
         Must contain a,b matrices.
         """
+        wcs = self.wcs
         self.naxis = numpy.array([wcs['naxis1'],
                                   wcs['naxis2']])
 
@@ -791,49 +1793,26 @@ class WCS(object):
                                            sp*ctheta/cd)
         return longitude_p, latitude_p
 
-    def ConvertWCS(self, wcs_in):
+    def ConvertWCS(self, wcs_in, minimal=False):
         """Convert to a dictionary.
+
+        With minimal=True only the keywords the WCS needs are looked up,
+        see header2dict.  For tile compressed images, ZNAXIS1/2 give the
+        image size.
         """
         self.wcs = None
-        self.distort = {'name': 'none'}
+        self.distort = DistortionModel(name='none')
+        self._distort_polys = {}
         self.cd = None
         self.crpix = None
         self.crval = None
         self.projection = None
 
         # Convert the wcs to a local dictionary
-
-        wcs = {}
-        if type(wcs_in) == numpy.ndarray or hasattr(wcs_in, 'dtype'):
-            if wcs_in.dtype.fields is None:
-                raise ValueError('wcs array must have fields')
-
-            for f in wcs_in.dtype.fields:
-                fl = f.lower()
-                val = wcs_in[f]
-                if val.ndim == 0:
-                    wcs[fl] = val
-                else:
-                    # only scalars
-                    wcs[fl] = val[0]
-
-        elif type(wcs_in) == type({}):
-            wcs = wcs_in.copy()
-        elif hasattr(wcs_in, '__iter__'):
-            wcs = {}
-            for k in wcs_in:
-                wcs[k.lower()] = wcs_in[k]
-        else:
-            # Try to use the items() method to get what we want
-            wcs = {}
-            try:
-                for k, v in list(wcs_in.items()):
-                    wcs[k.lower()] = v
-            except:
-                raise ValueError('Input wcs must be a numpy array ' +
-                                 'with fields or a dictionary or support ' +
-                                 'iteration or an items() method')
-
+        wcs = header2dict(wcs_in, minimal=minimal)
+        for key in ['naxis1', 'naxis2']:
+            if 'z'+key in wcs:
+                wcs[key] = wcs['z'+key]
         return wcs
 
     def SetAngles(self, longpole, latpole, theta0):
@@ -929,17 +1908,50 @@ class WCS(object):
                 self.distort['b'] = b
                 self.distort['b_order'] = border
 
-                # these coeffs will be zeros if not found above
-                self.distort['ap'] = ap
-                self.distort['ap_order'] = aporder
-                self.distort['bp'] = bp
-                self.distort['bp_order'] = bporder
+                if cap != 0 and cbp != 0:
+                    self.distort['ap'] = ap
+                    self.distort['ap_order'] = aporder
+                    self.distort['bp'] = bp
+                    self.distort['bp_order'] = bporder
+                else:
+                    # If inverse not there, get it from the persistent
+                    # store or calculate it, but only when first needed
+                    self.distort.set_loader(self._LoadInverse)
+
+    def _LoadInverse(self):
+        # Loader of the inverse coefficients for DistortionModel
+        self.LoadOrInvertDistortion(tol=self.inverse_tol)
+        self.distort['ap_order'] = self.distort['ap'].shape[0]-1
+        self.distort['bp_order'] = self.distort['bp'].shape[0]-1
+
+    def LoadOrInvertDistortion(self, fac=5, order_increase=1, tol=None):
+        """Set the inverse coefficients from the persistent store if possible.
+
+        When no store is configured (see set_inverse_store) or it does not
+        hold this distortion, InvertDistortion is run, or FitInverse when
+        a tolerance tol in pixels is given, and the result saved in the
+        store.  Returns the rms of the inversion in pixels.
+        """
+        store = get_inverse_store()
+        if store is not None:
+            key = store.key(self, fac=fac, order_increase=order_increase,
+                            tol=tol)
+            stored = store.load(key)
+            if stored is not None:
+                self.distort['ap'], self.distort['bp'], rms = stored
+                self.distort['inverse_rms'] = rms
+                return rms
+
+        if tol is None:
+            rms = self.InvertDistortion(fac=fac,
+                                        order_increase=order_increase)
+            self.distort['inverse_rms'] = rms
+        else:
+            rms = self.FitInverse(tol=tol, fac=fac)[1]
 
-                # If inverse not there, calculate it
-                if cap == 0 or cbp == 0:
-                    self.InvertDistortion()
-                    self.distort['ap_order'] = self.distort['a_order']+1
-                    self.distort['bp_order'] = self.distort['b_order']+1
+        if store is not None:
+            store.save(key, self.distort['ap'], self.distort['bp'], rms)
+        return rms
 
     def ExtractFromWCS(self):
 
@@ -1001,6 +2013,1541 @@ class WCS(object):
         self.ExtractDistortionModel()
 
 
+class DistortionModel(dict):
+    """The distortion model of a WCS, a dictionary.
+
+    It holds the name of the model, 'none', 'scamp' or 'sip', and the
+    coefficient matrices 'a', 'b' and inverse 'ap', 'bp' with their orders.
+    When the header has no inverse coefficients they are only fit (or read
+    from the persistent store) the first time one of the inverse keys is
+    looked up, e.g. by sky2image(find=False), so WCS objects used only for
+    image2sky do not pay for the fit.  'ap' in distort is False until
+    then; use has_inverse() and pending() to check without triggering it.
+    """
+
+    _lazy_keys = ('ap', 'bp', 'ap_order', 'bp_order', 'inverse_rms',
+                  'inverse_maxerr')
+
+    def __init__(self, *args, **kwargs):
+        dict.__init__(self, *args, **kwargs)
+        self._loader = None
+        self._loading = False
+        self._lock = threading.RLock()
+
+    def set_loader(self, loader):
+        """Set the function called, once, to fill the inverse keys.
+        """
+        self._loader = loader
+
+    def pending(self):
+        """True if the inverse is still to be computed.
+        """
+        return self._loader is not None
+
+    def has_inverse(self):
+        return 'ap' in self and 'bp' in self
+
+    def load(self):
+        """Compute the inverse now if it is pending.
+
+        Other threads that need the inverse meanwhile wait for it.  The
+        loader stays set until it has filled the keys, so it is run again
+        if it fails.
+        """
+        with self._lock:
+            # _loading is only seen by the thread holding the lock, when the
+            # loader itself looks up a missing key
+            if self._loader is None or self._loading:
+                return
+            self._loading = True
+            try:
+                self._loader()
+            finally:
+                self._loading = False
+            self._loader = None
+
+    def __missing__(self, key):
+        if key in self._lazy_keys:
+            if self._loader is not None:
+                self.load()
+            # check again, the keys may have been filled by another thread
+            # since the lookup failed
+            if dict.__contains__(self, key):
+                return dict.__getitem__(self, key)
+        raise KeyError(key)
+
+    def __getstate__(self):
+        # the lock does not pickle
+        return {'_loader': self._loader}
+
+    def __setstate__(self, state):
+        self._loader = state['_loader']
+        self._loading = False
+        self._lock = threading.RLock()
+
+
+class CompactWCS(object):
+    """A frozen, compact form of a WCS, to send to worker processes.
+
+    All of it is in a single contiguous float64 buffer, params: the
+    keywords that define the WCS, the distortion coefficients, and the
+    inverse coefficients if they were fit.  A DECam TPV WCS takes about
+    550 bytes, 800 with its fitted inverse, and pickles as the raw
+    buffer.  Get one with WCS.compact(), and the WCS back with to_wcs(),
+    which gives exactly the same transforms without fitting the inverse
+    again.  Only the WCS keywords of the header are kept.
+
+    The buffer can be a view of shared memory, see SharedWCSList.
+    """
+
+    __slots__ = ('params',)
+
+    def __init__(self, params):
+        if isinstance(params, bytes):
+            params = numpy.frombuffer(params, dtype='f8')
+        params = numpy.asarray(params)
+        if params.dtype != numpy.float64 or params.ndim != 1:
+            raise ValueError('params must be a 1-d float64 array')
+        self.params = params
+
+    def __repr__(self):
+        return 'CompactWCS(%d bytes)' % self.params.nbytes
+
+    def __reduce__(self):
+        return (CompactWCS, (self.params.tobytes(),))
+
+    def __len__(self):
+        return self.params.size
+
+    def to_wcs(self):
+        """Return the full WCS.
+        """
+        hdr, angles, inverse_tol, inverse = _unpack_wcs(self.params)
+        longpole, latpole, theta0 = angles
+        wcs = WCS(hdr, longpole=longpole, latpole=latpole, theta0=theta0,
+                  inverse_tol=inverse_tol)
+        if inverse:
+            wcs.distort.set_loader(None)
+            wcs.distort.update(inverse)
+        return wcs
+
+
+class SharedWCSList(object):
+    """A list of WCS held in one block of shared memory.
+
+    For fanning out work over a process pool: the WCS are packed once as
+    CompactWCS buffers, and a SharedWCSList pickles as just the name of
+    the memory block, so workers attach to it instead of receiving copies.
+    Indexing gives a CompactWCS whose buffer is a view of the shared
+    memory; call to_wcs() on it for the transforms.
+
+        shared = SharedWCSList(wcslist)
+        with multiprocessing.Pool() as pool:
+            pool.map(work, [(shared, i) for i in range(len(shared))])
+        shared.unlink()
+
+    The process that creates it must call unlink() when done; the others
+    can close().
+    """
+
+    def __init__(self, wcslist=None, _attach=None):
+        from multiprocessing import shared_memory
+
+        if _attach is not None:
+            name, size = _attach
+            self.shm = _attach_shared_memory(name)
+        else:
+            buffers = [w.params if isinstance(w, CompactWCS)
+                       else _pack_wcs(w) for w in wcslist]
+            start = len(buffers)+2
+            offsets = start + numpy.cumsum([0] + [b.size for b in buffers])
+            size = offsets[-1]
+            self.shm = shared_memory.SharedMemory(create=True, size=8*size)
+
+        # the number of WCS, the offsets of their buffers, then the buffers
+        self.data = numpy.ndarray(size, dtype='f8', buffer=self.shm.buf)
+        if _attach is None:
+            self.data[0] = len(buffers)
+            self.data[1:start] = offsets
+            for b, i0, i1 in zip(buffers, offsets[:-1], offsets[1:]):
+                self.data[i0:i1] = b
+        self._n = int(self.data[0])
+
+    def __repr__(self):
+        return 'SharedWCSList(%d WCS in %s)' % (len(self), self.shm.name)
+
+    def __reduce__(self):
+        return (_attach_shared_wcs, (self.shm.name, self.data.size))
+
+    def __len__(self):
+        return self._n
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self._n
+        if i < 0 or i >= self._n:
+            raise IndexError('index %d out of range' % i)
+        i0, i1 = int(self.data[i+1]), int(self.data[i+2])
+        return CompactWCS(self.data[i0:i1])
+
+    def close(self):
+        """Detach from the shared memory.
+        """
+        self.data = None
+        self.shm.close()
+
+    def unlink(self):
+        """Detach and free the shared memory; call once, in its creator.
+        """
+        self.close()
+        self.shm.unlink()
+
+
+def _attach_shared_wcs(name, size):
+    return SharedWCSList(_attach=(name, size))
+
+
+def _attach_shared_memory(name):
+    # Attach without registering with the resource tracker, which would
+    # otherwise free the block when the worker exits.  Before python 3.13
+    # there is no choice, but pool workers share the tracker of the
+    # process that created the block, where it is already registered
+    from multiprocessing import shared_memory
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        return shared_memory.SharedMemory(name=name)
+
+
+# Layout of the CompactWCS buffer: ctype1, ctype2 (16 characters, in two
+# floats each), cunit1, cunit2 (8 characters); the numbers, NaN when not
+# in the header; the angles used and inverse_tol; then the distortion keys
+# of the header, NaN when absent: 40 scamp PV/PVi terms, or for SIP the
+# order and coefficients of each of a, b, ap, bp; last the fitted inverse
+# coefficients and their diagnostics in distort.  ASCII text never makes
+# NaN bit patterns, so the strings survive copies.
+_compact_strings = [('ctype1', 2), ('ctype2', 2), ('cunit1', 1),
+                    ('cunit2', 1)]
+_compact_numbers = ['crpix1', 'crpix2', 'crval1', 'crval2',
+                    'cd1_1', 'cd1_2', 'cd2_1', 'cd2_2', 'naxis1', 'naxis2']
+_compact_int_keys = ['naxis1', 'naxis2']
+_compact_inverse_info = ['inverse_rms', 'inverse_maxerr',
+                         'inverse_order_increase', 'inverse_fac']
+
+
+def _compact_scamp_keys():
+    return ['%s_%d' % (prefix, i) for prefix in ['pv1', 'pv2', 'pvi1', 'pvi2']
+            for i in range(_scamp_max_ncoeff) if i not in _scamp_skip]
+
+
+def _triangle(dim):
+    ix, iy = numpy.indices((dim, dim))
+    return ix + iy < dim
+
+
+def _pack_matrix(matrix, fill):
+    # [n, terms]: with n = dim the terms ix+iy <= dim-1 when all others are
+    # fill, else n = -dim and the whole matrix
+    dim = matrix.shape[0]
+    tri = _triangle(dim)
+    rest = matrix[~tri]
+    if numpy.all((rest == fill) | (numpy.isnan(rest) & (fill != fill))):
+        return [float(dim)] + matrix[tri].tolist()
+    return [float(-dim)] + matrix.ravel().tolist()
+
+
+def _unpack_matrix(params, i, fill):
+    dim = int(params[i])
+    if dim > 0:
+        matrix = numpy.empty((dim, dim), dtype='f8')
+        matrix.fill(fill)
+        tri = _triangle(dim)
+        nterm = int(tri.sum())
+        matrix[tri] = params[i+1:i+1+nterm]
+    else:
+        dim = -dim
+        nterm = dim*dim
+        matrix = params[i+1:i+1+nterm].reshape(dim, dim).copy()
+    return matrix, i+1+nterm
+
+
+def _pack_wcs(wcs):
+    # The CompactWCS buffer of wcs
+    hdr = wcs.wcs
+    vals = []
+    for key, n in _compact_strings:
+        text = hdr.get(key, '').encode('ascii')
+        if len(text) > 8*n:
+            raise ValueError('%s longer than %d characters' % (key, 8*n))
+        vals += numpy.frombuffer(text.ljust(8*n, b'\0'), dtype='f8').tolist()
+    vals += [float(hdr.get(key, numpy.nan)) for key in _compact_numbers]
+    vals += [wcs.longpole, wcs.latpole, wcs.theta0]
+    vals += [numpy.nan if wcs.inverse_tol is None else wcs.inverse_tol]
+
+    if wcs.projection == '-TAN-SIP':
+        for prefix in ['a', 'b', 'ap', 'bp']:
+            if prefix+'_order' not in hdr:
+                vals.append(0.0)
+                continue
+            order = int(hdr[prefix+'_order'])
+            matrix = numpy.empty((order+1, order+1), dtype='f8')
+            for ix in range(order+1):
+                for iy in range(order+1):
+                    matrix[ix, iy] = hdr.get('%s_%d_%d' % (prefix, ix, iy),
+                                             numpy.nan)
+            vals += _pack_matrix(matrix, numpy.nan)
+        header_inverse = 'ap_order' in hdr and 'bp_order' in hdr
+    else:
+        keys = _compact_scamp_keys()
+        vals += [float(hdr.get(key, numpy.nan)) for key in keys]
+        header_inverse = any(key in hdr for key in keys
+                             if key.startswith('pvi'))
+
+    # the fitted inverse, when not in the header
+    if wcs.distort.has_inverse() and not header_inverse:
+        vals += _pack_matrix(wcs.distort['ap'], 0.0)
+        vals += _pack_matrix(wcs.distort['bp'], 0.0)
+    else:
+        vals.append(0.0)
+    vals += [float(wcs.distort.get(key, numpy.nan))
+             for key in _compact_inverse_info]
+    return numpy.array(vals, dtype='f8')
+
+
+def _unpack_wcs(params):
+    # The header dict, angles, inverse_tol and distortion inverse entries
+    # of a CompactWCS buffer
+    hdr = {}
+    i = 0
+    for key, n in _compact_strings:
+        text = params[i:i+n].tobytes().rstrip(b'\0').decode('ascii')
+        if text:
+            hdr[key] = text
+        i += n
+    for key in _compact_numbers:
+        if params[i] == params[i]:
+            val = float(params[i])
+            hdr[key] = int(val) if key in _compact_int_keys else val
+        i += 1
+    angles = params[i:i+3].tolist()
+    i += 3
+    inverse_tol = None if params[i] != params[i] else float(params[i])
+    i += 1
+
+    if hdr['ctype1'][4:].upper() == '-TAN-SIP':
+        for prefix in ['a', 'b', 'ap', 'bp']:
+            if params[i] == 0:
+                i += 1
+                continue
+            matrix, i = _unpack_matrix(params, i, numpy.nan)
+            hdr[prefix+'_order'] = matrix.shape[0]-1
+            for ix, iy in zip(*numpy.nonzero(matrix == matrix)):
+                hdr['%s_%d_%d' % (prefix, ix, iy)] = float(matrix[ix, iy])
+    else:
+        for key in _compact_scamp_keys():
+            if params[i] == params[i]:
+                hdr[key] = float(params[i])
+            i += 1
+
+    inverse = {}
+    if params[i] != 0:
+        ap, i = _unpack_matrix(params, i, 0.0)
+        bp, i = _unpack_matrix(params, i, 0.0)
+        inverse.update(ap=ap, bp=bp, ap_order=ap.shape[0]-1,
+                       bp_order=bp.shape[0]-1)
+    else:
+        i += 1
+    for key in _compact_inverse_info:
+        if params[i] == params[i]:
+            val = float(params[i])
+            if key in ['inverse_order_increase', 'inverse_fac']:
+                val = int(val)
+            inverse[key] = val
+        i += 1
+    return hdr, angles, inverse_tol, inverse
+
+
+class PixelMapping(object):
+    """Fast mapping of the pixels of one WCS onto the pixels of another.
+
+    The exact mapping, wcs_dst.sky2image(*wcs_src.image2sky(x, y)), is only
+    evaluated on a grid of control nodes over the source image.  It is
+    first fit with a 2D polynomial of increasing order, up to max_order;
+    when no polynomial is good enough the nodes are interpolated with
+    bicubic splines instead, halving the node spacing as needed.  Each fit
+    is checked against the exact mapping at the cell centers, where the
+    error is largest, and accepted when that error is below tol
+    destination pixels.
+
+    Usage:
+        mapping = PixelMapping(wcs_ccd, wcs_tile, tol=1.0e-3)
+        xt, yt = mapping(x, y)
+        xt, yt = mapping.grid()       # every pixel of the source
+        mapping.maxerr                # worst error found in the check
+
+    Parameters
+    ----------
+    wcs_src, wcs_dst : WCS
+        The source and destination WCS.
+    shape : tuple, optional
+        (ny, nx) of the source image.  Default (naxis2, naxis1) of wcs_src.
+    tol : float, optional
+        Maximum allowed error in destination pixels.  Default 1.0e-3
+    step : int, optional
+        Initial spacing of the nodes in pixels.  Default 64.
+    max_order : int, optional
+        Highest polynomial order tried, 0 to go straight to the splines.
+        Default 7.
+    distort : bool, optional
+        Use the distortion models if present.  Default is True.
+
+    The method used ends up in the attribute method, 'poly', 'spline' or
+    'exact' when even a spline with nodes every few pixels is not good
+    enough.  Points outside the source image are mapped exactly rather
+    than extrapolated.
+    """
+
+    def __init__(self, wcs_src, wcs_dst, shape=None, tol=1.0e-3, step=64,
+                 max_order=7, distort=True):
+        from scipy.interpolate import RectBivariateSpline
+
+        self.wcs_src = wcs_src
+        self.wcs_dst = wcs_dst
+        self.distort = distort
+        self.tol = tol
+        if shape is None:
+            shape = (wcs_src['naxis2'], wcs_src['naxis1'])
+        self.shape = tuple(shape)
+        ny, nx = self.shape
+
+        # The polynomials are in coordinates scaled to [-1, 1]
+        self.center = (0.5*(nx+1.0), 0.5*(ny+1.0))
+        self.scale = (2.0/max(nx-1.0, 1.0), 2.0/max(ny-1.0, 1.0))
+
+        self.method = 'exact'
+        self.order = None
+        self.xpoly = self.ypoly = None
+        self.xspline = self.yspline = None
+        self.maxerr = 0.0
+        while True:
+            xn = _grid_nodes(nx, step)
+            yn = _grid_nodes(ny, step)
+            if step < 4 or xn.size >= nx or yn.size >= ny:
+                # Not worth interpolating, map exactly
+                self.maxerr = 0.0
+                break
+
+            xd, yd = self._exact_mesh(xn, yn)
+            xc = 0.5*(xn[1:] + xn[:-1])
+            yc = 0.5*(yn[1:] + yn[:-1])
+            xdc, ydc = self._exact_mesh(xc, yc)
+
+            if self.method == 'exact' and max_order > 0:
+                if self._fit_poly(xn, yn, xd, yd, xc, yc, xdc, ydc,
+                                  max_order):
+                    break
+
+            xspline = RectBivariateSpline(yn, xn, xd)
+            yspline = RectBivariateSpline(yn, xn, yd)
+            self.maxerr = numpy.hypot(xspline(yc, xc) - xdc,
+                                      yspline(yc, xc) - ydc).max()
+            if self.maxerr <= tol:
+                self.method = 'spline'
+                self.xspline = xspline
+                self.yspline = yspline
+                break
+
+            # The polynomials were tried once, on the coarsest grid
+            max_order = 0
+            step = step//2
+        self.step = step
+
+    def __repr__(self):
+        return ('PixelMapping(shape=%s, method=%s, order=%s, step=%d, '
+                'maxerr=%.3g)' % (self.shape, self.method, self.order,
+                                  self.step, self.maxerr))
+
+    def _fit_poly(self, xn, yn, xd, yd, xc, yc, xdc, ydc, max_order):
+        # Least squares polynomials of increasing order through the mesh
+        # of nodes xn, yn, checked on the mesh of centers xc, yc.  Sets
+        # the polynomials and returns True if one meets the tolerance.
+        u, v = self._scaled_mesh(xn, yn)
+        uc, vc = self._scaled_mesh(xc, yc)
+        rhs = numpy.column_stack((xd.ravel(), yd.ravel()))
+        for order in range(1, max_order+1):
+            amatrix = _poly_design(u, v, order)
+            coeffs = numpy.linalg.lstsq(amatrix, rhs, rcond=None)[0]
+            xpoly = Polynomial2D(_poly_matrix(coeffs[:, 0], order))
+            ypoly = Polynomial2D(_poly_matrix(coeffs[:, 1], order))
+            maxerr = max(numpy.hypot(xpoly(u, v) - xd.ravel(),
+                                     ypoly(u, v) - yd.ravel()).max(),
+                         numpy.hypot(xpoly(uc, vc) - xdc.ravel(),
+                                     ypoly(uc, vc) - ydc.ravel()).max())
+            if maxerr <= self.tol:
+                self.method = 'poly'
+                self.order = order
+                self.xpoly, self.ypoly = xpoly, ypoly
+                self.maxerr = maxerr
+                return True
+        return False
+
+    def _scaled_mesh(self, x1d, y1d):
+        x, y = numpy.meshgrid(x1d, y1d)
+        return ((x.ravel()-self.center[0])*self.scale[0],
+                (y.ravel()-self.center[1])*self.scale[1])
+
+    def __call__(self, x, y):
+        """Destination x,y of the source pixels x,y.
+        """
+        arescalar = isscalar(x)
+        x = numpy.atleast_1d(numpy.asarray(x, dtype='f8'))
+        y = numpy.atleast_1d(numpy.asarray(y, dtype='f8'))
+        if x.shape != y.shape:
+            raise ValueError('x and y must be the same shape')
+
+        if self.method == 'poly':
+            u = x - self.center[0]
+            u *= self.scale[0]
+            v = y - self.center[1]
+            v *= self.scale[1]
+            work = numpy.empty_like(u)
+            xd = self.xpoly(u, v, work=work)
+            yd = self.ypoly(u, v, work=work)
+        elif self.method == 'spline':
+            xd = self.xspline.ev(y, x)
+            yd = self.yspline.ev(y, x)
+        else:
+            xd, yd = self.exact(x, y)
+
+        if self.method != 'exact':
+            ny, nx = self.shape
+            w, = numpy.where(((x < 1.0) | (x > nx) |
+                              (y < 1.0) | (y > ny)).ravel())
+            if w.size > 0:
+                xdflat, ydflat = xd.reshape(-1), yd.reshape(-1)
+                xdflat[w], ydflat[w] = self.exact(x.ravel()[w],
+                                                  y.ravel()[w])
+
+        if arescalar:
+            return xd[0], yd[0]
+        return xd, yd
+
+    def exact(self, x, y):
+        """The exact mapping of x,y, through the sky.
+        """
+        lon, lat = self.wcs_src.image2sky(x, y, distort=self.distort)
+        return self.wcs_dst.sky2image(lon, lat, distort=self.distort)
+
+    def _exact_mesh(self, x1d, y1d):
+        # exact on the mesh of x1d, y1d, returns arrays of shape
+        # (y1d.size, x1d.size)
+        x, y = numpy.meshgrid(x1d, y1d)
+        xd, yd = self.exact(x.ravel(), y.ravel())
+        return xd.reshape(x.shape), yd.reshape(x.shape)
+
+    def grid(self, out=None, rows=None):
+        """Destination x,y of every pixel of the source image.
+
+        Parameters
+        ----------
+        out : tuple of arrays, optional
+            (x, y) arrays of shape (nrows, nx) to fill.
+        rows : tuple, optional
+            (j0, j1) to only map the rows j0:j1 of the source image.
+            Default all rows.
+
+        Returns
+        -------
+        x, y : arrays of shape (nrows, nx)
+            The value at [j, i] is that of pixel x=i+1, y=j0+j+1.
+        """
+        ny, nx = self.shape
+        if rows is None:
+            rows = (0, ny)
+        j0, j1 = rows
+        if out is None:
+            out = (numpy.empty((j1-j0, nx), dtype='f8'),
+                   numpy.empty((j1-j0, nx), dtype='f8'))
+        xout, yout = out
+        if xout.shape != (j1-j0, nx) or yout.shape != (j1-j0, nx):
+            raise ValueError('out arrays must have shape %s' %
+                             ((j1-j0, nx),))
+
+        xpix = numpy.arange(1, nx+1, dtype='f8')
+        # rows per block, ~1M pixels at a time
+        nrows = max(1, 2**20//max(nx, 1))
+
+        if self.method != 'spline':
+            for i0 in range(j0, j1, nrows):
+                i1 = min(i0+nrows, j1)
+                ypix = numpy.arange(i0+1, i1+1, dtype='f8')
+                x, y = numpy.meshgrid(xpix, ypix)
+                xd, yd = self(x, y)
+                xout[i0-j0:i1-j0] = xd
+                yout[i0-j0:i1-j0] = yd
+            return xout, yout
+
+        # On a grid the spline is By C Bx^T, see WCS.image2sky_grid
+        mats = []
+        for spline in (self.xspline, self.yspline):
+            ty, tx, c = spline.tck
+            mats.append((ty, numpy.dot(c.reshape(len(ty)-4, len(tx)-4),
+                                       _spline_basis(tx, xpix).T)))
+        for i0 in range(j0, j1, nrows):
+            i1 = min(i0+nrows, j1)
+            ypix = numpy.arange(i0+1, i1+1, dtype='f8')
+            for (ty, m), arr in zip(mats, out):
+                _dot_into(_spline_basis(ty, ypix), m, arr[i0-j0:i1-j0])
+        return xout, yout
+
+    def check(self, n=100000, seed=None):
+        """Maximum error, in destination pixels, at n random source points.
+        """
+        rng = numpy.random.RandomState(seed)
+        ny, nx = self.shape
+        x = rng.uniform(1.0, nx, n)
+        y = rng.uniform(1.0, ny, n)
+        xd, yd = self(x, y)
+        xe, ye = self.exact(x, y)
+        return numpy.hypot(xd-xe, yd-ye).max()
+
+
+def reproject(image, wcs_in, wcs_out, shape_out=None, kernel='bilinear',
+              weight=None, mask=None, conserve_flux=False,
+              fill=float('nan'), tol=1.0e-3, rows=None, nthreads=None,
+              min_coverage=0.5):
+    """Resample an image onto the pixel grid of another WCS.
+
+    The output is processed in bands of rows.  For each band the input
+    positions of the output pixels come from a PixelMapping, so the WCS
+    transforms are not run per pixel, and the input is interpolated with
+    the kernel.  The memory used on top of the input and output images is
+    bounded by the band size, and the bands can be run on a thread pool.
+
+    Parameters
+    ----------
+    image : 2-d array
+        The input image, on the pixels of wcs_in.
+    wcs_in, wcs_out : WCS
+        The input and output WCS.
+    shape_out : tuple, optional
+        (ny, nx) of the output image.  Default (naxis2, naxis1) of wcs_out.
+    kernel : str, optional
+        'nearest', 'bilinear' or 'lanczos3'.  Default 'bilinear'.
+    weight : 2-d array, optional
+        Weight plane of the input, e.g. inverse variance.  Default 1.
+    mask : 2-d array, optional
+        Bad pixel mask of the input, pixels where it is nonzero get zero
+        weight.  Non finite pixels of the image are always masked.
+    conserve_flux : bool, optional
+        Scale by the ratio of the output to input pixel areas, for images
+        in counts per pixel rather than surface brightness.  Default False.
+    fill : float, optional
+        Value of the output pixels with no valid input.  Default NaN.
+    tol : float, optional
+        Tolerance of the PixelMapping in input pixels.  Default 1.0e-3
+    rows : int, optional
+        Output rows per band.  Default ~256k pixels per band.
+    nthreads : int, optional
+        Number of threads to run the bands on.  Default None, no threads.
+    min_coverage : float, optional
+        Fraction of the kernel that must fall on valid input pixels for an
+        output pixel to be valid.  Default 0.5
+
+    Returns
+    -------
+    image_out, weight_out : arrays of shape shape_out
+        The resampled image and weight.  The output weight is the input
+        weight interpolated with the same kernel, zero where there is no
+        valid input.
+
+    Example:
+        stamp, wstamp = wcsutil.reproject(im, wcs_ccd, wcs_stamp, (101, 101),
+                                          kernel='lanczos3', weight=wt)
+    """
+    image = numpy.asarray(image)
+    if image.ndim != 2:
+        raise ValueError('image must be 2-d')
+    if kernel not in _resample_kernels:
+        raise ValueError("kernel must be one of %s" %
+                         sorted(_resample_kernels.keys()))
+    if shape_out is None:
+        shape_out = (wcs_out['naxis2'], wcs_out['naxis1'])
+    ny_out, nx_out = shape_out
+
+    # input weights, zero for the masked and non finite pixels, and
+    # padded with zeros so the taps of the points _resample clips to half
+    # a kernel outside the image stay in the array: 2*half+1 on each side
+    good = numpy.isfinite(image)
+    if mask is not None:
+        good &= (numpy.asarray(mask) == 0)
+    if weight is None:
+        wt = good.astype('f4')
+    else:
+        wt = numpy.where(good, weight, 0.0)
+    pad = 2*_resample_kernels[kernel][0] + 1
+    wtpad = numpy.pad(wt, pad, mode='constant')
+    impad = numpy.pad(numpy.where(good, image, 0.0), pad, mode='constant')
+    del good, wt
+
+    dtype = numpy.result_type(image.dtype, numpy.float32)
+    image_out = numpy.empty(shape_out, dtype=dtype)
+    weight_out = numpy.empty(shape_out, dtype=wtpad.dtype)
+
+    mapping = PixelMapping(wcs_out, wcs_in, shape=shape_out, tol=tol)
+    if rows is None:
+        rows = max(1, 2**18//max(nx_out, 1))
+
+    def run_band(j0):
+        j1 = min(j0+rows, ny_out)
+        xin, yin = mapping.grid(rows=(j0, j1))
+        value, wt = _resample(impad, wtpad, pad, image.shape, xin-1.0,
+                              yin-1.0, kernel, min_coverage)
+        if conserve_flux:
+            xout, yout = numpy.meshgrid(
+                numpy.arange(1, nx_out+1, dtype='f8'),
+                numpy.arange(j0+1, j1+1, dtype='f8'))
+            value *= wcs_out.pixel_area(xout, yout, units='degree')
+            value /= wcs_in.pixel_area(xin, yin, units='degree')
+        value[wt <= 0.0] = fill
+        image_out[j0:j1] = value
+        weight_out[j0:j1] = wt
+
+    _run_blocks(run_band, range(0, ny_out, rows), nthreads)
+    return image_out, weight_out
+
+
+def header2dict(wcs_in, minimal=False):
+    """Convert a header or wcs structure to a dictionary with lower case keys.
+
+    The input can be a numpy array with fields, a dictionary, or something
+    that supports iteration or has an items() method such as a fitsio or
+    pyfits header.
+
+    With minimal=True only the keywords the WCS needs are looked up (those
+    in _wcs_keys and the distortion coefficients of the projection in
+    ctype1), rather than converting every card; keys are matched in lower
+    or upper case.
+    """
+    if minimal:
+        return _minimal_header(wcs_in)
+
+    wcs = {}
+    if type(wcs_in) == numpy.ndarray or hasattr(wcs_in, 'dtype'):
+        if wcs_in.dtype.fields is None:
+            raise ValueError('wcs array must have fields')
+
+        for f in wcs_in.dtype.fields:
+            fl = f.lower()
+            val = wcs_in[f]
+            if val.ndim == 0:
+                wcs[fl] = val
+            else:
+                # only scalars
+                wcs[fl] = val[0]
+
+    elif type(wcs_in) == type({}):
+        wcs = wcs_in.copy()
+    elif hasattr(wcs_in, '__iter__'):
+        wcs = {}
+        for k in wcs_in:
+            wcs[k.lower()] = wcs_in[k]
+    else:
+        # Try to use the items() method to get what we want
+        wcs = {}
+        try:
+            for k, v in list(wcs_in.items()):
+                wcs[k.lower()] = v
+        except:
+            raise ValueError('Input wcs must be a numpy array ' +
+                             'with fields or a dictionary or support ' +
+                             'iteration or an items() method')
+
+    return wcs
+
+
+def header_value(hdr, key, default=None):
+    """Value of key in a header of any of the types header2dict accepts.
+
+    The key is looked up as given and in upper case, and default returned
+    if it is not there.
+    """
+    if isinstance(hdr, numpy.ndarray) or hasattr(hdr, 'dtype'):
+        names = hdr.dtype.names or ()
+        for name in names:
+            if name.lower() == key.lower():
+                val = hdr[name]
+                if numpy.ndim(val) > 0:
+                    val = val[0]
+                return val
+        return default
+
+    for k in (key, key.upper()):
+        try:
+            return hdr[k]
+        except (KeyError, IndexError, ValueError, TypeError):
+            pass
+    return default
+
+
+def _minimal_header(hdr):
+    # header2dict(hdr, minimal=True): look up the keys the WCS needs
+    # instead of going through all the cards
+    missing = object()
+    if isinstance(hdr, numpy.ndarray) or hasattr(hdr, 'dtype'):
+        names = dict((name.lower(), name) for name in hdr.dtype.names or ())
+
+        def lookup(key):
+            if key not in names:
+                return missing
+            val = hdr[names[key]]
+            if numpy.ndim(val) > 0:
+                val = val[0]
+            # NaN marks the keys this row does not have, as in
+            # build_wcs_list
+            if isinstance(val, (float, numpy.floating)) and val != val:
+                return missing
+            return val
+    else:
+        def lookup(key):
+            for k in (key, key.upper()):
+                try:
+                    return hdr[k]
+                except (KeyError, IndexError, ValueError, TypeError):
+                    pass
+            return missing
+
+    wcs = {}
+
+    def get(key):
+        val = lookup(key)
+        if val is not missing:
+            if hasattr(val, 'item'):
+                val = val.item()
+            if isinstance(val, bytes):
+                val = val.decode('utf-8').strip()
+            if key.endswith('_order'):
+                # float in tables, e.g. of SIP and TPV rows filled with NaN
+                val = int(val)
+            wcs[key] = val
+        return val
+
+    for key in _wcs_keys:
+        get(key)
+
+    ctype = wcs.get('ctype1', '')
+    if ctype[4:].strip().upper() == '-TAN-SIP':
+        for prefix in ['a', 'b', 'ap', 'bp']:
+            order = get(prefix+'_order')
+            if order is missing:
+                continue
+            for ix in range(order+1):
+                for iy in range(order+1-ix):
+                    get('%s_%d_%d' % (prefix, ix, iy))
+    else:
+        for prefix in ['pv1', 'pv2', 'pvi1', 'pvi2']:
+            for i in range(_scamp_max_ncoeff):
+                if i not in _scamp_skip:
+                    get('%s_%d' % (prefix, i))
+    return wcs
+
+
+def is_header_table(headers):
+    """True if headers is a table of headers, one row per header.
+
+    That is a numpy array with fields (of more than one row), an astropy
+    Table, or a dictionary of columns.
+    """
+    if isinstance(headers, dict):
+        return (len(headers) > 0 and
+                all(numpy.ndim(v) == 1 for v in headers.values()))
+    if hasattr(headers, 'dtype') and hasattr(headers, 'ndim'):
+        return headers.dtype.names is not None and headers.ndim == 1
+    return hasattr(headers, 'colnames')
+
+
+def header_columns(table, keys=None):
+    """Columns of a table of headers as lists, by lower case key.
+
+    Only the WCS keywords are returned unless keys lists the ones wanted.
+    Strings are decoded and stripped, and each column is converted to
+    python values in one call.
+    """
+    if isinstance(table, dict):
+        names = list(table.keys())
+    elif hasattr(table, 'colnames'):
+        names = list(table.colnames)
+    else:
+        names = list(table.dtype.names)
+
+    columns = {}
+    for name in names:
+        key = name.lower()
+        if keys is None:
+            if key not in _wcs_keys and not _distort_key_re.match(key):
+                continue
+        elif key not in keys:
+            continue
+        col = numpy.asarray(table[name])
+        if col.dtype.kind == 'S':
+            col = numpy.char.decode(col, 'utf-8')
+        if col.dtype.kind == 'U':
+            col = numpy.char.strip(col)
+        col = col.tolist()
+        if key.endswith('_order'):
+            # the SIP orders are float when the column has NaN for the
+            # rows without them
+            col = [int(v) if v == v else v for v in col]
+        columns[key] = col
+    return columns
+
+
+def build_wcs_list(headers, longpole=180.0, latpole=90.0, theta0=90.0,
+                   inverse_tol=None):
+    """Build the WCS of each of a batch of headers.
+
+    headers is a table with one row per header (see is_header_table), such
+    as a structured array or astropy Table of CCD headers, or a sequence of
+    headers.  For a table the WCS keywords are extracted column by column,
+    with no per card Python work; NaN entries, e.g. the distortion terms
+    some rows do not have, are dropped.  Headers are read with
+    header2dict(minimal=True).  Returns a list of WCS objects.
+    """
+    if not is_header_table(headers):
+        return [WCS(header2dict(hdr, minimal=True), longpole=longpole,
+                    latpole=latpole, theta0=theta0, inverse_tol=inverse_tol)
+                for hdr in headers]
+
+    columns = header_columns(headers)
+    keys = list(columns.keys())
+    wcslist = []
+    for row in zip(*[columns[k] for k in keys]):
+        # v == v drops the NaNs
+        wcs = dict((k, v) for k, v in zip(keys, row) if v == v)
+        wcslist.append(WCS(wcs, longpole=longpole, latpole=latpole,
+                           theta0=theta0, inverse_tol=inverse_tol))
+    return wcslist
+
+
+def bench_ingest(hdr=None, ncards=300, n=200):
+    """Time building WCS objects from a full header and from a table.
+
+    By default uses a DECam-like TPV header padded with ncards other
+    cards.  Compares WCS(hdr), WCS(hdr, minimal=True) and build_wcs_list
+    on a structured array of n rows.  The inverse is not fit, as when it
+    is only needed by sky2image(find=False).
+    """
+    import time
+
+    if hdr is None:
+        class Header(dict):
+            # cards stored in upper case, looked up in either case, as
+            # for a FITS header object
+            def __getitem__(self, key):
+                return dict.__getitem__(self, key.upper())
+
+        hdr = Header((k.upper(), v) for k, v in _bench_header().items())
+        for i in range(ncards):
+            hdr['KEY%04d' % i] = float(i)
+
+    t0 = time.time()
+    for i in range(n):
+        WCS(hdr)
+    tfull = (time.time()-t0)/n
+
+    t0 = time.time()
+    for i in range(n):
+        WCS(hdr, minimal=True)
+    tmin = (time.time()-t0)/n
+
+    row = _minimal_header(hdr)
+    dtype = [(k, 'U16' if isinstance(v, str) else 'f8')
+             for k, v in row.items()]
+    table = numpy.zeros(n, dtype=dtype)
+    for k, v in row.items():
+        table[k] = v
+    t0 = time.time()
+    build_wcs_list(table)
+    ttable = (time.time()-t0)/n
+
+    sys.stdout.write('%d cards\n' % len(hdr))
+    sys.stdout.write('WCS(hdr):               %.3f ms\n' % (1000*tfull))
+    sys.stdout.write('WCS(hdr, minimal=True): %.3f ms\n' % (1000*tmin))
+    sys.stdout.write('build_wcs_list(table):  %.3f ms per row\n' %
+                     (1000*ttable))
+    return tfull, tmin, ttable
+
+
+class WCSCache(object):
+    """A bounded LRU cache of WCS objects keyed by their header.
+
+    Building a WCS is expensive when the distortion has to be inverted, and
+    pipelines often build the same one many times.  The key is a hash of the
+    WCS keywords of the header (see wcs_header_key), so headers that differ
+    only in other keywords share the same object.
+
+    The cached objects are shared, so they must not be modified.
+
+    Usage:
+        cache = WCSCache(maxsize=128)
+        wcs = cache.get(hdr)
+        cache.cache_info()
+    """
+
+    def __init__(self, maxsize=128):
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self.maxsize = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.resize(maxsize)
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, hdr, longpole=180.0, latpole=90.0, theta0=90.0):
+        """Return the cached WCS for hdr, building it if needed.
+
+        Only the WCS keywords of hdr are read, see header2dict.
+        """
+        wcs = header2dict(hdr, minimal=True)
+        key = wcs_header_key(wcs, longpole=longpole, latpole=latpole,
+                             theta0=theta0)
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+
+        # Build outside of the lock, the inversion can be slow
+        obj = WCS(wcs, longpole=longpole, latpole=latpole, theta0=theta0)
+
+        with self._lock:
+            if key in self._data:
+                # another thread built it in the meantime, use that one
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+            self._data[key] = obj
+            self._trim()
+        return obj
+
+    def resize(self, maxsize):
+        """Change the maximum number of entries, evicting the oldest.
+        """
+        if maxsize < 0:
+            raise ValueError('maxsize must be >= 0')
+        with self._lock:
+            self.maxsize = maxsize
+            self._trim()
+
+    def clear(self):
+        """Remove all entries and reset the counters.
+        """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def cache_info(self):
+        """Dictionary with the hits, misses, evictions, size and maxsize.
+        """
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'size': len(self._data),
+                    'maxsize': self.maxsize}
+
+    def _trim(self):
+        # Must be called holding the lock
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+
+def wcs_header_key(hdr, longpole=180.0, latpole=90.0, theta0=90.0):
+    """A canonical hash of the WCS keywords of a header.
+
+    Only the keywords in _wcs_keys and the distortion coefficients are used.
+    Numbers are compared as floats and strings with surrounding blanks
+    removed, so the same WCS gives the same key whatever the header type.
+    """
+    if not isinstance(hdr, dict):
+        hdr = header2dict(hdr)
+
+    items = [('_angles', repr((float(longpole), float(latpole),
+                               float(theta0))))]
+    for key in sorted(hdr):
+        if key in _wcs_keys or _distort_key_re.match(key):
+            items.append((key, _canonical_value(hdr[key])))
+
+    return hashlib.sha1(repr(items).encode('utf-8')).hexdigest()
+
+
+def _canonical_value(val):
+    if hasattr(val, 'item'):
+        # numpy scalar
+        val = val.item()
+    if isinstance(val, bytes):
+        val = val.decode('utf-8')
+    if isinstance(val, str):
+        return val.strip()
+    if isinstance(val, (int, float)) and not isinstance(val, bool):
+        return repr(float(val))
+    return repr(val)
+
+
+# Process-wide cache used by get_wcs
+_wcs_cache = WCSCache()
+
+
+def get_wcs(hdr, longpole=180.0, latpole=90.0, theta0=90.0):
+    """Return a WCS for hdr from the process-wide cache.
+
+    The returned object is shared with other callers and must not be
+    modified.  See wcs_cache_info, wcs_cache_clear and wcs_cache_resize.
+    """
+    return _wcs_cache.get(hdr, longpole=longpole, latpole=latpole,
+                          theta0=theta0)
+
+
+def wcs_cache_info():
+    """Counters of the process-wide WCS cache.
+    """
+    return _wcs_cache.cache_info()
+
+
+def wcs_cache_clear():
+    """Empty the process-wide WCS cache.
+    """
+    _wcs_cache.clear()
+
+
+def wcs_cache_resize(maxsize):
+    """Set the maximum size of the process-wide WCS cache.
+    """
+    _wcs_cache.resize(maxsize)
+
+
+class InverseStore(object):
+    """A directory of .npz files holding fitted inverse distortions.
+
+    Each file holds the ap, bp matrices and the rms of the fit, and is named
+    after a hash of everything the fit depends on: the distortion name, the
+    forward a, b matrices, the CD matrix, CRPIX, NAXIS and the fit
+    parameters.  Files are written to a temporary file in the same
+    directory and renamed into place, so any number of processes can share
+    the directory and readers never see a partial file.
+
+    Usage:
+        set_inverse_store('/path/to/cache')
+        # WCS objects without inverse coefficients now use the store
+        wcs = WCS(hdr)
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.abspath(os.path.expanduser(directory))
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                # another process may have created it in the meantime
+                if not os.path.isdir(self.directory):
+                    raise
+
+    def __repr__(self):
+        return 'InverseStore(%r)' % self.directory
+
+    def key(self, wcs, fac=5, order_increase=1, tol=None):
+        """Hash of the quantities that determine the inverse of wcs.
+        """
+        h = hashlib.sha1()
+        h.update(wcs.distort['name'].encode('utf-8'))
+        params = [fac, order_increase]
+        if tol is not None:
+            # adaptive fit, FitInverse
+            params.append(tol)
+        for arr in [wcs.distort['a'], wcs.distort['b'], wcs.cd, wcs.crpix,
+                    [wcs.wcs['naxis1'], wcs.wcs['naxis2']], params]:
+            h.update(numpy.ascontiguousarray(arr, dtype='f8').tobytes())
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.directory, key+'.npz')
+
+    def load(self, key):
+        """Return (ap, bp, rms) for key, or None if not stored.
+        """
+        fname = self.filename(key)
+        if not os.path.exists(fname):
+            return None
+        try:
+            with numpy.load(fname) as data:
+                return data['ap'], data['bp'], float(data['rms'])
+        except Exception:
+            # A damaged file is treated as missing and will be rewritten
+            return None
+
+    def save(self, key, ap, bp, rms):
+        """Atomically write the inverse coefficients for key.
+
+        The store is only a cache, so a directory that cannot be written,
+        e.g. read only or full, is not an error: the file is not written
+        and False is returned.  True when it was written.
+        """
+        import tempfile
+        tmpname = None
+        try:
+            fd, tmpname = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+            with os.fdopen(fd, 'wb') as fobj:
+                numpy.savez(fobj, ap=ap, bp=bp, rms=rms)
+                fobj.flush()
+                os.fsync(fobj.fileno())
+            # mkstemp creates the file readable by the owner only
+            os.chmod(tmpname, 0o644)
+            os.replace(tmpname, self.filename(key))
+        except OSError:
+            if tmpname is not None:
+                try:
+                    os.remove(tmpname)
+                except OSError:
+                    pass
+            return False
+        return True
+
+    def clear(self):
+        """Remove all the stored inverses.
+        """
+        for fname in os.listdir(self.directory):
+            if fname.endswith('.npz'):
+                try:
+                    os.remove(os.path.join(self.directory, fname))
+                except OSError:
+                    pass
+
+
+# The persistent store used by WCS.LoadOrInvertDistortion, off by default.
+# It can be turned on with set_inverse_store or the DESPYASTRO_INVERSE_STORE
+# environment variable.
+# _unset until it is set or first looked up, so that turning it off with
+# set_inverse_store(None) is not undone by the environment variable.
+_unset = object()
+_inverse_store = _unset
+
+
+def set_inverse_store(directory):
+    """Use directory to store inverse distortions, None to turn it off.
+
+    This overrides the DESPYASTRO_INVERSE_STORE environment variable.
+    """
+    global _inverse_store
+    if directory is None:
+        _inverse_store = None
+    else:
+        _inverse_store = InverseStore(directory)
+    return _inverse_store
+
+
+def get_inverse_store():
+    """The current InverseStore or None.
+    """
+    global _inverse_store
+    if _inverse_store is _unset:
+        directory = os.environ.get('DESPYASTRO_INVERSE_STORE')
+        _inverse_store = InverseStore(directory) if directory else None
+    return _inverse_store
+
+
+class TransformBackend(object):
+    """Base class of the backends that run the WCS transforms.
+
+    A backend provides image2sky(wcs, x, y, distort=True, out=None), the
+    full pixel to sky transform, and sph2image(wcs, lon, lat), the sky to
+    tangent plane stage of sky2image.  Backends with fused = True do the
+    whole transform in one pass over the data; the others are chains of
+    numpy passes.  Register new backends with register_backend.
+    """
+    name = None
+    fused = False
+
+    def __repr__(self):
+        return '%s(name=%r)' % (self.__class__.__name__, self.name)
+
+    def image2sky(self, wcs, x, y, distort=True, out=None):
+        raise NotImplementedError('implement image2sky')
+
+    def sph2image(self, wcs, lon, lat):
+        raise NotImplementedError('implement sph2image')
+
+
+class NumpyBackend(TransformBackend):
+    """The transforms as chains of in place numpy passes.  Always available.
+    """
+    name = 'numpy'
+    fused = False
+
+    def image2sky(self, wcs, x, y, distort=True, out=None):
+        return wcs._image2sky_block(x, y, distort, numpy.float64, out=out)
+
+    def sph2image(self, wcs, lon, lat):
+        return wcs.sph2image(lon, lat)
+
+
+class NumbaBackend(TransformBackend):
+    """The transforms fused into one compiled loop per point with numba.
+
+    Each point goes through the CRPIX offset, CD matrix, distortion
+    polynomials, projection and rotation in registers, so large transforms
+    are limited by the arithmetic rather than by memory bandwidth.  The
+    kernels release the GIL and combine with nthreads.  They are compiled
+    on first use, which takes a second or so once per process.
+
+    Raises ImportError if numba is not installed.
+    """
+    name = 'numba'
+    fused = True
+
+    def __init__(self):
+        import numba
+        jit = numba.njit(nogil=True, cache=False)
+        self._image2sky, self._sph2image = _make_fused_kernels(jit)
+
+    def image2sky(self, wcs, x, y, distort=True, out=None):
+        xflat = numpy.ascontiguousarray(x, dtype='f8').reshape(-1)
+        yflat = numpy.ascontiguousarray(y, dtype='f8').reshape(-1)
+        lon, lat, lonflat, latflat = _fused_outputs(x.shape, out)
+
+        crpix, cd, mode, a, b, r = wcs._fused_params(distort)
+        self._image2sky(xflat, yflat, crpix, cd, mode, a, b, r,
+                        lonflat, latflat)
+
+        if not numpy.may_share_memory(lonflat, lon):
+            lon[...] = lonflat.reshape(lon.shape)
+        if not numpy.may_share_memory(latflat, lat):
+            lat[...] = latflat.reshape(lat.shape)
+        return lon, lat
+
+    def sph2image(self, wcs, lon, lat):
+        lon = numpy.atleast_1d(numpy.asarray(lon, dtype='f8'))
+        lat = numpy.atleast_1d(numpy.asarray(lat, dtype='f8'))
+        if lon.size != lat.size:
+            raise ValueError('long,lat must be the same size')
+        u = numpy.empty(lon.shape, dtype='f8')
+        v = numpy.empty(lon.shape, dtype='f8')
+        self._sph2image(numpy.ascontiguousarray(lon).reshape(-1),
+                        numpy.ascontiguousarray(lat).reshape(-1),
+                        numpy.ascontiguousarray(wcs.rotation_matrix),
+                        u.reshape(-1), v.reshape(-1))
+        return u, v
+
+
+# name -> backend class, in order of preference for the default
+_backends = collections.OrderedDict()
+_backend_instances = {}
+_default_backend = None
+
+
+def register_backend(name, cls, first=False):
+    """Register a TransformBackend subclass under name.
+
+    The class is only instantiated when the backend is first used, and
+    should raise ImportError there if it cannot run.  With first=True the
+    backend is preferred over those already registered when picking the
+    default.
+    """
+    _backends[name] = cls
+    if first:
+        _backends.move_to_end(name, last=False)
+    _backend_instances.pop(name, None)
+
+
+def available_backends():
+    """Names of the registered backends that can run here.
+    """
+    names = []
+    for name in _backends:
+        try:
+            _load_backend(name)
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+
+def set_backend(name):
+    """Set the default transform backend, None to pick it again.
+
+    Raises ImportError if the backend cannot run, e.g. 'numba' when numba
+    is not installed.
+    """
+    global _default_backend
+    if name is None:
+        _default_backend = None
+    else:
+        _default_backend = _load_backend(name)
+    return _default_backend
+
+
+def get_backend(name=None):
+    """The TransformBackend called name, or the default one for None.
+
+    The default is the one given to set_backend, else the one named by the
+    DESPYASTRO_WCS_BACKEND environment variable, else the first registered
+    backend that can run: 'numba' when numba is installed, falling back to
+    'numpy'.
+    """
+    global _default_backend
+    if isinstance(name, TransformBackend):
+        return name
+    if name is not None:
+        return _load_backend(name)
+
+    if _default_backend is None:
+        envname = os.environ.get('DESPYASTRO_WCS_BACKEND')
+        if envname:
+            _default_backend = _load_backend(envname)
+        else:
+            for bname in _backends:
+                try:
+                    _default_backend = _load_backend(bname)
+                except ImportError:
+                    continue
+                break
+    return _default_backend
+
+
+def _load_backend(name):
+    if name not in _backends:
+        raise ValueError("unknown backend '%s', expected one of %s" %
+                         (name, list(_backends.keys())))
+    backend = _backend_instances.get(name)
+    if backend is None:
+        backend = _backends[name]()
+        _backend_instances[name] = backend
+    return backend
+
+
+register_backend('numba', NumbaBackend)
+register_backend('numpy', NumpyBackend)
+
+
+def _fused_outputs(shape, out):
+    # Output arrays of the given shape and flat contiguous views of them
+    # (or temporary buffers when the outputs are not contiguous doubles)
+    if out is None:
+        lon = numpy.empty(shape, dtype='f8')
+        lat = numpy.empty(shape, dtype='f8')
+    else:
+        lon, lat = out
+    flat = []
+    for arr in (lon, lat):
+        if arr.flags['C_CONTIGUOUS'] and arr.dtype == numpy.float64:
+            flat.append(arr.reshape(-1))
+        else:
+            flat.append(numpy.empty(arr.size, dtype='f8'))
+    return lon, lat, flat[0], flat[1]
+
+
+def _make_fused_kernels(jit):
+    """The fused image2sky and sph2image kernels compiled with jit.
+
+    The kernels are plain python loops over the points; send jit=numba.njit
+    (or any decorator with the same behaviour) to compile them, or an
+    identity function to get a slow pure python reference.
+    """
+
+    @jit
+    def horner2d(a, x, y):
+        # sum of a[ix, iy]*x**ix*y**iy
+        val = 0.0
+        for ix in range(a.shape[0]-1, -1, -1):
+            row = 0.0
+            for iy in range(a.shape[1]-1, -1, -1):
+                row = row*y + a[ix, iy]
+            val = val*x + row
+        return val
+
+    @jit
+    def image2sky(x, y, crpix, cd, mode, a, b, r, lon, lat):
+        for i in range(x.shape[0]):
+            xd = x[i] - crpix[0]
+            yd = y[i] - crpix[1]
+            if mode == 2:
+                # SIP, before the CD matrix
+                xs = xd + horner2d(a, xd, yd)
+                yd = yd + horner2d(b, xd, yd)
+                xd = xs
+            u = cd[0, 0]*xd + cd[0, 1]*yd
+            v = cd[1, 0]*xd + cd[1, 1]*yd
+            if mode == 1:
+                # PV, after the CD matrix
+                us = horner2d(a, u, v)
+                v = horner2d(b, u, v)
+                u = us
+
+            # native spherical coordinates, as in image2sph
+            theta = math.atan2(1.0, math.hypot(u, v)*d2r)
+            phi = math.atan2(u, -v)
+
+            # rotate with the transpose of r, as in _rotate
+            ctheta = math.cos(theta)
+            l = math.cos(phi)*ctheta
+            m = math.sin(phi)*ctheta
+            n = math.sin(theta)
+            b0 = r[0, 0]*l + r[0, 1]*m + r[0, 2]*n
+            b1 = r[1, 0]*l + r[1, 1]*m + r[1, 2]*n
+            b2 = r[2, 0]*l + r[2, 1]*m + r[2, 2]*n
+            b2 = min(max(b2, -1.0), 1.0)
+
+            lonval = math.atan2(b1, b0)*r2d
+            if lonval < 0.0:
+                lonval += 360.0
+            elif lonval >= 360.0:
+                lonval -= 360.0
+            lon[i] = lonval
+            lat[i] = math.asin(b2)*r2d
+
+    @jit
+    def sph2image(lon, lat, r, u, v):
+        for i in range(lon.shape[0]):
+            # rotate to the native system, as in Rotate
+            ra = lon[i]*d2r
+            dec = lat[i]*d2r
+            cdec = math.cos(dec)
+            l = math.cos(ra)*cdec
+            m = math.sin(ra)*cdec
+            n = math.sin(dec)
+            b0 = r[0, 0]*l + r[1, 0]*m + r[2, 0]*n
+            b1 = r[0, 1]*l + r[1, 1]*m + r[2, 1]*n
+            b2 = r[0, 2]*l + r[1, 2]*m + r[2, 2]*n
+
+            # tangent plane, zero for the far hemisphere as in sph2image
+            if b2 > 0.0:
+                u[i] = r2d*b1/b2
+                v[i] = -r2d*b0/b2
+            else:
+                u[i] = 0.0
+                v[i] = 0.0
+
+    return image2sky, sph2image
+
+
+def _angle_units(units):
+    # Number of units in a degree
+    if units == 'arcsec':
+        return 3600.0
+    elif units == 'arcmin':
+        return 60.0
+    elif units == 'degree':
+        return 1.0
+    else:
+        raise ValueError("must define units as arcsec/arcmin/degree only")
+
+
 def _dict_get(d, key, default=None):
     if key not in d:
         if default is not None:
@@ -1056,6 +3603,321 @@ def Apply2DPolynomial(a, x, y):
     return v
 
 
+def Differentiate2DPolynomial(a):
+    """Coefficient matrices of the x and y derivatives of a 2D polynomial.
+
+    The polynomial is sum a[ix,iy] x**ix y**iy as evaluated by
+    Apply2DPolynomial.  The returned matrices have the same shape as a.
+    """
+    sx, sy = a.shape
+    dadx = numpy.zeros_like(a)
+    dady = numpy.zeros_like(a)
+    for ix in range(1, sx):
+        dadx[ix-1, :] = ix*a[ix, :]
+    for iy in range(1, sy):
+        dady[:, iy-1] = iy*a[:, iy]
+    return dadx, dady
+
+
+class Polynomial2D(object):
+    """A 2D polynomial compiled once from its coefficient matrix.
+
+    Evaluates sum a[ix,iy] x**ix y**iy like Apply2DPolynomial, but the list
+    of nonzero terms is worked out at construction and the evaluation is a
+    nested Horner scheme, (..(r_n*x + r_n-1)*x + ..)*x + r_0 where each row
+    r_ix is itself a Horner polynomial in y.  All the arithmetic is done in
+    place in two buffers, which can be supplied by the caller.
+
+    Usage:
+        poly = Polynomial2D(a)
+        v = poly(x, y)
+        poly(x, y, out=v, work=tmp)
+    """
+
+    def __init__(self, a):
+        self.a = numpy.array(a, dtype='f8', ndmin=2)
+
+        # For each power of x keep the y coefficients up to the highest
+        # nonzero one; None flags an all-zero row
+        self.rows = []
+        for ix in range(self.a.shape[0]):
+            w, = numpy.where(self.a[ix, :] != 0.0)
+            if w.size > 0:
+                self.rows.append(self.a[ix, 0:w[-1]+1].copy())
+            else:
+                self.rows.append(None)
+
+        # strip trailing zero rows so the Horner scheme starts at the
+        # highest nonzero power of x
+        while len(self.rows) > 0 and self.rows[-1] is None:
+            self.rows.pop()
+
+        self.nterms = int((self.a != 0.0).sum())
+
+    def __repr__(self):
+        return 'Polynomial2D(nterms=%d, order=%s)' % (self.nterms,
+                                                      self.a.shape)
+
+    def __call__(self, x, y, out=None, work=None):
+        """Evaluate the polynomial at x,y.
+
+        out and work are optional arrays of the broadcast shape of x,y used
+        for the result and for the row evaluations.  The result is returned.
+        """
+        x = numpy.asanyarray(x)
+        y = numpy.asanyarray(y)
+        shape = numpy.broadcast(x, y).shape
+        dtype = numpy.result_type(x, y, numpy.float32)
+        if out is None:
+            out = numpy.empty(shape, dtype=dtype)
+
+        if len(self.rows) == 0:
+            out.fill(0.0)
+            return out
+
+        self._eval_row(self.rows[-1], y, out)
+        if len(self.rows) == 1:
+            return out
+
+        if work is None:
+            work = numpy.empty(shape, dtype=dtype)
+        for ix in range(len(self.rows)-2, -1, -1):
+            out *= x
+            row = self.rows[ix]
+            if row is not None:
+                out += self._eval_row(row, y, work)
+        return out
+
+    def _eval_row(self, coeffs, y, buff):
+        # Horner scheme in y, skipping the zero coefficients
+        buff.fill(coeffs[-1])
+        for iy in range(coeffs.size-2, -1, -1):
+            buff *= y
+            if coeffs[iy] != 0.0:
+                buff += coeffs[iy]
+        return buff
+
+
+# Points per block for the threaded transforms.  With the seven buffers of
+# image2sky this is ~3.5 MB per thread, which stays in cache.
+_default_chunk_size = 65536
+
+
+def _run_blocks(func, starts, nthreads=None):
+    # Call func(start) for every start, on a thread pool if nthreads > 1
+    if nthreads is None or nthreads <= 1:
+        for start in starts:
+            func(start)
+        return
+
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        # list() to raise any exception from the threads
+        list(pool.map(func, starts))
+
+
+def _image2sky_buffers(shape, dtype):
+    # Scratch buffers for WCS._image2sky_block: five of the tangent plane
+    # dtype and, if that is not double, four doubles for the spherical stage
+    dtype = numpy.dtype(dtype)
+    buffers = [numpy.empty(shape, dtype=dtype) for i in range(5)]
+    if dtype != numpy.float64:
+        buffers += [numpy.empty(shape, dtype='f8') for i in range(4)]
+    return buffers
+
+
+def _iter_blocks(x_iter, y_iter, chunk):
+    # Yield matching 1-d float64 blocks of chunk elements, the last one
+    # possibly shorter, from two arrays or two iterables of arrays.  Pieces
+    # larger than chunk are split and smaller ones merged.
+    if isinstance(x_iter, numpy.ndarray):
+        x_iter = [x_iter]
+    if isinstance(y_iter, numpy.ndarray):
+        y_iter = [y_iter]
+
+    # pieces held until they add up to a block, and their size; copies, as
+    # the iterables may reuse their arrays
+    xpend = []
+    ypend = []
+    npend = 0
+    end = object()
+    for xpiece, ypiece in itertools.zip_longest(x_iter, y_iter,
+                                                fillvalue=end):
+        if xpiece is end or ypiece is end:
+            raise ValueError('x and y must have the same number of pieces')
+        # converted to float64 a block at a time, e.g. from memory maps
+        xpiece = numpy.asarray(xpiece).reshape(-1)
+        ypiece = numpy.asarray(ypiece).reshape(-1)
+        if xpiece.size != ypiece.size:
+            raise ValueError('x and y pieces must be the same size')
+
+        i0 = 0
+        if npend > 0:
+            # complete the pending block first
+            i0 = min(chunk-npend, xpiece.size)
+            xpend.append(numpy.array(xpiece[0:i0], dtype='f8'))
+            ypend.append(numpy.array(ypiece[0:i0], dtype='f8'))
+            npend += i0
+            if npend < chunk:
+                continue
+            yield _join_pieces(xpend), _join_pieces(ypend)
+            xpend, ypend, npend = [], [], 0
+
+        for i0 in range(i0, xpiece.size, chunk):
+            i1 = i0+chunk
+            if i1 > xpiece.size:
+                xpend = [numpy.array(xpiece[i0:], dtype='f8')]
+                ypend = [numpy.array(ypiece[i0:], dtype='f8')]
+                npend = xpiece.size-i0
+                break
+            yield (numpy.asarray(xpiece[i0:i1], dtype='f8'),
+                   numpy.asarray(ypiece[i0:i1], dtype='f8'))
+
+    if npend > 0:
+        yield _join_pieces(xpend), _join_pieces(ypend)
+
+
+def _join_pieces(pieces):
+    # The float64 pieces of a block as one array
+    if len(pieces) == 1:
+        return pieces[0]
+    return numpy.concatenate(pieces)
+
+
+def _scratch(work, n, shape):
+    # A list of n double precision scratch arrays of the given shape,
+    # reusing those in work when they fit
+    buffs = []
+    if work is not None:
+        for w in work:
+            if (len(buffs) < n and w.shape == shape and
+                    w.dtype == numpy.float64):
+                buffs.append(w)
+    while len(buffs) < n:
+        buffs.append(numpy.empty(shape, dtype='f8'))
+    return buffs
+
+
+def _linear_kernel(t):
+    return numpy.clip(1.0-numpy.abs(t), 0.0, None)
+
+
+def _lanczos3_kernel(t):
+    # sinc(t)*sinc(t/3) for |t| < 3
+    return numpy.where(numpy.abs(t) < 3.0,
+                       numpy.sinc(t)*numpy.sinc(t/3.0), 0.0)
+
+
+# Resampling kernels for reproject: half width and kernel function
+_resample_kernels = {'nearest': (0, None),
+                     'bilinear': (1, _linear_kernel),
+                     'lanczos3': (3, _lanczos3_kernel)}
+
+
+def _resample(impad, wtpad, pad, shape, x, y, kernel, min_coverage=0.5):
+    # Weighted interpolation at the zero based positions x,y of an image
+    # of the given shape.  impad and wtpad are the image and weight with
+    # pad zero pixels added on each side, at least 2*half+1, so no tap
+    # needs a bounds check.
+    # Returns the value and the interpolated weight, which is zero where
+    # the kernel covers less than min_coverage of valid pixels.
+    ny, nx = shape
+    nxpad = nx + 2*pad
+    imflat = impad.reshape(-1)
+    wtflat = wtpad.reshape(-1)
+    half, func = _resample_kernels[kernel]
+    if half == 0:
+        ix0 = numpy.floor(x + 0.5)
+        iy0 = numpy.floor(y + 0.5)
+        offsets = [0]
+        wxs = wys = [1.0]
+    else:
+        ix0 = numpy.floor(x)
+        iy0 = numpy.floor(y)
+        offsets = list(range(1-half, half+1))
+        wxs = [func(x - ix0 - k) for k in offsets]
+        wys = [func(y - iy0 - k) for k in offsets]
+    ksum = sum(wxs)*sum(wys)
+
+    # Points further out than the kernel width have no valid taps; clip
+    # them into the padding
+    inside = ((ix0 >= -half) & (ix0 <= nx+half) &
+              (iy0 >= -half) & (iy0 <= ny+half))
+    numpy.clip(ix0, -half, nx+half, out=ix0)
+    numpy.clip(iy0, -half, ny+half, out=iy0)
+    base = ((iy0 + pad)*nxpad + ix0 + pad).astype('i8')
+
+    num = numpy.zeros(x.shape, dtype='f8')
+    den = numpy.zeros(x.shape, dtype='f8')
+    kgood = numpy.zeros(x.shape, dtype='f8')
+    kw = numpy.empty(x.shape, dtype='f8')
+    for ky, wy in zip(offsets, wys):
+        for kx, wx in zip(offsets, wxs):
+            idx = base + (ky*nxpad + kx)
+            wt = wtflat[idx]
+            numpy.multiply(wy, wx, out=kw)
+            kgood += kw*(wt > 0)
+            kw *= wt
+            den += kw
+            kw *= imflat[idx]
+            num += kw
+
+    valid = inside & (den > 0.0) & (kgood >= min_coverage*ksum)
+    value = numpy.zeros(x.shape, dtype='f8')
+    numpy.divide(num, den, out=value, where=valid)
+    weight = numpy.zeros(x.shape, dtype='f8')
+    numpy.divide(den, ksum, out=weight, where=valid)
+    return value, weight
+
+
+def _grid_nodes(n, step):
+    # Nodes from 1 to n with a spacing of at most step.  The bicubic spline
+    # needs at least 4 of them.
+    nnodes = max(4, int(math.ceil((n-1.0)/step))+1)
+    return numpy.linspace(1.0, n, nnodes)
+
+
+def _spline_basis(t, x, k=3):
+    # Matrix of the values at x of the B-spline basis with knots t, of
+    # shape (x.size, len(t)-k-1)
+    from scipy.interpolate import BSpline
+    n = len(t)-k-1
+    return BSpline(t, numpy.eye(n), k)(x)
+
+
+def _dot_into(a, b, out):
+    # numpy.dot(a, b) written into out, in place when out allows it
+    if out.flags['C_CONTIGUOUS'] and out.dtype == numpy.float64:
+        numpy.dot(a, b, out=out)
+    else:
+        out[:] = numpy.dot(a, b)
+
+
+def _poly_design(u, v, order):
+    # Design matrix of the terms u**ix*v**iy with ix+iy <= order, in the
+    # order of _poly_matrix
+    cols = []
+    upow = numpy.ones_like(u)
+    for ix in range(order+1):
+        col = upow.copy()
+        for iy in range(order+1-ix):
+            cols.append(col.copy())
+            col *= v
+        upow = upow*u
+    return numpy.column_stack(cols)
+
+
+def _poly_matrix(coeffs, order):
+    # Coefficient matrix a[ix, iy] from the output of a _poly_design fit
+    a = numpy.zeros((order+1, order+1), dtype='f8')
+    i = 0
+    for ix in range(order+1):
+        for iy in range(order+1-ix):
+            a[ix, iy] = coeffs[i]
+            i += 1
+    return a
+
+
 def make_xy_grid(n, xrang, yrang):
     # Create a grid on input ranges
     rng = numpy.arange(n, dtype='f8')
@@ -1066,60 +3928,182 @@ def make_xy_grid(n, xrang, yrang):
 
     x = numpy.outer(x, ones)
     y = numpy.outer(ones, y)
-    x = x.flatten(1)
-    y = y.flatten(1)
+    x = x.flatten('F')
+    y = y.flatten('F')
 
     return x, y
 
 
 def make_amatrix(u, v, order, constant=True):
-    # matrix for inversion.
+    # matrix for inversion, one row per term u**(k-j)*v**j for the orders
+    # k up to order, in the order used by pack_coeffs.
     # coeffs_u = A^{-1} x = (a^Ta)^{-1} A^T x
     # coeffs_v = A^{-1} v
+    u = numpy.asarray(u, dtype='f8').reshape(-1)
+    v = numpy.asarray(v, dtype='f8').reshape(-1)
+
+    # tables of the powers of u and v, then all the terms at once
+    upow = numpy.empty((order+1, u.size), dtype='f8')
+    vpow = numpy.empty((order+1, v.size), dtype='f8')
+    upow[0] = 1.0
+    vpow[0] = 1.0
+    for k in range(1, order+1):
+        numpy.multiply(upow[k-1], u, out=upow[k])
+        numpy.multiply(vpow[k-1], v, out=vpow[k])
+
+    iu, iv = _amatrix_powers(order, constant=constant)
+    return upow[iu]*vpow[iv]
+
+
+def _amatrix_powers(order, constant=True):
+    # Powers of u and v of the rows of make_amatrix
+    iu = []
+    iv = []
+    for k in range(0 if constant else 1, order+1):
+        for jj in range(k+1):
+            iu.append(k-jj)
+            iv.append(jj)
+    return numpy.array(iu, dtype='i8'), numpy.array(iv, dtype='i8')
+
+
+def invert_for_coeffs(amatrix, x, y, lsolve=True, weights=None,
+                      method='lstsq'):
+    """Least squares coefficients of the rows of amatrix for x and y.
+
+    method is 'lstsq' (SVD) or 'qr', which work on the design matrix with
+    its columns scaled to unit norm, or 'normal' to solve the normal
+    equations A^T A c = A^T x as was done before; these square the
+    condition number of A.  weights are optional per point weights, e.g.
+    inverse variances.
+    """
+    x = numpy.asarray(x, dtype='f8').reshape(-1)
+    y = numpy.asarray(y, dtype='f8').reshape(-1)
+    if weights is not None:
+        sw = numpy.sqrt(numpy.asarray(weights, dtype='f8').reshape(-1))
+        amatrix = amatrix*sw
+        x = x*sw
+        y = y*sw
+
+    if method == 'normal':
+        # a^T a
+        ata = numpy.inner(amatrix, amatrix)
+        # a^T x
+        atx = numpy.inner(amatrix, x)
+        # a^T y
+        aty = numpy.inner(amatrix, y)
+
+        if lsolve:
+            # More stable solver
+            xcoeffs = numpy.linalg.solve(ata, atx)
+            ycoeffs = numpy.linalg.solve(ata, aty)
 
-    #n = (order+1)*2
-    #n = n*n
-    n = u.size
-
-    tshape = [(order+1)*(order+2)/2-1, n]
-    if constant:
-        # Extra column with ones in it for the constant term
-        tshape[0] += 1
-        kstart = 1
-    else:
-        kstart = 0
-    #amatrix = numpy.zeros( tshape )
-    amatrix = numpy.ones(tshape)
-
-    kk = kstart
-    for order in range(1, order+1):
-        for jj in range(order+1):
-            amatrix[kk, :] = u**(order-jj)*v**jj
-            kk += 1
-
-    return amatrix
-
+        else:
+            atainv = numpy.linalg.inv(ata)
+            #atainv = numpy.linalg.pinv(ata)
+            xcoeffs = numpy.inner(atainv, atx)
+            ycoeffs = numpy.inner(atainv, aty)
 
-def invert_for_coeffs(amatrix, x, y, lsolve=True):
-    # a^T a
-    ata = numpy.inner(amatrix, amatrix)
-    # a^T x
-    atx = numpy.inner(amatrix, x)
-    # a^T y
-    aty = numpy.inner(amatrix, y)
+        return xcoeffs, ycoeffs
 
-    if lsolve:
-        # More stable solver
-        xcoeffs = numpy.linalg.solve(ata, atx)
-        ycoeffs = numpy.linalg.solve(ata, aty)
+    # The terms can differ by many orders of magnitude, e.g. powers of
+    # pixel offsets, so equilibrate the columns
+    a = amatrix.T
+    norms = numpy.sqrt((a*a).sum(axis=0))
+    norms[norms == 0.0] = 1.0
+    a = a/norms
+    rhs = numpy.column_stack((x, y))
+
+    if method == 'lstsq':
+        coeffs = numpy.linalg.lstsq(a, rhs, rcond=None)[0]
+    elif method == 'qr':
+        q, r = numpy.linalg.qr(a)
+        coeffs = numpy.linalg.solve(r, numpy.dot(q.T, rhs))
+    else:
+        raise ValueError("method must be 'lstsq', 'qr' or 'normal'")
+
+    coeffs /= norms[:, numpy.newaxis]
+    return coeffs[:, 0], coeffs[:, 1]
+
+
+def Fit2DPolynomial(u, v, x, y, porder, weights=None, constant=True,
+                    nsigma=None, maxiter=5, method='lstsq', pack=True,
+                    get_info=False):
+    """Fit the 2D polynomials of u,v of order porder to x and y.
+
+    This is the general engine behind Invert2DPolynomial, and can also fit
+    a distortion solution to matched stars, e.g. the tangent plane
+    coordinates of reference stars as a function of their pixel offsets
+    from crpix.
+
+    Parameters
+    ----------
+    u, v : arrays
+        Positions the polynomials are functions of.
+    x, y : arrays
+        Values to fit at those positions.
+    porder : int
+        Order of the polynomials.
+    weights : array, optional
+        Per point weights, e.g. inverse variances.  Points with zero
+        weight are not used.  Default all 1.
+    constant : bool, optional
+        Include the constant term.  Default True.
+    nsigma : float, optional
+        If set, iteratively reject the points whose weighted residual in x
+        or y is above nsigma times the rms, for up to maxiter iterations.
+    maxiter : int, optional
+        Maximum number of clipping iterations.  Default 5.
+    method : str, optional
+        'lstsq', 'qr' or 'normal', see invert_for_coeffs.  Default 'lstsq'.
+    pack : bool, optional
+        Return coefficient matrices, see pack_coeffs, rather than the
+        coefficient vectors.  Default True.
+    get_info : bool, optional
+        Also return a dictionary with the mask of the points 'used', the
+        rms residuals 'xrms' and 'yrms' of those points, and 'niter'.
+    """
+    x = numpy.asarray(x, dtype='f8').reshape(-1)
+    y = numpy.asarray(y, dtype='f8').reshape(-1)
+    amatrix = make_amatrix(u, v, porder, constant=constant)
+    if amatrix.shape[1] != x.size or x.size != y.size:
+        raise ValueError('u, v, x, y must be the same size')
 
+    if weights is None:
+        weights = numpy.ones(x.size, dtype='f8')
     else:
-        atainv = numpy.linalg.inv(ata)
-        #atainv = numpy.linalg.pinv(ata)
-        xcoeffs = numpy.inner(atainv, atx)
-        ycoeffs = numpy.inner(atainv, aty)
+        weights = numpy.asarray(weights, dtype='f8').reshape(-1)
+    used = weights > 0.0
+    sw = numpy.sqrt(numpy.where(used, weights, 0.0))
+
+    niter = 0
+    while True:
+        wused = numpy.where(used, weights, 0.0)
+        xcoeffs, ycoeffs = invert_for_coeffs(amatrix, x, y, weights=wused,
+                                             method=method)
+        xres = (x - numpy.dot(xcoeffs, amatrix))*sw
+        yres = (y - numpy.dot(ycoeffs, amatrix))*sw
+        nused = max(used.sum(), 1)
+        xrms = math.sqrt((xres[used]**2).sum()/nused)
+        yrms = math.sqrt((yres[used]**2).sum()/nused)
+
+        if nsigma is None or niter >= maxiter:
+            break
+        newused = ((weights > 0.0) &
+                   (numpy.abs(xres) <= nsigma*xrms) &
+                   (numpy.abs(yres) <= nsigma*yrms))
+        if numpy.array_equal(newused, used):
+            break
+        used = newused
+        niter += 1
 
-    return xcoeffs, ycoeffs
+    if pack:
+        result = pack_coeffs(xcoeffs, ycoeffs, porder, constant=constant)
+    else:
+        result = (xcoeffs, ycoeffs)
+    if get_info:
+        info = {'used': used, 'xrms': xrms, 'yrms': yrms, 'niter': niter}
+        return result + (info,)
+    return result
 
 
 def pack_coeffs(xcoeffs, ycoeffs, porder, constant=True):
@@ -1144,25 +4128,14 @@ def pack_coeffs(xcoeffs, ycoeffs, porder, constant=True):
 
 # Find the polynomial coeffs that take us from u,v to x,y
 def Invert2DPolynomial(u, v, x, y, porder, pack=True, constant=True):
-    # matrix for inversion.
-    # coeffs_u = A^{-1} x = (A^TA)^{-1} A^T x
-    # coeffs_v = A^{-1} v
-    amatrix = make_amatrix(u, v, porder, constant=constant)
-
-    # Now we know the inverse must equal x,y so we use that as the
-    # constraint vector
-    xcoeffs, ycoeffs = invert_for_coeffs(amatrix, x, y)
-
-    if pack:
-        # now pack the coefficients into a matrix
-        ainv, binv = pack_coeffs(xcoeffs, ycoeffs, porder, constant=constant)
-        return ainv, binv
-    else:
-        return xcoeffs, ycoeffs
+    # Least squares fit of the polynomial of u,v that gives x,y, see
+    # Fit2DPolynomial.  We know the inverse must equal x,y so we use that
+    # as the constraint vector
+    return Fit2DPolynomial(u, v, x, y, porder, constant=constant, pack=pack)
 
 
 def Ncoeff(order, constant=True):
-    ncoeff = (order+1)*(order+2)/2
+    ncoeff = (order+1)*(order+2)//2
     if not constant:
         ncoeff -= 1
     return ncoeff
@@ -1292,3 +4265,187 @@ def test_invert_2dpoly(porder, fac=5, constant=True, order_increase=0,
         pylab.hist(vfrac, 50, edgecolor='red', fill=False)
 
     pylab.show()
+
+
+def bench_2dpoly(nx=2048, ny=4096, order=3, nrep=3):
+    """Time Polynomial2D against Apply2DPolynomial on a full-CCD grid.
+
+    The default 2048x4096 grid is the size of a DECam CCD, 8M pixels.
+    """
+    import time
+
+    x, y = numpy.mgrid[1:nx+1, 1:ny+1].astype('f8')
+    x -= nx/2.0
+    y -= ny/2.0
+    x *= 7.3e-05
+    y *= 7.3e-05
+
+    # A TPV-like matrix with the scamp skipped term left at zero
+    a = numpy.zeros((order+1, order+1), dtype='f8')
+    for ix in range(order+1):
+        for iy in range(order+1-ix):
+            a[ix, iy] = 10.0**(-2*(ix+iy))
+    a[0, 0] = 0.0
+    a[1, 0] = 1.0
+
+    t0 = time.time()
+    for i in range(nrep):
+        v1 = Apply2DPolynomial(a, x, y)
+    tapply = (time.time()-t0)/nrep
+
+    poly = Polynomial2D(a)
+    out = numpy.empty_like(x)
+    work = numpy.empty_like(x)
+    t0 = time.time()
+    for i in range(nrep):
+        v2 = poly(x, y, out=out, work=work)
+    tpoly = (time.time()-t0)/nrep
+
+    maxdiff = numpy.abs(v1-v2).max()
+    sys.stdout.write('grid %dx%d, %d terms\n' % (nx, ny, poly.nterms))
+    sys.stdout.write('Apply2DPolynomial: %.3f s\n' % tapply)
+    sys.stdout.write('Polynomial2D:      %.3f s\n' % tpoly)
+    sys.stdout.write('speedup: %.1f  max abs diff: %s\n' %
+                     (tapply/tpoly, maxdiff))
+    return tapply, tpoly
+
+
+def bench_threads(wcs=None, n=8000000, maxthreads=None, nrep=3):
+    """Time image2sky and sky2image(find=False) with 1 to maxthreads threads.
+
+    By default uses a DECam-like TPV WCS and n random points on a
+    2048x4096 CCD.  The number of threads doubles up to maxthreads, by
+    default the number of cores.
+    """
+    import time
+
+    if wcs is None:
+        wcs = WCS(_bench_header())
+    if maxthreads is None:
+        maxthreads = os.cpu_count() or 1
+
+    x = numpy.random.uniform(1.0, 2048.0, n)
+    y = numpy.random.uniform(1.0, 4096.0, n)
+    lon = numpy.empty(n, dtype='f8')
+    lat = numpy.empty(n, dtype='f8')
+
+    nthreads = [1]
+    while nthreads[-1]*2 <= maxthreads:
+        nthreads.append(nthreads[-1]*2)
+    if nthreads[-1] != maxthreads:
+        nthreads.append(maxthreads)
+
+    results = []
+    for nt in nthreads:
+        t0 = time.time()
+        for i in range(nrep):
+            wcs.image2sky(x, y, out=(lon, lat), nthreads=nt)
+        tforward = (time.time()-t0)/nrep
+
+        t0 = time.time()
+        for i in range(nrep):
+            wcs.sky2image(lon, lat, find=False, nthreads=nt)
+        tinverse = (time.time()-t0)/nrep
+
+        if len(results) == 0:
+            tf1, ti1 = tforward, tinverse
+        sys.stdout.write('%3d threads: image2sky %.3f s (x%.2f) '
+                         'sky2image %.3f s (x%.2f)\n' %
+                         (nt, tforward, tf1/tforward, tinverse, ti1/tinverse))
+        results.append((nt, tforward, tinverse))
+    return results
+
+
+def _bench_header():
+    # A DECam-like TPV header for the benchmarks
+    hdr = {'ctype1': 'RA---TPV', 'ctype2': 'DEC--TPV',
+           'crval1': 35.0, 'crval2': -5.0,
+           'crpix1': -3000.0, 'crpix2': 5000.0,
+           'cd1_1': 0.0, 'cd1_2': 7.286e-05,
+           'cd2_1': -7.286e-05, 'cd2_2': 0.0,
+           'naxis1': 2048, 'naxis2': 4096}
+    pv1 = [0.0035, 1.012, -0.0065, 0.0, -0.0089, 0.0118, -0.0054,
+           -0.0112, 0.0057, -0.0109, 0.0024]
+    pv2 = [-0.0047, 1.0154, -0.0093, 0.0, -0.0117, 0.0143, -0.0068,
+           -0.0114, 0.0043, -0.0108, 0.0032]
+    for i in range(len(pv1)):
+        if i not in _scamp_skip:
+            hdr['pv1_%d' % i] = pv1[i]
+            hdr['pv2_%d' % i] = pv2[i]
+    return hdr
+
+
+def bench_backends(wcs=None, n=8000000, nrep=3):
+    """Time image2sky and sky2image(find=False) with each available backend.
+
+    By default uses a DECam-like TPV WCS and n random points on a
+    2048x4096 CCD.  The first call of each backend is not timed, so the
+    numba compilation is left out.
+    """
+    import time
+
+    if wcs is None:
+        wcs = WCS(_bench_header())
+
+    x = numpy.random.uniform(1.0, 2048.0, n)
+    y = numpy.random.uniform(1.0, 4096.0, n)
+    lon = numpy.empty(n, dtype='f8')
+    lat = numpy.empty(n, dtype='f8')
+
+    results = []
+    for name in available_backends():
+        lon0, lat0 = wcs.image2sky(x[0:10], y[0:10], backend=name)
+        wcs.sky2image(lon0, lat0, find=False, backend=name)
+
+        t0 = time.time()
+        for i in range(nrep):
+            wcs.image2sky(x, y, out=(lon, lat), backend=name)
+        tforward = (time.time()-t0)/nrep
+
+        t0 = time.time()
+        for i in range(nrep):
+            wcs.sky2image(lon, lat, find=False, backend=name)
+        tinverse = (time.time()-t0)/nrep
+
+        sys.stdout.write('%-8s image2sky %.3f s  sky2image %.3f s\n' %
+                         (name, tforward, tinverse))
+        results.append((name, tforward, tinverse))
+    return results
+
+
+def bench_construction(hdr=None, n=50):
+    """Time the construction of WCS objects from a header without inverse.
+
+    Compares building only (enough for image2sky) with building and then
+    fitting the inverse coefficients, what WCS() did for every object
+    before the inverse was made lazy.  By default uses a DECam-like TPV
+    header.  The persistent inverse store is turned off while timing.
+    """
+    import time
+
+    global _inverse_store
+    if hdr is None:
+        hdr = _bench_header()
+
+    store = _inverse_store
+    environ = os.environ.pop('DESPYASTRO_INVERSE_STORE', None)
+    _inverse_store = None
+    try:
+        t0 = time.time()
+        for i in range(n):
+            WCS(hdr)
+        tlazy = (time.time()-t0)/n
+
+        t0 = time.time()
+        for i in range(n):
+            WCS(hdr).distort.load()
+        teager = (time.time()-t0)/n
+    finally:
+        _inverse_store = store
+        if environ is not None:
+            os.environ['DESPYASTRO_INVERSE_STORE'] = environ
+
+    sys.stdout.write('WCS():                %.2f ms\n' % (1000*tlazy))
+    sys.stdout.write('WCS() + inverse fit:  %.2f ms\n' % (1000*teager))
+    sys.stdout.write('speedup: %.1f\n' % (teager/tlazy))
+    return tlazy, teager
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# run against the package in this tree
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'python'))
@@ -0,0 +1,112 @@
+import numpy
+import pytest
+
+from despyastro import coords
+
+# points, and their conversions by euler(ra, dec, select, b1950) as it was
+# before it went through convert_frame, computed with trigonometric
+# formulae for each select
+_ra = numpy.array([0.0, 45.0, 123.4, 266.40499, 359.9])
+_dec = numpy.array([0.0, -30.0, 67.8, -28.93617, -89.5])
+_euler = {
+    (1, False): (
+        [96.3372723, 226.4330564, 147.7939584, 0.0000012, 303.0584659],
+        [-60.1885533, -61.7176352, 32.6952298, 0.0000057, -27.6154577]),
+    (1, True): (
+        [97.7421609, 226.0644055, 147.8969364, 0.3469409, 303.1209922],
+        [-60.1810240, -61.2527842, 33.1696885, -0.6026038, -27.8883774]),
+    (2, False): (
+        [266.4049948, 314.7797484, 192.5881156, 90.9422885, 12.3873289],
+        [-28.9361740, -3.8329539, 49.3272635, -57.8343146, -27.4000131]),
+    (2, True): (
+        [265.6108440, 314.1254267, 192.0168128, 90.7442305, 11.7770438],
+        [-28.9167903, -4.0279266, 49.5992773, -57.8302185, -27.6722530]),
+    (3, False): (
+        [0.0000000, 30.6551534, 107.5492697, 266.8395198, 271.2567694],
+        [0.0000000, -44.6141436, 46.3853075, -5.5363108, -66.5548049]),
+    (3, True): (
+        [0.0000000, 30.6496382, 107.5472137, 266.8395545, 271.2564409],
+        [0.0000000, -44.6174562, 46.3791123, -5.5298232, -66.5483089]),
+    (4, False): (
+        [0.0000000, 51.1666047, 200.7688140, 264.8503059, 88.7431423],
+        [0.0000000, -12.4245192, 77.1470800, -52.3112158, -66.5565499]),
+    (4, True): (
+        [0.0000000, 51.1675022, 200.7954360, 264.8495509, 88.7434708],
+        [0.0000000, -12.4194577, 77.1447745, -52.3176871, -66.5500539]),
+    (5, False): (
+        [96.3372738, 198.3086830, 120.6471656, 339.2675736, 276.3852198],
+        [-60.1885533, -51.2719057, 39.8404901, -11.1055119, -30.3114374]),
+    (5, True): (
+        [97.7421609, 198.4931356, 120.5232065, 339.5537019, 276.3706262],
+        [-60.1810240, -50.6760406, 40.0907919, -11.6488130, -30.3119283]),
+    (6, False): (
+        [266.8395234, 316.0977286, 164.9212117, 93.3040961, 359.4503257],
+        [-5.5363160, 12.7317564, 48.7951910, -81.2627961, -29.8666657]),
+    (6, True): (
+        [266.1409654, 315.4003248, 164.2153448, 92.6113288, 358.7480453],
+        [-5.5297943, 12.7358962, 48.7939942, -81.2692589, -29.8671161]),
+}
+_sdss = ([5.0000000, -33.8258450, -19.4125125, 59.9204884, 0.0444466],
+         [147.5000000, -175.4954980, 46.5155515, -107.3731594, -122.9980206])
+
+
+def _separation(lon1, lat1, lon2, lat2):
+    # in arcsec, from the chord, which is precise for small angles
+    p1 = numpy.array(coords.eq2xyz(lon1, lat1), dtype='f8')
+    p2 = numpy.array(coords.eq2xyz(lon2, lat2), dtype='f8')
+    chord = numpy.sqrt(((p1-p2)**2).sum(axis=0))
+    return numpy.degrees(2.0*numpy.arcsin(0.5*chord))*3600.0
+
+
+@pytest.mark.parametrize('select,b1950', sorted(_euler))
+def test_euler_matches_trigonometric_formulae(select, b1950):
+    lon, lat = coords.euler(_ra, _dec, select, b1950=b1950)
+    elon, elat = _euler[select, b1950]
+    assert _separation(lon, lat, elon, elat).max() < 0.01
+    assert ((lon >= 0.0) & (lon < 360.0)).all()
+
+
+def test_eq2sdss_matches_and_round_trips():
+    clam, ceta = coords.eq2sdss(_ra, _dec)
+    numpy.testing.assert_allclose(clam, _sdss[0], rtol=0, atol=3.0e-6)
+    numpy.testing.assert_allclose(ceta, _sdss[1], rtol=0, atol=3.0e-6)
+    ra, dec = coords.sdss2eq(clam, ceta)
+    assert _separation(ra, dec, _ra, _dec).max() < 1.0e-6
+
+
+def test_frame_matrices_compose():
+    frames = ['eq', 'eq1950', 'gal', 'ec', 'ec1950', 'sdss']
+    for f1 in frames:
+        for f2 in frames:
+            # rotations, to the precision of the published constants,
+            # the same whichever frame they go through
+            m = coords.frame_matrix(f1, f2)
+            numpy.testing.assert_allclose(numpy.dot(m, m.T), numpy.eye(3),
+                                          rtol=0, atol=1.0e-10)
+            m12 = numpy.dot(coords.frame_matrix('gal', f2),
+                            coords.frame_matrix(f1, 'gal'))
+            numpy.testing.assert_allclose(m, m12, rtol=0, atol=1.0e-10)
+    with pytest.raises(ValueError):
+        coords.frame_matrix('eq', 'nonesuch')
+
+
+def test_convert_frame_chunks_and_dtype():
+    rng = numpy.random.RandomState(7)
+    ra = rng.uniform(0.0, 360.0, 1000)
+    dec = numpy.degrees(numpy.arcsin(rng.uniform(-1.0, 1.0, 1000)))
+    lon, lat = coords.convert_frame(ra, dec, 'eq', 'gal')
+    clon, clat = coords.convert_frame(ra, dec, 'eq', 'gal', chunk_size=77)
+    numpy.testing.assert_array_equal(clon, lon)
+    numpy.testing.assert_array_equal(clat, lat)
+
+    # through two conversions and back
+    l2, b2 = coords.convert_frame(lon, lat, 'gal', 'ec1950')
+    ra2, dec2 = coords.convert_frame(l2, b2, 'ec1950', 'eq')
+    assert _separation(ra2, dec2, ra, dec).max() < 1.0e-5
+
+    lon4, lat4 = coords.convert_frame(ra, dec, 'eq', 'gal', dtype='f4')
+    assert lon4.dtype == numpy.float32
+    assert _separation(lon4, lat4, lon, lat).max() < 1.0
+
+    slon, slat = coords.convert_frame(ra[0], dec[0], 'eq', 'gal')
+    assert slon.shape == (1,) and slon[0] == lon[0]
@@ -0,0 +1,81 @@
+import numpy
+
+from despyastro import focalplane
+from despyastro import wcsutil
+
+
+def _ccd_headers(nccd=4):
+    # TPV headers of side by side CCDs, with no inverse coefficients
+    headers = []
+    for i in range(nccd):
+        hdr = wcsutil._bench_header()
+        hdr['crpix1'] = -3000.0 + 2100.0*i
+        hdr['ccdnum'] = i+1
+        headers.append(hdr)
+    return headers
+
+
+def test_focalplane_inverse_is_lazy():
+    wcslist = [wcsutil.WCS(hdr) for hdr in _ccd_headers()]
+    fp = focalplane.FocalPlaneWCS(wcslist, ccdnums=[1, 2, 3, 4])
+    assert all(w.distort.pending() for w in wcslist)
+
+    ccd = numpy.repeat([1, 2, 3, 4], 50)
+    x = numpy.tile(numpy.linspace(1.0, 2048.0, 50), 4)
+    y = numpy.tile(numpy.linspace(1.0, 4096.0, 50), 4)
+    ra, dec = fp.image2sky(ccd, x, y)
+    assert all(w.distort.pending() for w in wcslist)
+
+    for i, w in enumerate(wcslist):
+        sel = ccd == i+1
+        rra, rdec = w.image2sky(x[sel], y[sel])
+        numpy.testing.assert_allclose(ra[sel], rra, rtol=0, atol=1.0e-10)
+        numpy.testing.assert_allclose(dec[sel], rdec, rtol=0, atol=1.0e-10)
+
+    xt, yt = fp.sky2image(ccd, ra, dec)
+    assert not any(w.distort.pending() for w in wcslist)
+    numpy.testing.assert_allclose(xt, x, rtol=0, atol=1.0e-7)
+    numpy.testing.assert_allclose(yt, y, rtol=0, atol=1.0e-7)
+
+
+def test_focalplane_ccdnums_from_headers():
+    fp = focalplane.FocalPlaneWCS(_ccd_headers(3))
+    assert list(fp.ccdnums) == [1, 2, 3]
+    assert fp[2] is fp.wcslist[1]
+
+
+def test_mosaic_lookup_matches_brute_force():
+    wcslist = [wcsutil.WCS(hdr) for hdr in _ccd_headers()]
+    mosaic = focalplane.MosaicLookup(wcslist)
+    assert len(mosaic) == 4
+
+    # points over the CCDs, the gaps between them and around them
+    rng = numpy.random.RandomState(3)
+    ccd = rng.randint(0, 4, 4000)
+    x = rng.uniform(-200.0, 2250.0, ccd.size)
+    y = rng.uniform(-200.0, 4300.0, ccd.size)
+    ra = numpy.zeros(ccd.size)
+    dec = numpy.zeros(ccd.size)
+    for i, w in enumerate(wcslist):
+        sel = ccd == i
+        ra[sel], dec[sel] = w.image2sky(x[sel], y[sel])
+
+    expected = numpy.zeros(ra.size, dtype='i8') - 1
+    for i, w in reversed(list(enumerate(wcslist))):
+        xi, yi = w.sky2image(ra, dec)
+        on = (xi >= 0.5) & (xi < 2048.5) & (yi >= 0.5) & (yi < 4096.5)
+        expected[on] = i
+
+    ccd_index, xl, yl = mosaic.lookup(ra, dec, chunksize=1000)
+    numpy.testing.assert_array_equal(ccd_index, expected)
+    assert (ccd_index >= 0).sum() > 1000 and (ccd_index < 0).sum() > 100
+    on = ccd_index == ccd
+    numpy.testing.assert_allclose(xl[on], x[on], rtol=0, atol=1.0e-7)
+    numpy.testing.assert_allclose(yl[on], y[on], rtol=0, atol=1.0e-7)
+    assert numpy.isnan(xl[ccd_index < 0]).all()
+
+    # a border excludes the pixels near the edges
+    bordered = focalplane.MosaicLookup(wcslist, border=100)
+    ccd_b = bordered.lookup(ra, dec)[0]
+    assert ((ccd_b == ccd_index) | (ccd_b == -1)).all()
+    assert (ccd_b == -1).sum() > (ccd_index == -1).sum()
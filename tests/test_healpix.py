@@ -0,0 +1,244 @@
+import numpy
+import pytest
+
+from despyastro import coords
+from despyastro import healpix
+
+# points and their nested pixels from the reference HEALPix library
+_ra = numpy.array([0.3, 45.1, 123.4, 266.40499, 359.9, 180.0])
+_dec = numpy.array([0.2, -30.2, 67.8, -28.93617, -89.5, 90.0])
+_pix = {
+    1: [4, 8, 1, 7, 11, 2],
+    16: [1130, 2243, 487, 1801, 2816, 767],
+    1024: [4631230, 9191412, 1995168, 7380519, 11534404, 3145727],
+    2**29: [1273022844813112069, 2526516317410469810, 548427793748196899,
+            2028741720134339536, 3170552919956237627, 864691128455135231],
+}
+# neighbors at nside 4, SW, W, NW, N, NE, E, SE, S
+_neighbors = {
+    0: [69, 71, 2, 3, 1, 91, 90, 143],
+    5: [4, 6, 7, 27, 26, -1, 95, 94],
+    11: [10, 53, 55, 61, 14, 12, 9, 8],
+    100: [97, 99, 102, 103, 101, 175, 174, 171],
+    191: [190, 116, 117, 48, 74, 72, 189, 188],
+}
+
+
+def _angle(ra1, dec1, ra2, dec2):
+    # in degrees, from the chord
+    p1 = numpy.array(coords.eq2xyz(ra1, dec1), dtype='f8')
+    p2 = numpy.array(coords.eq2xyz(ra2, dec2), dtype='f8')
+    p1 = p1.reshape(3, -1)
+    p2 = p2.reshape(3, -1)
+    chord = numpy.sqrt(((p1-p2)**2).sum(axis=0))
+    return numpy.degrees(2.0*numpy.arcsin(numpy.minimum(0.5*chord, 1.0)))
+
+
+def _random_points(n, seed):
+    rng = numpy.random.RandomState(seed)
+    ra = rng.uniform(0.0, 360.0, n)
+    dec = numpy.degrees(numpy.arcsin(rng.uniform(-1.0, 1.0, n)))
+    return ra, dec
+
+
+@pytest.mark.parametrize('nside', sorted(_pix))
+def test_ang2pix_fixed_values(nside):
+    pix = healpix.ang2pix(nside, _ra, _dec)
+    assert pix.dtype == numpy.int64
+    numpy.testing.assert_array_equal(pix, _pix[nside])
+    x, y, z = coords.eq2xyz(_ra, _dec)
+    numpy.testing.assert_array_equal(healpix.vec2pix(nside, x, y, z),
+                                     _pix[nside])
+
+
+def test_pix2ang_fixed_values():
+    ra, dec = healpix.pix2ang(1, numpy.arange(12))
+    numpy.testing.assert_allclose(ra, [45.0, 135.0, 225.0, 315.0,
+                                       0.0, 90.0, 180.0, 270.0,
+                                       45.0, 135.0, 225.0, 315.0],
+                                  rtol=0, atol=1.0e-12)
+    z = numpy.degrees(numpy.arcsin(2.0/3.0))
+    numpy.testing.assert_allclose(dec, [z]*4 + [0.0]*4 + [-z]*4,
+                                  rtol=0, atol=1.0e-12)
+
+    ra, dec = healpix.pix2ang(1024, [0, 1234567, 12582911])
+    numpy.testing.assert_allclose(ra, [45.0, 127.00195312, 315.0],
+                                  rtol=0, atol=1.0e-8)
+    numpy.testing.assert_allclose(dec, [0.03730194, 24.50127814,
+                                        -0.03730194],
+                                  rtol=0, atol=1.0e-8)
+
+
+@pytest.mark.parametrize('nside', [1, 2, 64, 2**20, 2**29])
+def test_pix2ang_round_trip(nside):
+    rng = numpy.random.RandomState(nside % 1000)
+    pix = rng.randint(0, healpix.nside2npix(nside), 5000, dtype='i8')
+    ra, dec = healpix.pix2ang(nside, pix)
+    numpy.testing.assert_array_equal(healpix.ang2pix(nside, ra, dec), pix)
+    x, y, z = healpix.pix2vec(nside, pix)
+    numpy.testing.assert_array_equal(healpix.vec2pix(nside, x, y, z), pix)
+
+    # every point is within max_pixrad of the center of its pixel
+    ra, dec = _random_points(5000, 3)
+    cra, cdec = healpix.pix2ang(nside, healpix.ang2pix(nside, ra, dec))
+    assert (_angle(ra, dec, cra, cdec) <= healpix.max_pixrad(nside)).all()
+
+
+def test_neighbors_fixed_values_and_symmetry():
+    pix = sorted(_neighbors)
+    result = healpix.neighbors(4, pix)
+    assert result.shape == (8, len(pix))
+    numpy.testing.assert_array_equal(result.T, [_neighbors[p] for p in pix])
+
+    # each pixel is a neighbor of its neighbors, and they are close by
+    nside = 16
+    pix = numpy.arange(healpix.nside2npix(nside))
+    result = healpix.neighbors(nside, pix)
+    ra, dec = healpix.pix2ang(nside, pix)
+    for i in range(8):
+        w, = numpy.where(result[i] >= 0)
+        back = healpix.neighbors(nside, result[i, w])
+        assert ((back == pix[w]).sum(axis=0) == 1).all()
+        nra, ndec = healpix.pix2ang(nside, result[i, w])
+        assert (_angle(ra[w], dec[w], nra, ndec) <
+                2.0*healpix.max_pixrad(nside)).all()
+    # only 3 base pixels meet at 8 of their corners, where each of the 3
+    # pixels at the corner lacks one neighbor
+    assert (result < 0).sum() == 24
+
+
+def test_nside_checks_and_sizes():
+    assert healpix.nside2order(1) == 0
+    assert healpix.nside2order(2**29) == 29
+    assert healpix.nside2npix(4) == 192
+    numpy.testing.assert_allclose(healpix.nside2area(1)*12,
+                                  4.0*numpy.pi*(180.0/numpy.pi)**2)
+    numpy.testing.assert_allclose(healpix.max_pixrad(1), 48.189685104221404)
+    numpy.testing.assert_allclose(healpix.max_pixrad(16), 3.7823672156460226)
+    for nside in [0, 3, 12, 2**30]:
+        with pytest.raises(ValueError):
+            healpix.nside2npix(nside)
+
+
+def _check_query(nside, ranges, inside):
+    # ranges against the brute force inside(ra, dec) on the pixel centers
+    # (not inclusive) or on random points (inclusive)
+    allpix = numpy.arange(healpix.nside2npix(nside))
+    ra, dec = healpix.pix2ang(nside, allpix)
+    centers = allpix[inside(ra, dec)]
+    assert centers.size > 0
+    numpy.testing.assert_array_equal(
+        healpix.ranges_to_pixels(ranges[False]), centers)
+
+    rra, rdec = _random_points(200000, 9)
+    touched = numpy.unique(healpix.ang2pix(nside, rra[inside(rra, rdec)],
+                                           rdec[inside(rra, rdec)]))
+    assert healpix.ranges_contains(ranges[True], touched).all()
+    assert healpix.ranges_contains(ranges[True], centers).all()
+    # and not much more than the pixels touched
+    extra = healpix.ranges_to_pixels(ranges[True]).size - touched.size
+    assert extra < 2*touched.size
+
+
+@pytest.mark.parametrize('ra0,dec0,radius', [(10.0, 20.0, 5.0),
+                                             (359.0, -88.0, 7.0),
+                                             (200.0, 0.5, 30.0),
+                                             (5.0, 5.0, 2.0)])
+def test_query_disc_matches_brute_force(ra0, dec0, radius):
+    nside = 32
+
+    def inside(ra, dec):
+        return _angle(ra, dec, ra0, dec0) <= radius
+
+    ranges = dict((inclusive, healpix.query_disc(nside, ra0, dec0, radius,
+                                                 inclusive=inclusive))
+                  for inclusive in [False, True])
+    _check_query(nside, ranges, inside)
+
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_query_polygon_matches_brute_force(reverse):
+    nside = 64
+    # a quadrilateral across RA 0, about CCD shaped but larger
+    vra = numpy.array([-4.0, 3.0, 3.5, -4.5]) % 360.0
+    vdec = numpy.array([-10.0, -10.5, -3.0, -2.0])
+    if reverse:
+        vra = vra[::-1]
+        vdec = vdec[::-1]
+    verts = numpy.array(coords.eq2xyz(vra, vdec))
+    normals = numpy.cross(verts.T, numpy.roll(verts, -1, axis=1).T)
+    if reverse:
+        normals = -normals
+
+    def inside(ra, dec):
+        vec = numpy.array(coords.eq2xyz(ra, dec))
+        return (numpy.dot(normals, vec) >= 0).all(axis=0)
+
+    ranges = dict((inclusive, healpix.query_polygon(nside, vra, vdec,
+                                                    inclusive=inclusive))
+                  for inclusive in [False, True])
+    _check_query(nside, ranges, inside)
+
+    with pytest.raises(ValueError):
+        healpix.query_polygon(nside, vra[:2], vdec[:2])
+    with pytest.raises(ValueError):
+        # a bow tie
+        healpix.query_polygon(nside, vra[[0, 2, 1, 3]], vdec[[0, 2, 1, 3]])
+
+
+def test_range_set_algebra():
+    pix = [7, 3, 4, 5, 20, 21, 5, 40]
+    ranges = healpix.pixels_to_ranges(pix)
+    numpy.testing.assert_array_equal(ranges, [[3, 6], [7, 8], [20, 22],
+                                              [40, 41]])
+    numpy.testing.assert_array_equal(healpix.ranges_to_pixels(ranges),
+                                     numpy.unique(pix))
+    assert healpix.pixels_to_ranges([]).shape == (0, 2)
+    assert healpix.ranges_to_pixels(numpy.zeros((0, 2))).size == 0
+
+    # touching and overlapping ranges merge, empty ones vanish
+    numpy.testing.assert_array_equal(
+        healpix.ranges_union([[10, 12], [0, 2]], [[2, 4], [11, 15], [6, 6]]),
+        [[0, 4], [10, 15]])
+
+    a = [[0, 10], [20, 30], [40, 50]]
+    b = [[5, 25], [28, 45], [60, 70]]
+    numpy.testing.assert_array_equal(healpix.ranges_intersection(a, b),
+                                     [[5, 10], [20, 25], [28, 30], [40, 45]])
+    assert healpix.ranges_intersection(a, []).shape == (0, 2)
+
+    test = numpy.arange(-2, 75)
+    numpy.testing.assert_array_equal(
+        healpix.ranges_contains(a, test),
+        numpy.in1d(test, healpix.ranges_to_pixels(a)))
+    assert not healpix.ranges_contains([], [1, 2]).any()
+
+    # against the same operations on pixel sets
+    rng = numpy.random.RandomState(4)
+    p1 = rng.randint(0, 3000, 1500)
+    p2 = rng.randint(0, 3000, 1500)
+    r1 = healpix.pixels_to_ranges(p1)
+    r2 = healpix.pixels_to_ranges(p2)
+    numpy.testing.assert_array_equal(
+        healpix.ranges_to_pixels(healpix.ranges_union(r1, r2)),
+        numpy.union1d(p1, p2))
+    numpy.testing.assert_array_equal(
+        healpix.ranges_to_pixels(healpix.ranges_intersection(r1, r2)),
+        numpy.intersect1d(p1, p2))
+    numpy.testing.assert_array_equal(
+        healpix.ranges_to_pixels(healpix.ranges_degrade(r1, 16, 4)),
+        numpy.unique(p1 >> 4))
+    numpy.testing.assert_array_equal(healpix.ranges_degrade(r1, 16, 16), r1)
+    with pytest.raises(ValueError):
+        healpix.ranges_degrade(r1, 4, 16)
+
+
+def test_query_disc_ranges_degrade_to_coarse_query():
+    # the pixels of a disc at nside 256 are inside those at nside 16
+    fine = healpix.query_disc(256, 150.0, -40.0, 3.0)
+    coarse = healpix.query_disc(16, 150.0, -40.0, 3.0)
+    degraded = healpix.ranges_degrade(fine, 256, 16)
+    numpy.testing.assert_array_equal(
+        healpix.ranges_intersection(degraded, coarse), degraded)
+    # whole pixels inside the disc make long ranges
+    assert fine.shape[0] < healpix.ranges_to_pixels(fine).size/10
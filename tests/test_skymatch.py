@@ -0,0 +1,171 @@
+import numpy
+import pytest
+
+from despyastro import coords
+from despyastro import skymatch
+
+
+def _catalogs(n1=300, n2=500, seed=11):
+    # uniform points plus clusters at both poles and across RA 0/360
+    rng = numpy.random.RandomState(seed)
+
+    def points(n):
+        ra = rng.uniform(0.0, 360.0, n)
+        dec = numpy.degrees(numpy.arcsin(rng.uniform(-1.0, 1.0, n)))
+        m = n//4
+        dec[:m] = rng.uniform(87.0, 90.0, m)
+        dec[m:2*m] = rng.uniform(-90.0, -87.0, m)
+        ra[2*m:3*m] = rng.uniform(-3.0, 3.0, m) % 360.0
+        dec[2*m:3*m] = rng.uniform(-3.0, 3.0, m)
+        return ra, dec
+
+    ra1, dec1 = points(n1)
+    ra2, dec2 = points(n2)
+    return ra1, dec1, ra2, dec2
+
+
+def _brute_force(ra1, dec1, ra2, dec2, radius, maxmatch):
+    # every pair, with the distance computed as SkyIndex does
+    x1, y1, z1 = coords.eq2xyz(ra1, dec1)
+    x2, y2, z2 = coords.eq2xyz(ra2, dec2)
+    dx = x2[None, :] - x1[:, None]
+    dy = y2[None, :] - y1[:, None]
+    dz = z2[None, :] - z1[:, None]
+    chord2 = dx*dx + dy*dy + dz*dz
+    radius = numpy.zeros(len(ra1)) + radius
+    maxchord = 2.0*numpy.sin(0.5*numpy.radians(radius))
+    m1, m2 = numpy.where(chord2 <= (maxchord*maxchord)[:, None])
+    d12 = numpy.degrees(2.0*numpy.arcsin(
+        numpy.minimum(0.5*numpy.sqrt(chord2[m1, m2]), 1.0)))
+    s = numpy.lexsort((m2, d12, m1))
+    m1, m2, d12 = m1[s], m2[s], d12[s]
+    if maxmatch > 0:
+        rank = numpy.zeros(m1.size, dtype='i8')
+        for i in range(1, m1.size):
+            if m1[i] == m1[i-1]:
+                rank[i] = rank[i-1] + 1
+        keep = rank < maxmatch
+        m1, m2, d12 = m1[keep], m2[keep], d12[keep]
+    return m1, m2, d12
+
+
+def _check(result, expected):
+    i1, i2, d12 = result
+    m1, m2, md12 = expected
+    numpy.testing.assert_array_equal(i1, m1)
+    numpy.testing.assert_array_equal(i2, m2)
+    numpy.testing.assert_allclose(d12, md12, rtol=0, atol=1.0e-12)
+
+
+@pytest.mark.parametrize('maxmatch', [0, 1, 3])
+@pytest.mark.parametrize('cellsize', [None, 0.3, 2.0])
+def test_match_matches_brute_force(maxmatch, cellsize):
+    ra1, dec1, ra2, dec2 = _catalogs()
+    radius = 1.5
+    result = skymatch.match(ra1, dec1, ra2, dec2, radius, maxmatch=maxmatch,
+                            cellsize=cellsize)
+    expected = _brute_force(ra1, dec1, ra2, dec2, radius, maxmatch)
+    assert expected[0].size > 0
+    _check(result, expected)
+
+
+def test_match_per_point_radius_and_chunking():
+    ra1, dec1, ra2, dec2 = _catalogs()
+    rng = numpy.random.RandomState(5)
+    radius = rng.uniform(0.1, 4.0, ra1.size)
+    expected = _brute_force(ra1, dec1, ra2, dec2, radius, 0)
+
+    index = skymatch.SkyIndex(ra2, dec2, cellsize=0.5)
+    _check(index.match(ra1, dec1, radius, maxmatch=0), expected)
+    # chunks of points, and blocks of a few candidates within them
+    _check(index.match(ra1, dec1, radius, maxmatch=0, chunksize=37,
+                       max_pairs=50), expected)
+
+
+def test_match_edge_cases():
+    index = skymatch.SkyIndex([10.0, 10.0, 200.0], [20.0, 20.0, -89.9])
+    # duplicates in the catalog are ordered by index
+    i1, i2, d12 = index.match(10.0, 20.0, 1.0/3600, maxmatch=0)
+    assert list(i1) == [0, 0] and list(i2) == [0, 1]
+    # a large radius around the pole
+    i1, i2, d12 = index.match([0.0], [-90.0], 0.2)
+    assert list(i2) == [2]
+    numpy.testing.assert_allclose(d12, 0.1, rtol=0, atol=1.0e-10)
+
+    i1, i2, d12 = index.match([], [], 1.0)
+    assert i1.size == 0 and i2.size == 0 and d12.size == 0
+    i1, i2, d12 = skymatch.SkyIndex([], []).match([1.0], [2.0], 1.0)
+    assert i1.size == 0
+
+    with pytest.raises(ValueError):
+        index.match([1.0, 2.0], [1.0], 1.0)
+    with pytest.raises(ValueError):
+        index.match([1.0, 2.0], [1.0, 2.0], [1.0, 2.0, 3.0])
+
+
+@pytest.mark.parametrize('per_point', [False, True])
+def test_match_nproc_same_as_serial(per_point):
+    ra1, dec1, ra2, dec2 = _catalogs(n1=1000)
+    radius = 1.5
+    if per_point:
+        radius = numpy.random.RandomState(2).uniform(0.1, 3.0, ra1.size)
+    index = skymatch.SkyIndex(ra2, dec2)
+    serial = index.match(ra1, dec1, radius, maxmatch=2, chunksize=100)
+    parallel = index.match(ra1, dec1, radius, maxmatch=2, chunksize=100,
+                           max_pairs=500, nproc=2)
+    for s, p in zip(serial, parallel):
+        numpy.testing.assert_array_equal(p, s)
+    _check(serial, _brute_force(ra1, dec1, ra2, dec2, radius, 2))
+
+
+def _csr_points(offsets):
+    # the point of each entry of CSR arrays
+    return numpy.repeat(numpy.arange(offsets.size-1), numpy.diff(offsets))
+
+
+def test_neighbors_csr_matches_match(tmp_path):
+    ra1, dec1, ra2, dec2 = _catalogs()
+    index = skymatch.SkyIndex(ra2, dec2)
+    i1, i2, d12 = index.match(ra1, dec1, 2.0, maxmatch=0)
+
+    offsets, indices, distances = index.neighbors(ra1, dec1, 2.0,
+                                                  chunksize=64)
+    assert offsets.size == ra1.size+1 and offsets[-1] == i1.size
+    assert indices.dtype == numpy.int32
+    numpy.testing.assert_array_equal(_csr_points(offsets), i1)
+    numpy.testing.assert_array_equal(indices, i2)
+    numpy.testing.assert_array_equal(distances, d12)
+
+    # streamed to a file chunk by chunk
+    filename = str(tmp_path / 'pairs.npy')
+    npairs = index.neighbors(ra1, dec1, 2.0, chunksize=64, dtype='f4',
+                             filename=filename)
+    assert npairs == i1.size
+    chunks = list(skymatch.iter_neighbors(filename))
+    assert [c[0] for c in chunks] == list(range(0, ra1.size, 64))
+    for i0, o, i, d in chunks:
+        numpy.testing.assert_array_equal(i, indices[offsets[i0]:
+                                                    offsets[i0]+o[-1]])
+    foffsets, findices, fdistances = skymatch.read_neighbors(filename)
+    numpy.testing.assert_array_equal(foffsets, offsets)
+    numpy.testing.assert_array_equal(findices, indices)
+    assert fdistances.dtype == numpy.float32
+    numpy.testing.assert_array_equal(fdistances, distances.astype('f4'))
+
+
+def test_neighbors_empty_and_sphneighbors():
+    ra1, dec1, ra2, dec2 = _catalogs()
+    index = skymatch.SkyIndex(ra2, dec2)
+    offsets, indices, distances = index.neighbors([], [], 1.0)
+    assert list(offsets) == [0] and indices.size == 0
+    assert distances.size == 0
+
+    # points with no neighbors have empty ranges
+    offsets, indices, distances = index.neighbors([0.0, 180.0], [0.0, 0.0],
+                                                  1.0e-6)
+    assert list(offsets) == [0, 0, 0]
+
+    expected = index.neighbors(ra1, dec1, 1.0)
+    result = coords.sphneighbors(ra1, dec1, ra2, dec2, 1.0, cellsize=0.7)
+    for r, e in zip(result, expected):
+        numpy.testing.assert_array_equal(r, e)
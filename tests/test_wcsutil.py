@@ -0,0 +1,674 @@
+import subprocess
+import sys
+
+import numpy
+import pytest
+
+from despyastro import wcsutil
+
+
+def _sky_points(wcs, n=2000):
+    x = numpy.linspace(1.0, 2048.0, n)
+    y = numpy.linspace(1.0, 4096.0, n)
+    return x, y, wcs.image2sky(x, y)
+
+
+def test_sky2image_threads_wait_for_lazy_inverse():
+    # a WCS with no inverse in the header fits it on first use; the
+    # other threads must wait for it rather than see it missing
+    hdr = wcsutil._bench_header()
+    ref = wcsutil.WCS(hdr)
+    x, y, (ra, dec) = _sky_points(ref)
+    xref, yref = ref.sky2image(ra, dec, find=False)
+
+    wcs = wcsutil.WCS(hdr)
+    assert wcs.distort.pending()
+    xt, yt = wcs.sky2image(ra, dec, find=False, nthreads=4, chunk_size=100)
+    assert not wcs.distort.pending()
+    numpy.testing.assert_array_equal(xt, xref)
+    numpy.testing.assert_array_equal(yt, yref)
+
+
+def _tan_header(crpix1, crpix2, naxis1, naxis2, rot=0.0):
+    scale = 0.27/3600
+    c, s = numpy.cos(numpy.radians(rot)), numpy.sin(numpy.radians(rot))
+    return {'ctype1': 'RA---TAN', 'ctype2': 'DEC--TAN',
+            'crval1': 35.0, 'crval2': -5.0,
+            'crpix1': crpix1, 'crpix2': crpix2,
+            'cd1_1': -scale*c, 'cd1_2': scale*s,
+            'cd2_1': scale*s, 'cd2_2': scale*c,
+            'naxis1': naxis1, 'naxis2': naxis2}
+
+
+@pytest.mark.parametrize('kernel', ['nearest', 'bilinear', 'lanczos3'])
+def test_reproject_output_past_every_edge(kernel):
+    # a 200x200 output around a 48x64 input, slightly rotated so the
+    # output pixels fall at all fractional positions near the edges
+    wcs_in = wcsutil.WCS(_tan_header(32.5, 24.5, 64, 48))
+    wcs_out = wcsutil.WCS(_tan_header(100.5, 100.5, 200, 200, rot=3.0))
+    image = numpy.ones((48, 64), dtype='f4')
+    out, wout = wcsutil.reproject(image, wcs_in, wcs_out, kernel=kernel)
+    assert out.shape == (200, 200)
+
+    valid = wout > 0
+    numpy.testing.assert_allclose(out[valid], 1.0, rtol=1.0e-5)
+    assert numpy.isnan(out[~valid]).all()
+    # the center is covered, the output corners are not
+    assert valid[100, 100]
+    assert not valid[0, 0] and not valid[0, -1]
+    assert not valid[-1, 0] and not valid[-1, -1]
+
+
+def _sip_header():
+    hdr = _tan_header(1024.5, 2048.5, 2048, 4096)
+    hdr['ctype1'] = 'RA---TAN-SIP'
+    hdr['ctype2'] = 'DEC--TAN-SIP'
+    hdr['a_order'] = 2
+    hdr['b_order'] = 2
+    hdr['a_2_0'] = 2.0e-6
+    hdr['a_1_1'] = -1.0e-6
+    hdr['b_0_2'] = 1.5e-6
+    hdr['b_1_1'] = 0.5e-6
+    hdr['ap_order'] = 2
+    hdr['bp_order'] = 2
+    hdr['ap_2_0'] = -2.0e-6
+    hdr['ap_1_1'] = 1.0e-6
+    hdr['bp_0_2'] = -1.5e-6
+    hdr['bp_1_1'] = -0.5e-6
+    return hdr
+
+
+def test_build_wcs_list_mixed_sip_tpv_table():
+    # rows of SIP and TPV headers in one table: the keys a row does not
+    # have are NaN, which makes the SIP orders float
+    headers = [_sip_header(), wcsutil._bench_header()]
+    keys = sorted(set(headers[0]) | set(headers[1]))
+    dtype = [(k.upper(), 'U16' if k.startswith('ctype') else 'f8')
+             for k in keys]
+    table = numpy.zeros(len(headers), dtype=dtype)
+    for i, hdr in enumerate(headers):
+        for k in keys:
+            table[k.upper()][i] = hdr.get(k, numpy.nan)
+    assert table['A_ORDER'].dtype.kind == 'f'
+
+    x = numpy.array([1.0, 500.0, 2048.0])
+    y = numpy.array([1.0, 3000.0, 4096.0])
+    wcslist = wcsutil.build_wcs_list(table)
+    for i, hdr in enumerate(headers):
+        ref = wcsutil.WCS(hdr)
+        for wcs in [wcslist[i], wcsutil.WCS(table[i], minimal=True)]:
+            assert wcs.distort['name'] == ref.distort['name']
+            lon, lat = wcs.image2sky(x, y)
+            rlon, rlat = ref.image2sky(x, y)
+            numpy.testing.assert_array_equal(lon, rlon)
+            numpy.testing.assert_array_equal(lat, rlat)
+    assert wcslist[0].distort['a_order'] == 2
+    assert wcslist[0].distort['ap_order'] == 2
+
+
+def test_inverse_store_write_errors_are_ignored(tmp_path, monkeypatch):
+    def replace(src, dst):
+        raise PermissionError(13, 'Permission denied', dst)
+
+    monkeypatch.setattr(wcsutil.os, 'replace', replace)
+    monkeypatch.setattr(wcsutil, '_inverse_store', wcsutil._unset)
+    wcsutil.set_inverse_store(str(tmp_path))
+    wcs = wcsutil.WCS(wcsutil._bench_header())
+    x, y, (ra, dec) = _sky_points(wcs, n=10)
+    xt, yt = wcs.sky2image(ra, dec, find=False)
+    numpy.testing.assert_allclose(xt, x, atol=0.01)
+    numpy.testing.assert_allclose(yt, y, atol=0.01)
+    # the fitted inverse is kept, and no temporary file left behind
+    assert wcs.distort.has_inverse()
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_set_inverse_store_none_overrides_environment(tmp_path,
+                                                      monkeypatch):
+    monkeypatch.setenv('DESPYASTRO_INVERSE_STORE', str(tmp_path))
+    monkeypatch.setattr(wcsutil, '_inverse_store', wcsutil._unset)
+    assert wcsutil.get_inverse_store().directory == str(tmp_path)
+    wcsutil.set_inverse_store(None)
+    assert wcsutil.get_inverse_store() is None
+
+
+def test_inverse_table_leaves_shared_wcs_unchanged():
+    # the table is returned, so the WCS shared through get_wcs gives the
+    # same results to the other holders
+    hdr = wcsutil._bench_header()
+    wcs = wcsutil.get_wcs(hdr)
+    x, y, (ra, dec) = _sky_points(wcs)
+    xref, yref = wcs.sky2image(ra, dec, find=True)
+
+    table = wcs.build_inverse_table(resolution=64.0)
+    assert table['maxerr'] < 0.01
+    assert wcsutil.get_wcs(hdr) is wcs
+    xf, yf = wcs.sky2image(ra, dec, find=True)
+    numpy.testing.assert_array_equal(xf, xref)
+    numpy.testing.assert_array_equal(yf, yref)
+
+    xt, yt = wcs.sky2image(ra, dec, find='table', table=table)
+    numpy.testing.assert_allclose(xt, xref, atol=1.0e-6)
+    numpy.testing.assert_allclose(yt, yref, atol=1.0e-6)
+    with pytest.raises(ValueError):
+        wcs.sky2image(ra, dec, find='table')
+
+
+def test_chunks_reblock_pieces():
+    wcs = wcsutil.WCS(wcsutil._bench_header())
+    x = numpy.linspace(1.0, 2048.0, 1000)
+    y = numpy.linspace(1.0, 4096.0, 1000)
+    lon, lat = wcs.image2sky(x, y)
+
+    # pieces smaller and larger than the chunk are merged and split
+    sizes = [3, 250, 7, 1, 400, 90, 249]
+    edges = numpy.cumsum([0] + sizes)
+    xpieces = [x[i0:i1] for i0, i1 in zip(edges[:-1], edges[1:])]
+    ypieces = [y[i0:i1] for i0, i1 in zip(edges[:-1], edges[1:])]
+    blocks = list(wcs.image2sky_chunks(xpieces, ypieces, chunk=128))
+    assert [b[0].size for b in blocks] == [128]*7 + [104]
+    numpy.testing.assert_array_equal(
+        numpy.concatenate([b[0] for b in blocks]), lon)
+    numpy.testing.assert_array_equal(
+        numpy.concatenate([b[1] for b in blocks]), lat)
+
+
+def test_chunks_different_number_of_pieces():
+    wcs = wcsutil.WCS(wcsutil._bench_header())
+    x = numpy.ones(10)
+    with pytest.raises(ValueError):
+        list(wcs.image2sky_chunks([x, x], [x], chunk=4))
+    with pytest.raises(ValueError):
+        list(wcs.sky2image_chunks([x], [x, x], chunk=4))
+
+
+def test_import_without_numpy():
+    # wcsutil imports numpy under a guard, so nothing at module level may
+    # need it
+    code = (
+        "import sys, importlib.util\n"
+        "class Block(object):\n"
+        "    def find_spec(self, name, path=None, target=None):\n"
+        "        if name.split('.')[0] in ('numpy', 'scipy'):\n"
+        "            raise ImportError(name)\n"
+        "sys.meta_path.insert(0, Block())\n"
+        "spec = importlib.util.spec_from_file_location('wcsutil', %r)\n"
+        "module = importlib.util.module_from_spec(spec)\n"
+        "spec.loader.exec_module(module)\n"
+        "assert not module.have_numpy\n" % wcsutil.__file__)
+    subprocess.check_call([sys.executable, '-c', code])
+
+
+def _shifted_header(crval1):
+    hdr = wcsutil._bench_header()
+    hdr['crval1'] = crval1
+    return hdr
+
+
+def test_wcs_cache_counters_and_eviction():
+    cache = wcsutil.WCSCache(maxsize=2)
+    h1, h2, h3 = [_shifted_header(c) for c in (10.0, 20.0, 30.0)]
+    w1 = cache.get(h1)
+    assert cache.get(dict(h1, object='other')) is w1
+    w2 = cache.get(h2)
+    # h1 is now the most recently used, so h2 goes first
+    assert cache.get(h1) is w1
+    cache.get(h3)
+    assert cache.cache_info() == {'hits': 2, 'misses': 3, 'evictions': 1,
+                                  'size': 2, 'maxsize': 2}
+    assert cache.get(h1) is w1
+    assert cache.get(h2) is not w2
+    cache.resize(0)
+    assert len(cache) == 0
+
+
+def test_wcs_cache_entry_built_by_another_thread(monkeypatch):
+    # while this thread builds the WCS another one inserts it: that entry
+    # is returned, as the most recently used, and counted as a hit
+    cache = wcsutil.WCSCache(maxsize=2)
+    h1, h2 = _shifted_header(10.0), _shifted_header(20.0)
+    WCS = wcsutil.WCS
+    built = []
+
+    def build(*args, **kwargs):
+        if not built:
+            built.append(None)
+            built[0] = cache.get(h1)
+            cache.get(h2)
+        return WCS(*args, **kwargs)
+
+    monkeypatch.setattr(wcsutil, 'WCS', build)
+    assert cache.get(h1) is built[0]
+    monkeypatch.setattr(wcsutil, 'WCS', WCS)
+    info = cache.cache_info()
+    assert (info['hits'], info['misses']) == (1, 2)
+
+    # h1 was moved to the end, so h2 is evicted first
+    cache.get(_shifted_header(30.0))
+    assert cache.get(h1) is built[0]
+
+
+@pytest.mark.parametrize('header', ['tpv', 'sip'])
+def test_sky2image_newton_round_trip(header):
+    if header == 'tpv':
+        wcs = wcsutil.WCS(wcsutil._bench_header())
+    else:
+        wcs = wcsutil.WCS(_sip_header())
+    rng = numpy.random.RandomState(1)
+    x = rng.uniform(-100.0, 2148.0, 5000)
+    y = rng.uniform(-100.0, 4196.0, 5000)
+    ra, dec = wcs.image2sky(x, y)
+
+    xt, yt = wcs.sky2image(ra, dec, find=True)
+    assert numpy.abs(xt-x).max() < 1.0e-8
+    assert numpy.abs(yt-y).max() < 1.0e-8
+
+    # the same as the point by point solution
+    xf, yf = wcs._findxy_fsolve(ra[0:20], dec[0:20])
+    numpy.testing.assert_allclose(xt[0:20], xf, rtol=0, atol=1.0e-6)
+    numpy.testing.assert_allclose(yt[0:20], yf, rtol=0, atol=1.0e-6)
+
+    # scalars in, scalars out
+    xs, ys = wcs.sky2image(ra[0], dec[0])
+    assert numpy.isscalar(xs) and abs(xs-x[0]) < 1.0e-8
+
+
+@pytest.mark.parametrize('shape', [(1, 1), (4, 4), (5, 3), (2, 6)])
+def test_polynomial2d_matches_apply2dpolynomial(shape):
+    rng = numpy.random.RandomState(2)
+    a = rng.normal(size=shape)
+    a[rng.uniform(size=shape) < 0.3] = 0.0
+    x = rng.uniform(-1.5, 1.5, 1000)
+    y = rng.uniform(-1.5, 1.5, 1000)
+    ref = wcsutil.Apply2DPolynomial(a, x, y)
+
+    poly = wcsutil.Polynomial2D(a)
+    assert poly.nterms == (a != 0).sum()
+    numpy.testing.assert_allclose(poly(x, y), ref, rtol=1.0e-12,
+                                  atol=1.0e-12)
+
+    out = numpy.empty_like(x)
+    work = numpy.empty_like(x)
+    assert poly(x, y, out=out, work=work) is out
+    numpy.testing.assert_allclose(out, ref, rtol=1.0e-12, atol=1.0e-12)
+
+
+def test_polynomial2d_zero_and_float32():
+    zero = wcsutil.Polynomial2D(numpy.zeros((3, 3)))
+    assert (zero([1.0, 2.0], [3.0, 4.0]) == 0.0).all()
+    a = numpy.array([[0.5, 1.0], [2.0, -1.0]])
+    x = numpy.linspace(0, 1, 10, dtype='f4')
+    v = wcsutil.Polynomial2D(a)(x, x)
+    assert v.dtype == numpy.float32
+    numpy.testing.assert_allclose(
+        v, wcsutil.Apply2DPolynomial(a, x.astype('f8'), x.astype('f8')),
+        rtol=1.0e-6)
+
+
+def test_image2sky_grid_matches_exact():
+    pytest.importorskip('scipy')
+    wcs = wcsutil.WCS(wcsutil._bench_header())
+    shape = (600, 300)
+    scale = 7.286e-05
+    lon, lat, err = wcs.image2sky_grid(shape=shape, step=64, tol=1.0e-3,
+                                       get_err=True)
+    assert lon.shape == shape and err < 1.0e-3
+
+    x, y = numpy.meshgrid(numpy.arange(1.0, 301.0),
+                          numpy.arange(1.0, 601.0))
+    rlon, rlat = wcs.image2sky(x, y)
+    dlon = (lon-rlon)*numpy.cos(numpy.radians(rlat))
+    assert numpy.abs(dlon).max()/scale < 2.0e-3
+    assert numpy.abs(lat-rlat).max()/scale < 2.0e-3
+
+    out = (numpy.empty(shape), numpy.empty(shape))
+    res = wcs.image2sky_grid(shape=shape, out=out)
+    assert res[0] is out[0] and res[1] is out[1]
+    with pytest.raises(ValueError):
+        wcs.image2sky_grid(shape=shape, out=(numpy.empty((2, 2)),
+                                             numpy.empty((2, 2))))
+
+
+def test_image2sky_float32_and_out():
+    wcs = wcsutil.WCS(wcsutil._bench_header())
+    x, y, (lon, lat) = _sky_points(wcs)
+    scale = 7.286e-05
+
+    lon4, lat4 = wcs.image2sky(x, y, dtype='f4')
+    assert lon4.dtype == numpy.float64
+    dlon = (lon4-lon)*numpy.cos(numpy.radians(lat))
+    # within the documented ~2e-7*|x-crpix| pixels
+    assert numpy.abs(dlon).max()/scale < 3.0e-3
+    assert numpy.abs(lat4-lat).max()/scale < 3.0e-3
+
+    out = (numpy.empty(x.shape), numpy.empty(x.shape))
+    res = wcs.image2sky(x, y, out=out)
+    assert res[0] is out[0] and res[1] is out[1]
+    numpy.testing.assert_array_equal(out[0], lon)
+    numpy.testing.assert_array_equal(out[1], lat)
+
+    # 2-d input and output keep the shape
+    res = wcs.image2sky(x.reshape(40, 50), y.reshape(40, 50))
+    numpy.testing.assert_array_equal(res[0], lon.reshape(40, 50))
+
+
+def test_threaded_transforms_match_serial():
+    wcs = wcsutil.WCS(wcsutil._bench_header())
+    x, y, (lon, lat) = _sky_points(wcs, n=10007)
+    xs, ys = wcs.sky2image(lon, lat)
+    xi, yi = wcs.sky2image(lon, lat, find=False)
+
+    for nthreads, chunk_size in [(1, 1000), (3, 1000), (4, None)]:
+        tlon, tlat = wcs.image2sky(x, y, nthreads=nthreads,
+                                   chunk_size=chunk_size)
+        numpy.testing.assert_array_equal(tlon, lon)
+        numpy.testing.assert_array_equal(tlat, lat)
+
+        tx, ty = wcs.sky2image(lon, lat, nthreads=nthreads,
+                               chunk_size=chunk_size)
+        numpy.testing.assert_array_equal(tx, xs)
+        numpy.testing.assert_array_equal(ty, ys)
+        tx, ty = wcs.sky2image(lon, lat, find=False, nthreads=nthreads,
+                               chunk_size=chunk_size)
+        numpy.testing.assert_array_equal(tx, xi)
+        numpy.testing.assert_array_equal(ty, yi)
+
+    # into output buffers, in float32
+    out = (numpy.empty(x.size), numpy.empty(x.size))
+    wcs.image2sky(x, y, dtype='f4', out=out, nthreads=3, chunk_size=999)
+    lon4, lat4 = wcs.image2sky(x, y, dtype='f4')
+    numpy.testing.assert_array_equal(out[0], lon4)
+    numpy.testing.assert_array_equal(out[1], lat4)
+
+
+class _PythonBackend(wcsutil.NumbaBackend):
+    # the fused kernels as plain python, their reference implementation
+    name = 'python'
+
+    def __init__(self):
+        self._image2sky, self._sph2image = \
+            wcsutil._make_fused_kernels(lambda func: func)
+
+
+@pytest.mark.parametrize('header', ['tpv', 'sip', 'tan'])
+def test_fused_kernels_match_numpy_backend(header, monkeypatch):
+    monkeypatch.setitem(wcsutil._backends, 'python', _PythonBackend)
+    monkeypatch.setattr(wcsutil, '_backend_instances', {})
+    if header == 'tpv':
+        wcs = wcsutil.WCS(wcsutil._bench_header())
+    elif header == 'sip':
+        wcs = wcsutil.WCS(_sip_header())
+    else:
+        wcs = wcsutil.WCS(_tan_header(1024.5, 2048.5, 2048, 4096))
+    x, y = _sky_points(wcs, n=200)[0:2]
+
+    for distort in [True, False]:
+        lon, lat = wcs.image2sky(x, y, distort=distort, backend='numpy')
+        flon, flat = wcs.image2sky(x, y, distort=distort, backend='python')
+        numpy.testing.assert_allclose(flon, lon, rtol=0, atol=1.0e-11)
+        numpy.testing.assert_allclose(flat, lat, rtol=0, atol=1.0e-11)
+
+    xt, yt = wcs.sky2image(lon, lat, find=False, backend='numpy')
+    fx, fy = wcs.sky2image(lon, lat, find=False, backend='python')
+    numpy.testing.assert_allclose(fx, xt, rtol=0, atol=1.0e-8)
+    numpy.testing.assert_allclose(fy, yt, rtol=0, atol=1.0e-8)
+
+
+def test_backend_registry(monkeypatch):
+    monkeypatch.setitem(wcsutil._backends, 'python', _PythonBackend)
+    monkeypatch.setattr(wcsutil, '_backend_instances', {})
+    monkeypatch.setattr(wcsutil, '_default_backend', None)
+    names = wcsutil.available_backends()
+    assert 'numpy' in names and 'python' in names
+    try:
+        import numba  # noqa: F401
+    except ImportError:
+        assert 'numba' not in names
+        with pytest.raises(ImportError):
+            wcsutil.set_backend('numba')
+    assert wcsutil.get_backend('python').name == 'python'
+    with pytest.raises(ValueError):
+        wcsutil.get_backend('nonesuch')
+
+    monkeypatch.setenv('DESPYASTRO_WCS_BACKEND', 'numpy')
+    assert wcsutil.get_backend().name == 'numpy'
+    assert wcsutil.set_backend('python').name == 'python'
+    assert wcsutil.get_backend().name == 'python'
+    wcsutil.set_backend(None)
+    assert wcsutil.get_backend().name == 'numpy'
+
+
+def _unit_vectors(lon, lat):
+    lon = numpy.radians(lon)
+    lat = numpy.radians(lat)
+    return numpy.array([numpy.cos(lat)*numpy.cos(lon),
+                        numpy.cos(lat)*numpy.sin(lon), numpy.sin(lat)])
+
+
+@pytest.mark.parametrize('header', ['tpv', 'sip'])
+def test_jacobian_and_pixel_area_match_finite_differences(header):
+    if header == 'tpv':
+        wcs = wcsutil.WCS(wcsutil._bench_header())
+    else:
+        wcs = wcsutil.WCS(_sip_header())
+    x, y = _sky_points(wcs, n=50)[0:2]
+    h = 0.01
+
+    lon_xp, lat_xp = wcs.image2sky(x+h, y)
+    lon_xm, lat_xm = wcs.image2sky(x-h, y)
+    lon_yp, lat_yp = wcs.image2sky(x, y+h)
+    lon_ym, lat_ym = wcs.image2sky(x, y-h)
+    expected = [(lon_xp-lon_xm)/(2*h), (lon_yp-lon_ym)/(2*h),
+                (lat_xp-lat_xm)/(2*h), (lat_yp-lat_ym)/(2*h)]
+    # to 1e-7 of the pixel scale, the rounding of the differences
+    for d, e in zip(wcs.jacobian(x, y), expected):
+        numpy.testing.assert_allclose(d, e, rtol=0, atol=1.0e-11)
+
+    # solid angle of the pixel from the derivatives of the unit vectors
+    dqdx = (_unit_vectors(lon_xp, lat_xp) -
+            _unit_vectors(lon_xm, lat_xm))/(2*h)
+    dqdy = (_unit_vectors(lon_yp, lat_yp) -
+            _unit_vectors(lon_ym, lat_ym))/(2*h)
+    area = numpy.sqrt((numpy.cross(dqdx.T, dqdy.T)**2).sum(axis=1))
+    area *= (180.0/numpy.pi*3600.0)**2
+    numpy.testing.assert_allclose(wcs.pixel_area(x, y), area, rtol=1.0e-6)
+    numpy.testing.assert_allclose(wcs.pixel_area(x, y, units='degree'),
+                                  area/3600.0**2, rtol=1.0e-6)
+
+
+def test_pixel_area_map():
+    wcs = wcsutil.WCS(_tan_header(10.5, 20.5, 30, 40))
+    amap = wcs.pixel_area_map()
+    assert amap.shape == (40, 30)
+    assert amap[20, 10] == pytest.approx(0.27**2, rel=1.0e-6)
+    assert amap[3, 7] == wcs.pixel_area(8.0, 4.0)
+    out = numpy.empty((40, 30))
+    assert wcs.pixel_area_map(out=out) is out
+
+
+@pytest.mark.parametrize('max_order', [7, 0])
+def test_pixel_mapping_matches_exact(max_order):
+    pytest.importorskip('scipy')
+    wcs_src = wcsutil.WCS(wcsutil._bench_header())
+    wcs_dst = wcsutil.WCS(_tan_header(-2500.0, 5500.0, 3000, 3000,
+                                      rot=10.0))
+    mapping = wcsutil.PixelMapping(wcs_src, wcs_dst, shape=(400, 300),
+                                   tol=1.0e-3, max_order=max_order)
+    assert mapping.method == ('poly' if max_order else 'spline')
+    assert mapping.maxerr <= 1.0e-3
+    assert mapping.check(n=2000, seed=1) < 2.0e-3
+
+    xd, yd = mapping.grid()
+    assert xd.shape == (400, 300)
+    x = numpy.array([1.0, 300.0, 17.0, 150.0])
+    y = numpy.array([1.0, 400.0, 311.0, 77.0])
+    xe, ye = mapping.exact(x, y)
+    ix, iy = x.astype(int)-1, y.astype(int)-1
+    assert numpy.hypot(xd[iy, ix]-xe, yd[iy, ix]-ye).max() < 2.0e-3
+
+    # a band of rows, and points off the source mapped exactly
+    xr, yr = mapping.grid(rows=(100, 120))
+    numpy.testing.assert_allclose(xr, xd[100:120], rtol=0, atol=1.0e-9)
+    xo, yo = mapping([-50.0, 400.0], [10.0, 500.0])
+    xe, ye = mapping.exact([-50.0, 400.0], [10.0, 500.0])
+    numpy.testing.assert_array_equal(xo, xe)
+    numpy.testing.assert_array_equal(yo, ye)
+
+
+def _true_polys(order, rng):
+    a = numpy.zeros((order+1, order+1))
+    b = numpy.zeros((order+1, order+1))
+    for ix in range(order+1):
+        for iy in range(order+1-ix):
+            a[ix, iy] = rng.normal()*10.0**(-3*(ix+iy))
+            b[ix, iy] = rng.normal()*10.0**(-3*(ix+iy))
+    return a, b
+
+
+@pytest.mark.parametrize('method', ['lstsq', 'qr', 'normal'])
+def test_fit2dpolynomial_recovers_polynomial(method):
+    rng = numpy.random.RandomState(4)
+    a, b = _true_polys(3, rng)
+    u = rng.uniform(-1.0, 1.0, 500)
+    v = rng.uniform(-1.0, 1.0, 500)
+    x = wcsutil.Apply2DPolynomial(a, u, v)
+    y = wcsutil.Apply2DPolynomial(b, u, v)
+    afit, bfit = wcsutil.Fit2DPolynomial(u, v, x, y, 3, method=method)
+    numpy.testing.assert_allclose(afit, a, rtol=0, atol=1.0e-9)
+    numpy.testing.assert_allclose(bfit, b, rtol=0, atol=1.0e-9)
+
+
+def test_fit2dpolynomial_pixel_offsets():
+    # polynomials of pixel offsets, with terms differing by many orders
+    # of magnitude, fit without scaling the coordinates
+    rng = numpy.random.RandomState(5)
+    a, b = _true_polys(5, rng)
+    u = rng.uniform(-4000.0, 4000.0, 3000)
+    v = rng.uniform(-4000.0, 4000.0, 3000)
+    x = wcsutil.Apply2DPolynomial(a, u, v)
+    y = wcsutil.Apply2DPolynomial(b, u, v)
+    for method in ['lstsq', 'qr']:
+        afit, bfit = wcsutil.Fit2DPolynomial(u, v, x, y, 5, method=method)
+        xfit = wcsutil.Apply2DPolynomial(afit, u, v)
+        yfit = wcsutil.Apply2DPolynomial(bfit, u, v)
+        assert numpy.abs(xfit-x).max() < 1.0e-6*numpy.abs(x).max()
+        assert numpy.abs(yfit-y).max() < 1.0e-6*numpy.abs(y).max()
+
+
+def test_fit2dpolynomial_weights_and_clipping():
+    rng = numpy.random.RandomState(6)
+    a, b = _true_polys(2, rng)
+    u = rng.uniform(-1.0, 1.0, 400)
+    v = rng.uniform(-1.0, 1.0, 400)
+    x = wcsutil.Apply2DPolynomial(a, u, v) + rng.normal(0, 1.0e-6, 400)
+    y = wcsutil.Apply2DPolynomial(b, u, v) + rng.normal(0, 1.0e-6, 400)
+    bad = numpy.arange(0, 400, 40)
+    x[bad] += 1.0
+
+    weights = numpy.ones(400)
+    weights[bad] = 0.0
+    afit, bfit = wcsutil.Fit2DPolynomial(u, v, x, y, 2, weights=weights)
+    numpy.testing.assert_allclose(afit, a, rtol=0, atol=1.0e-5)
+
+    afit, bfit, info = wcsutil.Fit2DPolynomial(u, v, x, y, 2, nsigma=4.0,
+                                               get_info=True)
+    numpy.testing.assert_allclose(afit, a, rtol=0, atol=1.0e-5)
+    numpy.testing.assert_array_equal(numpy.where(~info['used'])[0], bad)
+    assert info['xrms'] < 1.0e-5 and info['niter'] >= 1
+
+    with pytest.raises(ValueError):
+        wcsutil.Fit2DPolynomial(u, v, x, y, 2, method='cholesky')
+
+
+def test_inverse_tol_and_find_auto():
+    hdr = wcsutil._bench_header()
+    wcs = wcsutil.WCS(hdr, inverse_tol=1.0e-4)
+    x, y, (ra, dec) = _sky_points(wcs)
+    xi, yi = wcs.sky2image(ra, dec, find=False)
+    assert wcs.distort['inverse_maxerr'] <= 1.0e-4
+    assert numpy.hypot(xi-x, yi-y).max() <= 1.0e-4
+    maxerr, rms = wcs.InverseError(force=True)
+    assert rms <= maxerr <= 1.0e-4
+
+    # the default inverse is not as good
+    loose = wcsutil.WCS(hdr)
+    assert loose.InverseError()[0] > wcs.InverseError()[0]
+
+    # find='auto' gives the root found solution to auto_tol, also off the
+    # image where the polynomial is not checked
+    xo = numpy.concatenate([x, [-300.0, 2400.0]])
+    yo = numpy.concatenate([y, [-300.0, 4500.0]])
+    rao, deco = loose.image2sky(xo, yo)
+    xa, ya = loose.sky2image(rao, deco, find='auto', auto_tol=1.0e-6)
+    assert numpy.hypot(xa-xo, ya-yo).max() < 1.0e-6
+    xa, ya = wcs.sky2image(ra, dec, find='auto', auto_tol=1.0e-3)
+    numpy.testing.assert_array_equal(xa, xi)
+    numpy.testing.assert_array_equal(ya, yi)
+
+
+def test_compact_wcs_round_trip():
+    import pickle
+
+    for hdr in [wcsutil._bench_header(), _sip_header()]:
+        wcs = wcsutil.WCS(hdr)
+        x, y, (ra, dec) = _sky_points(wcs, n=100)
+        pending = pickle.loads(pickle.dumps(wcs.compact()))
+        xi, yi = wcs.sky2image(ra, dec, find=False)
+
+        compact = wcs.compact()
+        data = pickle.dumps(compact)
+        assert len(data) < len(pickle.dumps(wcs))/3
+        copy = pickle.loads(data).to_wcs()
+        # the inverse is carried over, not fit again
+        assert not copy.distort.pending()
+        numpy.testing.assert_array_equal(copy.image2sky(x, y)[0], ra)
+        numpy.testing.assert_array_equal(copy.image2sky(x, y)[1], dec)
+        xc, yc = copy.sky2image(ra, dec, find=False)
+        numpy.testing.assert_array_equal(xc, xi)
+        numpy.testing.assert_array_equal(yc, yi)
+
+        # compacted before the inverse was needed, it is fit when it is
+        copy = pending.to_wcs()
+        numpy.testing.assert_array_equal(copy.image2sky(x, y)[0], ra)
+        numpy.testing.assert_allclose(copy.sky2image(ra, dec)[0], x,
+                                      rtol=0, atol=1.0e-8)
+
+
+def _shared_worker(args):
+    shared, i, x, y = args
+    wcs = shared[i].to_wcs()
+    return wcs.image2sky(x, y)
+
+
+@pytest.mark.parametrize('method', ['fork', 'spawn'])
+def test_shared_wcs_list_in_pool(method):
+    import multiprocessing
+    import pickle
+
+    if method not in multiprocessing.get_all_start_methods():
+        pytest.skip('no %s start method' % method)
+
+    wcslist = [wcsutil.WCS(_shifted_header(c)) for c in (10.0, 20.0, 30.0)]
+    x, y = _sky_points(wcslist[0], n=50)[0:2]
+    shared = wcsutil.SharedWCSList(wcslist)
+    try:
+        assert len(shared) == 3
+        assert len(pickle.dumps(shared)) < 200
+        numpy.testing.assert_array_equal(shared[-1].to_wcs().image2sky(x, y),
+                                         wcslist[2].image2sky(x, y))
+        with pytest.raises(IndexError):
+            shared[3]
+
+        pool = multiprocessing.get_context(method).Pool(2)
+        try:
+            results = pool.map(_shared_worker,
+                               [(shared, i, x, y) for i in range(3)])
+        finally:
+            pool.close()
+            pool.join()
+        for w, (lon, lat) in zip(wcslist, results):
+            rlon, rlat = w.image2sky(x, y)
+            numpy.testing.assert_array_equal(lon, rlon)
+            numpy.testing.assert_array_equal(lat, rlat)
+    finally:
+        shared.unlink()